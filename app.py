@@ -1,34 +1,140 @@
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_caching import Cache
+from sqlalchemy.pool import QueuePool
 
 DB_FILE = "clubreview.db"
 
 app = Flask(__name__)
-cache = Cache(app)
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{DB_FILE}"
 app.config['SECRET_KEY'] = 'pennlabs'
 app.config['UPLOAD_FOLDER'] = 'club_files'
+# Uploaded content, stored once per distinct sha256 (see storage.py).
+# UPLOAD_FOLDER still holds files uploaded before that.
+app.config['BLOB_FOLDER'] = 'club_blobs'
+app.config['BLOB_CHUNK_SIZE'] = 64 * 1024
+# Let the front-end server send file downloads: None, 'x-sendfile' (Apache,
+# lighttpd) or 'x-accel-redirect' (nginx, with an internal location at
+# FILE_ACCEL_PREFIX aliased to BLOB_FOLDER).
+app.config['FILE_OFFLOAD'] = None
+app.config['FILE_ACCEL_PREFIX'] = '/_blobs/'
+# ?size= presets for image downloads, by longest side (see derivatives.py).
+app.config['IMAGE_SIZES'] = {'thumb': 128, 'small': 320, 'medium': 800}
+app.config['IMAGE_WORKERS'] = 1
+app.config['IMAGE_QUEUE'] = 16
+app.config['DERIVATIVE_FOLDER'] = 'club_derivatives'
+app.config['DERIVATIVE_MAX_BYTES'] = 256 * 1024 * 1024
+app.config['DERIVATIVE_JPEG_QUALITY'] = 80
+app.config['CLUB_STREAM_CHUNK_SIZE'] = 500
+# Serialized clubs kept per worker for list responses (utils.club_fragments).
+app.config['CLUB_FRAGMENT_CACHE_SIZE'] = 100000
+app.config['CLUB_FRAGMENT_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+# Most usernames or codes accepted by one batch request.
+app.config['BATCH_MAX_ITEMS'] = 1000
+# Deeper replies are left out of threaded comment responses; fetch them with
+# the thread endpoint of the deepest comment returned.
+app.config['COMMENT_THREAD_MAX_DEPTH'] = 50
+# In-process LRU by default. Point CACHE_TYPE at a shared backend (e.g.
+# flask_caching.backends.FileSystemCache with CACHE_DIR) to share entries
+# between gunicorn workers.
+app.config['CACHE_TYPE'] = 'caching.LRUCache'
+app.config['CACHE_THRESHOLD'] = 2048
+app.config['CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+app.config['CACHE_DEFAULT_TIMEOUT'] = 3600
+# Pick up invalidations made by other workers (from the cache_tag table) at
+# the start of each request. Not needed when the backend itself is shared.
+app.config['CACHE_SYNC'] = True
+# Cached responses at least this big are compressed for clients that accept
+# it, in this order of preference ('br' needs the brotli package).
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_ENCODINGS'] = ['br', 'gzip']
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+app.config['AUTH_CACHE_SIZE'] = 10000
+app.config['AUTH_CACHE_TTL'] = 300
+app.config['REVOCATION_FILTER_CAPACITY'] = 100000
+app.config['REVOCATION_FILTER_ERROR_RATE'] = 0.001
+app.config['TOKEN_PURGE_INTERVAL'] = 3600
+app.config['BCRYPT_LOG_ROUNDS'] = 12
+app.config['PASSWORD_HASH_WORKERS'] = 1
+# Hashes running or queued stay below the request threads (gunicorn.sh runs
+# 2), so a login storm always leaves a thread for other requests; past that
+# a login or signup gets a 503 with Retry-After straight away.
+app.config['PASSWORD_HASH_QUEUE'] = 0
+app.config['PASSWORD_HASH_WAIT'] = 0
+# Scraper sources by name (see scraper.SOURCES) and the page each reads.
+app.config['SCRAPER_SOURCES'] = {'ocwp': 'https://ocwp.pennlabs.org/'}
+app.config['SCRAPER_WORKERS'] = 4
+app.config['SCRAPER_TIMEOUT'] = 30
+# Pool connections instead of opening one per checkout; the write
+# coordinator (database.py) keeps one of them for itself.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': QueuePool, 'pool_size': 5, 'max_overflow': 10,
+                                           'pool_timeout': 10, 'connect_args': {'check_same_thread': False, 'timeout': 15}}
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Applied to every new connection. journal_mode sticks to the file; the
+# rest are per connection.
+app.config['SQLITE_PRAGMAS'] = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'mmap_size': 256 * 1024 * 1024,
+                                'cache_size': -64 * 1024, 'temp_store': 'MEMORY'}
+app.config['WRITE_COORDINATOR'] = True
+app.config['WRITE_BATCH_SIZE'] = 64
+app.config['WRITE_BATCH_WAIT'] = 0.001
+# Per-route request metrics for /api/metrics (see metrics.py). Each worker
+# writes its own to METRICS_FOLDER, which they must share.
+app.config['METRICS'] = True
+app.config['METRICS_FOLDER'] = 'metrics'
+app.config['METRICS_FLUSH_INTERVAL'] = 1
+# Sample request stacks and keep those of slow requests, as flame graph
+# input in PROFILE_FOLDER. Costs a thread waking every PROFILE_INTERVAL.
+app.config['PROFILE'] = False
+app.config['PROFILE_INTERVAL'] = 0.005
+app.config['PROFILE_SLOW_SECONDS'] = 0.5
+app.config['PROFILE_FOLDER'] = 'profiles'
+app.config.from_envvar('CLUBREVIEW_SETTINGS', silent=True)
+cache = Cache(app)
 db = SQLAlchemy(app)
+import database
+import metrics
+app.json = metrics.JSONProvider(app)
 
 def token_required(f):
     from functools import wraps
     @wraps(f)
     def decorator(*args, **kwargs):
-        from utils import make_response, validate_token, decode_token
+        from utils import make_response, authenticate
         token = None
         if 'auth_token' in request.headers:
             token = request.headers.get('auth_token')
         if not token:
             return make_response(False, 'A valid auth token is missing', 401)
-        if not validate_token(token):
+        current_user = authenticate(token)
+        if current_user is None:
             return make_response(False, 'Your auth token is invalid/has expired.', 401)
-        from models import User
-        username = decode_token(token)
-        current_user = User.query.filter_by(username=username).first()
         return f(current_user, *args, **kwargs)
     return decorator
 
+@app.before_request
+def start_metrics():
+    if app.config.get('METRICS'):
+        metrics.start()
+
+@app.before_request
+def sync_cache():
+    if app.config.get('CACHE_SYNC'):
+        from caching import sync
+        sync()
+
+@app.after_request
+def record_metrics(response):
+    if app.config.get('METRICS'):
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.finish(route, request.method, response.status_code,
+                       None if response.is_streamed else response.content_length)
+    return response
+
+@app.teardown_request
+def clear_metrics(error):
+    metrics.clear()
+
 from views.club import club
 from views.tag import tag
 from views.auth import auth
@@ -40,6 +146,15 @@ app.register_blueprint(auth)
 app.register_blueprint(user)
 app.register_blueprint(favorite)
 
+from passwords import PasswordHasherBusy
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    from utils import make_response
+    response, code = make_response(False, 'Too many logins right now, please try again shortly.', 503)
+    response.headers['Retry-After'] = '1'
+    return response, code
+
 @app.route('/')
 def main():
     return "Welcome to Penn Club Review!"
@@ -48,5 +163,15 @@ def main():
 def api():
     return jsonify({"message": "Welcome to the Penn Club Review API!."}), 200
 
+@app.route('/api/cache')
+def cache_stats():
+    from caching import stats
+    return jsonify(stats()), 200
+
+@app.route('/api/metrics')
+def metrics_endpoint():
+    from flask import Response
+    return Response(metrics.render(metrics.collect()), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run()
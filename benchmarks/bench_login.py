@@ -0,0 +1,121 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Runs a login storm against a worker with gunicorn's two request threads
+# and measures login throughput and the latency of a non-auth endpoint
+# polled alongside it: once with no logins for a baseline, once with bcrypt
+# inline on the request threads and once on the bounded hashing pool with
+# the app's PASSWORD_HASH_* settings. The last column is the probe's p99
+# against the baseline's; with the pool it should stay close to 1.
+#
+#   python benchmarks/bench_login.py --clients 8 --duration 10
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def configure(db_path):
+    settings = os.path.join(os.path.dirname(db_path), 'settings.py')
+    with open(settings, 'w') as f:
+        f.write('SQLALCHEMY_DATABASE_URI = {!r}\n'.format('sqlite:///' + db_path))
+    os.environ['CLUBREVIEW_SETTINGS'] = settings
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def run(app, users, clients, duration, threads):
+    import passwords
+    passwords._executor = None
+    # Stands in for gunicorn's request threads: every request, login or not,
+    # needs one of these.
+    server = ThreadPoolExecutor(max_workers=threads)
+    stop = time.time() + duration
+    logins, rejected, probes = [], [], []
+    lock = threading.Lock()
+
+    def request(method, path, **kwargs):
+        client = app.test_client()
+        start = time.perf_counter()
+        response = getattr(client, method)(path, **kwargs)
+        return response.status_code, time.perf_counter() - start
+
+    def login_client(i):
+        username = users[i % len(users)]
+        while time.time() < stop:
+            start = time.perf_counter()
+            status, _ = server.submit(request, 'post', '/api/login',
+                                      json={'username': username, 'password': 'password'}).result()
+            with lock:
+                (logins if status == 200 else rejected).append(time.perf_counter() - start)
+            if status == 503:
+                # Clients honour Retry-After, with some jitter.
+                time.sleep(random.uniform(0.5, 1.5))
+
+    def probe_client():
+        while time.time() < stop:
+            start = time.perf_counter()
+            server.submit(request, 'get', '/api/tags/').result()
+            probes.append(time.perf_counter() - start)
+            time.sleep(0.01)
+
+    workers = [threading.Thread(target=login_client, args=(i,)) for i in range(clients)]
+    workers.append(threading.Thread(target=probe_client))
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    server.shutdown()
+    return {
+        'logins/s': len(logins) / duration,
+        'rejected/s': len(rejected) / duration,
+        'login p50 ms': percentile(logins, 50) * 1000,
+        'probe p50 ms': percentile(probes, 50) * 1000,
+        'probe p99 ms': percentile(probes, 99) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--rounds', type=int, default=None, help='bcrypt cost, defaults to the app config')
+    parser.add_argument('--queue', type=int, default=None, help='PASSWORD_HASH_QUEUE, defaults to the app config')
+    parser.add_argument('--wait', type=float, default=None, help='PASSWORD_HASH_WAIT, defaults to the app config')
+    args = parser.parse_args()
+    configure(os.path.join(tempfile.mkdtemp(), 'clubreview.db'))
+    from app import app, db
+    from models import User
+    from passwords import hash_password
+    if args.rounds:
+        app.config['BCRYPT_LOG_ROUNDS'] = args.rounds
+    if args.queue is not None:
+        app.config['PASSWORD_HASH_QUEUE'] = args.queue
+    if args.wait is not None:
+        app.config['PASSWORD_HASH_WAIT'] = args.wait
+    db.create_all()
+    users = ['storm{}'.format(i) for i in range(args.users)]
+    password = hash_password('password')
+    db.session.add_all([User(username=username, email=username + '@seas.upenn.edu', password=password)
+                        for username in users])
+    db.session.commit()
+    workers = app.config['PASSWORD_HASH_WORKERS']
+    baseline = None
+    for label, clients, pool_size in (('no logins', 0, workers), ('inline', args.clients, 0),
+                                      ('pool of {}'.format(workers), args.clients, workers)):
+        app.config['PASSWORD_HASH_WORKERS'] = pool_size
+        result = run(app, users, clients, args.duration, args.threads)
+        if baseline is None:
+            baseline = result['probe p99 ms']
+        result['probe p99 x'] = result['probe p99 ms'] / baseline
+        print('{:<12} '.format(label) + '  '.join('{} {:.1f}'.format(key, value) for key, value in result.items()))
+
+if __name__ == '__main__':
+    main()
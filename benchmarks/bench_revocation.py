@@ -0,0 +1,90 @@
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+# Simulates millions of logouts arriving over several weeks and measures how
+# long authenticating a live token and looking up a revoked one take as the
+# invalid_token table fills up, before and after each purge.
+#
+#   python benchmarks/bench_revocation.py --logouts 2000000
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def configure(db_path):
+    settings = os.path.join(os.path.dirname(db_path), 'settings.py')
+    with open(settings, 'w') as f:
+        f.write('SQLALCHEMY_DATABASE_URI = {!r}\n'.format('sqlite:///' + db_path))
+    os.environ['CLUBREVIEW_SETTINGS'] = settings
+
+def insert_logouts(db, count, days, ago):
+    # Logouts are spread evenly over `days` days ending `ago` days back, and
+    # tokens expire a day after logout at the latest.
+    from sqlalchemy import text
+    now = datetime.datetime.utcnow() - datetime.timedelta(days=ago)
+    step = datetime.timedelta(days=days) / count
+    batch = []
+    with db.engine.begin() as connection:
+        for i in range(count):
+            expires = now - datetime.timedelta(days=days - 1) + step * i
+            batch.append({'jti': uuid.uuid4().hex, 'expires': expires.strftime('%Y-%m-%d %H:%M:%S.%f')})
+            if len(batch) == 50000:
+                connection.execute(text('INSERT INTO invalid_token (jti, expires) VALUES (:jti, :expires)'), batch)
+                batch = []
+        if batch:
+            connection.execute(text('INSERT INTO invalid_token (jti, expires) VALUES (:jti, :expires)'), batch)
+
+def time_per_call(f, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        f()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def measure(label, app, db, token, revoked_jti, iterations):
+    from models import InvalidToken
+    from utils import authenticate
+    with app.test_request_context():
+        rows = InvalidToken.query.count()
+        authenticate(token)
+        auth = time_per_call(lambda: authenticate(token) and db.session.expunge_all(), iterations)
+        lookup = time_per_call(lambda: InvalidToken.query.filter_by(jti=revoked_jti).first(), iterations)
+    print('{:<28} {:>10} rows {:>10.1f} us/auth {:>10.1f} us/lookup'.format(label, rows, auth, lookup))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logouts', type=int, default=1000000)
+    parser.add_argument('--rounds', type=int, default=4)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    configure(os.path.join(directory, 'clubreview.db'))
+    from app import app, db
+    from models import User, InvalidToken
+    from utils import create_token, invalidate_token, purge_expired_tokens
+    db.create_all()
+    db.session.add(User(username='bench', email='bench@seas.upenn.edu', password=b''))
+    db.session.commit()
+    with app.test_request_context():
+        token = create_token('bench')
+        revoked = create_token('bench')
+        invalidate_token(revoked)
+        revoked_jti = InvalidToken.query.order_by(InvalidToken.seq.desc()).first().jti
+    measure('empty', app, db, token, revoked_jti, args.iterations)
+    for round in range(1, args.rounds + 1):
+        insert_logouts(db, args.logouts // args.rounds, args.days, (args.rounds - round) * args.days)
+        measure('{} logouts, unpurged'.format(round * args.logouts // args.rounds),
+                app, db, token, revoked_jti, args.iterations)
+        with app.test_request_context():
+            start = time.perf_counter()
+            purged = purge_expired_tokens(force=True)
+            elapsed = time.perf_counter() - start
+        print('{:<28} {:>10} rows purged in {:.2f}s'.format('', purged, elapsed))
+        measure('{} logouts, purged'.format(round * args.logouts // args.rounds),
+                app, db, token, revoked_jti, args.iterations)
+
+if __name__ == '__main__':
+    main()
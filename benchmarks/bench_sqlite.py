@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Runs a mixed read/write load from several worker processes, each with a
+# couple of request threads like gunicorn's, against one database file: once
+# with SQLite's defaults (rollback journal, a connection per checkout, every
+# thread committing on its own) and once with the WAL pragmas, pooled
+# connections and the write coordinator from database.py. Reads fetch a club
+# and its comments; writes favorite and unfavorite clubs and post comments.
+#
+#   python benchmarks/bench_sqlite.py --workers 2 --threads 2 --duration 10
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULTS = ("SQLITE_PRAGMAS = {}\n"
+            "SQLALCHEMY_ENGINE_OPTIONS = {}\n"
+            "WRITE_COORDINATOR = False\n")
+
+def configure(db_path, defaults):
+    settings = os.path.join(os.path.dirname(db_path), 'settings.py')
+    with open(settings, 'w') as f:
+        f.write('SQLALCHEMY_DATABASE_URI = {!r}\n'.format('sqlite:///' + db_path))
+        # Measure the database, not the response cache.
+        f.write("CACHE_TYPE = 'NullCache'\n")
+        f.write('BCRYPT_LOG_ROUNDS = 4\n')
+        if defaults:
+            f.write(DEFAULTS)
+    return settings
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def seed(users, clubs):
+    from app import db
+    from importer import import_clubs
+    from models import User
+    from passwords import hash_password
+    db.create_all()
+    password = hash_password('password')
+    db.session.add_all([User(username='load{}'.format(i), email='load{}@seas.upenn.edu'.format(i),
+                             password=password) for i in range(users)])
+    db.session.commit()
+    import_clubs([{'code': 'load-{}'.format(i), 'name': 'Load {}'.format(i), 'description': 'Load test',
+                   'tags': ['Load']} for i in range(clubs)])
+
+def worker(index, users, clubs, threads, duration, write_ratio, start):
+    from app import app
+    from utils import create_token
+    with app.app_context():
+        token = create_token('load{}'.format(index))
+    stop = start + duration
+    results = {'reads': [], 'writes': [], 'errors': 0}
+    lock = threading.Lock()
+
+    def run(thread):
+        client = app.test_client()
+        rng = random.Random(index * 1000 + thread)
+        headers = {'auth_token': token}
+        while time.time() < start:
+            time.sleep(0.001)
+        while time.time() < stop:
+            code = 'load-{}'.format(rng.randrange(clubs))
+            began = time.perf_counter()
+            if rng.random() < write_ratio:
+                kind = 'writes'
+                if rng.random() < 0.5:
+                    statuses = [client.post('/api/clubs/{}/comments/'.format(code), json={'content': 'Load'},
+                                            headers=headers).status_code]
+                else:
+                    statuses = [client.post('/api/favorites/', json={'code': code}, headers=headers).status_code,
+                                client.delete('/api/favorites/' + code, headers=headers).status_code]
+            else:
+                kind = 'reads'
+                statuses = [client.get('/api/clubs/{}/'.format(code)).status_code,
+                            client.get('/api/clubs/{}/comments/'.format(code)).status_code]
+            elapsed = time.perf_counter() - began
+            with lock:
+                if all(status < 500 for status in statuses):
+                    results[kind].append(elapsed)
+                else:
+                    results['errors'] += 1
+
+    pool = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    print(json.dumps(results))
+
+def measure(label, defaults, args):
+    folder = tempfile.mkdtemp()
+    env = dict(os.environ, CLUBREVIEW_SETTINGS=configure(os.path.join(folder, 'clubreview.db'), defaults))
+    subprocess.run([sys.executable, __file__, '--seed', '--users', str(args.workers), '--clubs', str(args.clubs)],
+                   env=env, check=True)
+    start = time.time() + 3
+    processes = [subprocess.Popen([sys.executable, __file__, '--worker', str(i), '--users', str(args.workers),
+                                   '--clubs', str(args.clubs), '--threads', str(args.threads),
+                                   '--duration', str(args.duration), '--writes', str(args.writes),
+                                   '--start', str(start)], env=env, stdout=subprocess.PIPE)
+                 for i in range(args.workers)]
+    reads, writes, errors = [], [], 0
+    for process in processes:
+        output, _ = process.communicate()
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        reads += result['reads']
+        writes += result['writes']
+        errors += result['errors']
+    print('{:<9} reads/s {:.1f}  writes/s {:.1f}  errors {}  read p99 ms {:.1f}  write p99 ms {:.1f}'.format(
+        label, len(reads) / args.duration, len(writes) / args.duration, errors,
+        percentile(reads, 99) * 1000, percentile(writes, 99) * 1000))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--clubs', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--writes', type=float, default=0.3, help='fraction of operations that write')
+    parser.add_argument('--seed', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--users', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--start', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.seed:
+        return seed(args.users, args.clubs)
+    if args.worker is not None:
+        return worker(args.worker, args.users, args.clubs, args.threads, args.duration, args.writes, args.start)
+    measure('defaults', True, args)
+    measure('tuned', False, args)
+
+if __name__ == '__main__':
+    main()
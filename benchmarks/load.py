@@ -0,0 +1,363 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+# Drives a weighted mix of requests against every blueprint from several
+# processes with a few threads each, like gunicorn's workers, and reports
+# throughput, p50/p95/p99 latency and SQL statements per request for each
+# operation. Requests go through the Flask test client against the
+# configured database (CLUBREVIEW_SETTINGS), or over HTTP with --url. Seed
+# the data with seed.py at the same scale first. Statements are counted on
+# the request thread, so writes handed to the write coordinator and every
+# statement in --url mode are left out.
+#
+#   python benchmarks/seed.py
+#   python benchmarks/load.py --workload mixed --output before.json
+#   python benchmarks/load.py --workload mixed --compare before.json
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import SCALE, WORDS
+
+class Context:
+    def __init__(self, rng, scale, username, token):
+        self.rng = rng
+        self.scale = scale
+        self.username = username
+        self.headers = {'auth_token': token}
+
+    def club(self):
+        return 'bench-{}'.format(int(self.scale['clubs'] * self.rng.random() ** 2))
+
+    def own_club(self):
+        # Clubs bench-<i> belong to user bench<i % users>.
+        index = int(self.username[len('bench'):])
+        return 'bench-{}'.format(index) if index < self.scale['clubs'] else None
+
+    def tag(self):
+        return 'Bench {}'.format(int(self.scale['tags'] * self.rng.random() ** 2))
+
+    def user(self):
+        return 'bench{}'.format(self.rng.randrange(self.scale['users']))
+
+def list_clubs(client, ctx):
+    return [client('GET', '/api/clubs/', query={'limit': 20, 'cursor': ctx.rng.randrange(ctx.scale['clubs'])})]
+
+def search_clubs(client, ctx):
+    return [client('GET', '/api/clubs/', query={'search': ctx.rng.choice(WORDS), 'limit': 20})]
+
+def filter_clubs(client, ctx):
+    return [client('GET', '/api/clubs/', query={'tags': '{},{}'.format(ctx.tag(), ctx.tag()), 'match': 'any',
+                                                'limit': 20})]
+
+def sorted_clubs(client, ctx):
+    return [client('GET', '/api/clubs/', query={'sort': ctx.rng.choice(['popular', 'trending']), 'limit': 20})]
+
+def get_club(client, ctx):
+    return [client('GET', '/api/clubs/{}/'.format(ctx.club()))]
+
+def club_members(client, ctx):
+    return [client('GET', '/api/clubs/{}/members/'.format(ctx.club()))]
+
+def club_files(client, ctx):
+    # No club has files after seeding, so 404 is the expected answer.
+    return [client('GET', '/api/clubs/{}/files'.format(ctx.club()), query={'limit': 20})]
+
+def club_comments(client, ctx):
+    return [client('GET', '/api/clubs/{}/comments/'.format(ctx.club()))]
+
+def post_comment(client, ctx):
+    return [client('POST', '/api/clubs/{}/comments/'.format(ctx.club()), json={'content': 'Load test'},
+                   headers=ctx.headers)]
+
+def toggle_member(client, ctx):
+    code = ctx.own_club()
+    if code is None:
+        return []
+    username = ctx.user()
+    if username == ctx.username:
+        return []
+    return [client('POST', '/api/clubs/{}/members/'.format(code), json={'username': username}, headers=ctx.headers),
+            client('DELETE', '/api/clubs/{}/members/{}'.format(code, username), headers=ctx.headers)]
+
+def get_favorites(client, ctx):
+    return [client('GET', '/api/favorites/', headers=ctx.headers)]
+
+def toggle_favorite(client, ctx):
+    code = ctx.club()
+    return [client('POST', '/api/favorites/', json={'code': code}, headers=ctx.headers),
+            client('DELETE', '/api/favorites/' + code, headers=ctx.headers)]
+
+def list_tags(client, ctx):
+    return [client('GET', '/api/tags/')]
+
+def tag_facets(client, ctx):
+    return [client('GET', '/api/tags/facets', query={'tags': ctx.tag()})]
+
+def get_user(client, ctx):
+    return [client('GET', '/api/users/' + ctx.user(), headers=ctx.headers)]
+
+def login(client, ctx):
+    return [client('POST', '/api/login', json={'username': ctx.username, 'password': 'password'})]
+
+OPERATIONS = {
+    'list clubs': list_clubs,
+    'search clubs': search_clubs,
+    'filter clubs': filter_clubs,
+    'sorted clubs': sorted_clubs,
+    'get club': get_club,
+    'club members': club_members,
+    'club files': club_files,
+    'club comments': club_comments,
+    'post comment': post_comment,
+    'toggle member': toggle_member,
+    'get favorites': get_favorites,
+    'toggle favorite': toggle_favorite,
+    'list tags': list_tags,
+    'tag facets': tag_facets,
+    'get user': get_user,
+    'login': login,
+}
+
+# Relative weights of each operation.
+WORKLOADS = {
+    'read': {'list clubs': 10, 'search clubs': 10, 'filter clubs': 5, 'sorted clubs': 5, 'get club': 30,
+             'club members': 5, 'club files': 3, 'club comments': 15, 'get favorites': 5, 'list tags': 3,
+             'tag facets': 3, 'get user': 5},
+    'mixed': {'list clubs': 8, 'search clubs': 8, 'filter clubs': 4, 'sorted clubs': 4, 'get club': 25,
+              'club members': 4, 'club files': 2, 'club comments': 12, 'post comment': 10, 'toggle member': 3,
+              'get favorites': 4, 'toggle favorite': 10, 'list tags': 2, 'tag facets': 2, 'get user': 4,
+              'login': 1},
+    'write': {'get club': 10, 'post comment': 40, 'toggle member': 10, 'toggle favorite': 40},
+}
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def test_client():
+    # Requests through the app in this process, counting the statements each
+    # one runs on its thread.
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from app import app
+    counts = threading.local()
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counts.value = getattr(counts, 'value', 0) + 1
+
+    def connect():
+        client = app.test_client()
+
+        def request(method, path, query=None, json=None, headers=None):
+            counts.value = 0
+            began = time.perf_counter()
+            response = client.open(path, method=method, query_string=query, json=json, headers=headers)
+            return response.status_code, time.perf_counter() - began, counts.value, response.get_json(silent=True)
+
+        return request
+    return connect
+
+def http_client(url, timeout):
+    import requests
+
+    def connect():
+        session = requests.Session()
+
+        def request(method, path, query=None, json=None, headers=None):
+            began = time.perf_counter()
+            response = session.request(method, url.rstrip('/') + path, params=query, json=json, headers=headers,
+                                       timeout=timeout, allow_redirects=False)
+            elapsed = time.perf_counter() - began
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+            return response.status_code, elapsed, None, data
+
+        return request
+    return connect
+
+def worker(index, args, start):
+    scale = {name: getattr(args, name) for name in ('clubs', 'users', 'tags')}
+    connect = http_client(args.url, args.timeout) if args.url else test_client()
+    weights = WORKLOADS[args.workload]
+    names = list(weights)
+    samples = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    stop = start + args.duration
+    failures = []
+
+    def log_in(request, username):
+        # Every thread logs in at once, so the hashing pool may turn some
+        # away at first.
+        for _ in range(20):
+            status, _, _, data = request('POST', '/api/login', json={'username': username, 'password': 'password'})
+            if status == 200:
+                return data['auth_token']
+            if status != 503:
+                break
+            time.sleep(random.uniform(0.5, 1.5))
+        raise RuntimeError('Could not log in as {}: {}'.format(username, status))
+
+    def run(thread):
+        try:
+            rng = random.Random(args.seed * 1000003 + index * 1000 + thread)
+            request = connect()
+            username = 'bench{}'.format(rng.randrange(args.users))
+            drive_thread(rng, request, username, log_in(request, username))
+        except Exception as e:
+            failures.append(e)
+            raise
+
+    def drive_thread(rng, request, username, token):
+        ctx = Context(rng, scale, username, token)
+        last = []
+
+        def client(method, path, query=None, json=None, headers=None):
+            status, elapsed, queries, _ = request(method, path, query, json, headers)
+            last.append((status, elapsed, queries))
+            return status
+
+        while time.time() < start:
+            time.sleep(0.001)
+        while time.time() < stop:
+            name = rng.choices(names, [weights[name] for name in names])[0]
+            del last[:]
+            OPERATIONS[name](client, ctx)
+            if not last:
+                continue
+            elapsed = sum(sample[1] for sample in last)
+            queries = None if last[0][2] is None else sum(sample[2] for sample in last) / len(last)
+            with lock:
+                if all(sample[0] < 500 for sample in last):
+                    samples[name].append((elapsed, queries))
+                else:
+                    errors[name] += 1
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        sys.exit(1)
+    print(json.dumps({'samples': samples, 'errors': errors}))
+
+def summarize(samples, errors, duration):
+    latencies = [sample[0] for sample in samples]
+    queries = [sample[1] for sample in samples if sample[1] is not None]
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'throughput': len(samples) / duration,
+        'p50_ms': None if not latencies else percentile(latencies, 50) * 1000,
+        'p95_ms': None if not latencies else percentile(latencies, 95) * 1000,
+        'p99_ms': None if not latencies else percentile(latencies, 99) * 1000,
+        'queries_per_request': sum(queries) / len(queries) if queries else None,
+    }
+
+def drive(args):
+    # Runs the workers in their own processes and merges what they saw.
+    start = time.time() + args.warmup
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+    processes = [subprocess.Popen(command + ['--worker', str(i), '--start', str(start)], stdout=subprocess.PIPE)
+                 for i in range(args.workers)]
+    samples, errors = {}, {}
+    for process in processes:
+        output, _ = process.communicate()
+        if process.returncode:
+            raise SystemExit('A worker failed.')
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        for name, values in result['samples'].items():
+            samples.setdefault(name, []).extend(values)
+            errors[name] = errors.get(name, 0) + result['errors'][name]
+    everything = [sample for values in samples.values() for sample in values]
+    return {
+        'workload': args.workload,
+        'target': args.url or 'test client',
+        'workers': args.workers,
+        'threads': args.threads,
+        'duration': args.duration,
+        'scale': {name: getattr(args, name) for name in ('clubs', 'users', 'tags')},
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'total': summarize(everything, sum(errors.values()), args.duration),
+        'operations': {name: summarize(samples[name], errors[name], args.duration) for name in sorted(samples)},
+    }
+
+def format_ms(value):
+    return '{:8.1f}'.format(value) if value is not None else '       -'
+
+def show(report):
+    print('{:<16} {:>8} {:>7} {:>8} {:>8} {:>8} {:>8}'.format('operation', 'req/s', 'errors', 'p50 ms', 'p95 ms',
+                                                            'p99 ms', 'queries'))
+    for name, result in list(report['operations'].items()) + [('total', report['total'])]:
+        queries = result['queries_per_request']
+        print('{:<16} {:8.1f} {:7} {} {} {} {:>8}'.format(name, result['throughput'], result['errors'],
+                                                       format_ms(result['p50_ms']), format_ms(result['p95_ms']),
+                                                       format_ms(result['p99_ms']),
+                                                       '-' if queries is None else '{:.1f}'.format(queries)))
+
+def compare(report, baseline, threshold):
+    # Lists the operations whose throughput fell or whose p99 or statement
+    # count rose by more than threshold (a fraction) against the baseline.
+    regressions = []
+    for name, result in list(report['operations'].items()) + [('total', report['total'])]:
+        before = baseline['total'] if name == 'total' else baseline['operations'].get(name)
+        if before is None:
+            continue
+        checks = (('throughput', -1), ('p99_ms', 1), ('queries_per_request', 1))
+        for key, direction in checks:
+            old, new = before.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if change * direction > threshold:
+                regressions.append('{} {}: {:.1f} -> {:.1f} ({:+.0%})'.format(name, key, old, new, change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workload', choices=sorted(WORKLOADS), default='mixed')
+    parser.add_argument('--workers', type=int, default=2, help='processes')
+    parser.add_argument('--threads', type=int, default=2, help='request threads per process')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=3, help='seconds to let the workers start')
+    parser.add_argument('--url', help='base URL of a running server, instead of the test client')
+    parser.add_argument('--timeout', type=float, default=30)
+    for name in ('clubs', 'users', 'tags'):
+        parser.add_argument('--' + name, type=int, default=SCALE[name], help='as seeded')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', help='save the report as JSON')
+    parser.add_argument('--compare', help='JSON report to check for regressions against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed change against --compare')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--start', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker is not None:
+        return worker(args.worker, args, args.start)
+    report = drive(args)
+    show(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for regression in regressions:
+            print('regression: ' + regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
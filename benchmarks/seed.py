@@ -0,0 +1,121 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+# Fills the configured database (CLUBREVIEW_SETTINGS) with synthetic data for
+# load tests: clubs bench-<i> owned by users bench<i % users>, who all have
+# the password 'password', tags 'Bench <i>', and memberships, favorites and
+# comments skewed towards the low-numbered clubs the way real popularity is.
+# Rows go in with executemany over the raw connection, a transaction per
+# batch, so the triggers keep every counter and score in step. Seed an
+# empty database; load.py assumes the same scale.
+#
+#   python benchmarks/seed.py --clubs 100000 --users 1000000 --memberships 10000000 \
+#       --favorites 10000000 --comments 10000000
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCALE = {'clubs': 1000, 'users': 5000, 'tags': 50, 'memberships': 20000, 'favorites': 20000, 'comments': 20000}
+
+WORDS = ('club', 'society', 'penn', 'music', 'debate', 'robotics', 'dance', 'finance', 'film', 'chess',
+         'service', 'theatre', 'coding', 'hiking', 'cooking', 'writing', 'jazz', 'startup', 'poetry', 'art')
+
+def skewed(rng, n):
+    # Mostly low indexes: the top 10% of clubs get about a third of the picks.
+    return int(n * rng.random() ** 2)
+
+def text_of(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+def insert(connection, label, statement, rows, batch_size):
+    start, count, batch = time.perf_counter(), 0, []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            count += flush(connection, statement, batch)
+            batch = []
+    count += flush(connection, statement, batch)
+    seconds = time.perf_counter() - start
+    print('{:<12} {:>10} rows in {:7.1f}s ({:.0f} rows/s)'.format(label, count, seconds,
+                                                                 count / seconds if seconds else 0))
+    return count
+
+def flush(connection, statement, batch):
+    if not batch:
+        return 0
+    cursor = connection.cursor()
+    cursor.executemany(statement, batch)
+    connection.commit()
+    return len(batch)
+
+def seed(scale, batch_size=10000, seed=0):
+    from app import db
+    from caching import invalidate
+    from models import Club
+    from passwords import hash_password
+    from search import rebuild_index
+    db.create_all()
+    if Club.query.filter_by(code='bench-0').first():
+        raise SystemExit('This database is already seeded.')
+    rng = random.Random(seed)
+    clubs, users, tags = scale['clubs'], scale['users'], scale['tags']
+    base = {table: db.session.execute(db.text('SELECT coalesce(max(id), 0) FROM "{}"'.format(table))).scalar()
+            for table in ('club', 'user', 'tag')}
+    db.session.commit()
+    password = hash_password('password')
+    connection = db.engine.raw_connection()
+    try:
+        insert(connection, 'users', 'INSERT INTO user (id, username, email, password) VALUES (?, ?, ?, ?)',
+               ((base['user'] + i + 1, 'bench{}'.format(i), 'bench{}@seas.upenn.edu'.format(i), password)
+                for i in range(users)), batch_size)
+        insert(connection, 'tags', 'INSERT INTO tag (id, name) VALUES (?, ?)',
+               ((base['tag'] + i + 1, 'Bench {}'.format(i)) for i in range(tags)), batch_size)
+        insert(connection, 'clubs', 'INSERT INTO club (id, code, name, description, owner) VALUES (?, ?, ?, ?, ?)',
+               ((base['club'] + i + 1, 'bench-{}'.format(i), 'Bench {} {}'.format(text_of(rng, 2).title(), i),
+                 text_of(rng, 30), 'bench{}'.format(i % users)) for i in range(clubs)), batch_size)
+        insert(connection, 'tag links', 'INSERT OR IGNORE INTO tag_to_club (club_id, tag_id) VALUES (?, ?)',
+               ((base['club'] + i + 1, base['tag'] + skewed(rng, tags) + 1)
+                for i in range(clubs) for _ in range(rng.randint(1, 3))), batch_size)
+        owners = ((base['user'] + i % users + 1, base['club'] + i + 1) for i in range(clubs))
+        members = ((base['user'] + rng.randrange(users) + 1, base['club'] + skewed(rng, clubs) + 1)
+                   for _ in range(scale['memberships']))
+        insert(connection, 'memberships', 'INSERT OR IGNORE INTO user_to_club (user_id, club_id) VALUES (?, ?)',
+               (row for rows in (owners, members) for row in rows), batch_size)
+        insert(connection, 'favorites', 'INSERT OR IGNORE INTO favorites (user_id, club_id) VALUES (?, ?)',
+               ((base['user'] + rng.randrange(users) + 1, base['club'] + skewed(rng, clubs) + 1)
+                for _ in range(scale['favorites'])), batch_size)
+        comment_base = db.session.execute(db.text('SELECT coalesce(max(id), 0) FROM comment')).scalar()
+        db.session.commit()
+        last = {}
+
+        def comments():
+            # About a third reply to the club's previous comment.
+            for i in range(scale['comments']):
+                club_id = base['club'] + skewed(rng, clubs) + 1
+                parent = last.get(club_id) if rng.random() < 0.3 else None
+                last[club_id] = comment_base + i + 1
+                yield (comment_base + i + 1, text_of(rng, 12), base['user'] + rng.randrange(users) + 1,
+                       club_id, parent)
+
+        insert(connection, 'comments', 'INSERT INTO comment (id, content, user_id, club_id, parent_id) '
+               'VALUES (?, ?, ?, ?, ?)', comments(), batch_size)
+    finally:
+        connection.close()
+    start = time.perf_counter()
+    rebuild_index()
+    print('{:<12} rebuilt in {:.1f}s'.format('search', time.perf_counter() - start))
+    invalidate('clubs', 'tags', 'users')
+
+def main():
+    parser = argparse.ArgumentParser()
+    for name, default in SCALE.items():
+        parser.add_argument('--' + name, type=int, default=default)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    seed({name: getattr(args, name) for name in SCALE}, args.batch_size, args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+import gzip
+import hashlib
+import pickle
+import threading
+from collections import OrderedDict
+from functools import wraps
+from time import time
+
+from flask_caching.backends.base import BaseCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response caching for the views. Entries are keyed on the path, the query
+# string, the user (for per-user views) and the current version of every tag
+# the view depends on, so invalidating a tag just gives it a new version and
+# leaves the old entries to age out of the backend. A tag's version is its
+# seq in the cache_tag table, the same in every worker and across restarts.
+# The backend is whatever CACHE_TYPE names: LRUCache below for a single
+# process, or a shared one such as flask_caching.backends.FileSystemCache for
+# all gunicorn workers.
+#
+# The key doubles as a weak ETag, so a client polling with If-None-Match gets
+# a 304 without the entry even being read while none of the tags has changed,
+# whichever worker it reaches. Bodies of COMPRESS_MIN_SIZE bytes or more are
+# sent br (with the brotli package) or gzip encoded when the client accepts
+# it, and each encoding is cached next to the entry so it is compressed once.
+
+class LRUCache(BaseCache):
+    # Values are pickled so callers can't change what is cached, unless
+    # pickled is False (for immutable values; max_bytes then counts len()).
+    def __init__(self, threshold=500, max_bytes=None, default_timeout=300, pickled=True):
+        BaseCache.__init__(self, default_timeout)
+        self._cache = OrderedDict()
+        self._threshold = threshold
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pickled = pickled
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(threshold=config['CACHE_THRESHOLD'], max_bytes=config.get('CACHE_MAX_BYTES'))
+        return cls(*args, **kwargs)
+
+    def _normalize_timeout(self, timeout):
+        timeout = BaseCache._normalize_timeout(self, timeout)
+        if timeout > 0:
+            timeout = time() + timeout
+        return timeout
+
+    def _pop(self, key):
+        item = self._cache.pop(key, None)
+        if item is not None:
+            self._bytes -= len(item[1])
+        return item
+
+    def get(self, key):
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires != 0 and expires <= time():
+                self._pop(key)
+                return None
+            self._cache.move_to_end(key)
+        return pickle.loads(value) if self._pickled else value
+
+    def set(self, key, value, timeout=None):
+        if self._pickled:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self._normalize_timeout(timeout)
+        with self._lock:
+            self._pop(key)
+            self._cache[key] = (expires, value)
+            self._bytes += len(value)
+            while self._cache and (len(self._cache) > self._threshold or
+                                   (self._max_bytes and self._bytes > self._max_bytes)):
+                self._pop(next(iter(self._cache)))
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._pop(key) is not None
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+        return True
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+def record(view, hit):
+    from metrics import add
+    add('cache_hits' if hit else 'cache_misses')
+    with _stats_lock:
+        counts = _stats.setdefault(view, {'hits': 0, 'misses': 0})
+        counts['hits' if hit else 'misses'] += 1
+
+def stats():
+    with _stats_lock:
+        views = {view: dict(counts) for view, counts in _stats.items()}
+    hits = sum(counts['hits'] for counts in views.values())
+    misses = sum(counts['misses'] for counts in views.values())
+    return {'hits': hits, 'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0, 'views': views}
+
+def tag_versions(tags):
+    from sqlalchemy import bindparam, text
+    from app import db, cache
+    keys = ['tag:' + tag for tag in tags]
+    versions = dict(zip(keys, cache.get_many(*keys)))
+    # Versions not cached here yet (or evicted) are read from cache_tag; a
+    # tag that was never invalidated is at 0.
+    missing = [key[len('tag:'):] for key, version in versions.items() if version is None]
+    if missing:
+        rows = db.session.execute(text('SELECT name, seq FROM cache_tag WHERE name IN :names')
+                                  .bindparams(bindparam('names', expanding=True)), {'names': missing})
+        seqs = dict.fromkeys(missing, 0)
+        seqs.update(rows.fetchall())
+        versions.update(('tag:' + tag, seq) for tag, seq in advance(seqs).items())
+    return [versions[key] for key in keys]
+
+_advance_lock = threading.Lock()
+
+def advance(seqs):
+    # Moves tags to the given seqs, never back: a thread holding an older
+    # reading must not undo a newer one. Returns the resulting versions.
+    from app import cache
+    keys = ['tag:' + tag for tag in seqs]
+    with _advance_lock:
+        current = dict(zip(seqs, cache.get_many(*keys)))
+        newer = {tag: seq for tag, seq in seqs.items() if current[tag] is None or seq > current[tag]}
+        if newer:
+            cache.set_many({'tag:' + tag: seq for tag, seq in newer.items()}, timeout=0)
+    current.update(newer)
+    return current
+
+def invalidate(*tags):
+    if tags:
+        advance(publish(tags))
+
+# Invalidations are written to the cache_tag table, which stamps each tag
+# with the next seq. Each gunicorn worker has its own LRUCache, so with
+# CACHE_SYNC on every worker reads, once per request, the rows stamped after
+# the last seq it saw and moves those tags on locally.
+
+_seen_lock = threading.Lock()
+_seen_seq = None
+
+def publish(tags):
+    # The new seq of each tag.
+    from sqlalchemy import bindparam, text
+    from database import write
+    upsert = text('INSERT INTO cache_tag (name, seq) VALUES '
+                  '(:name, (SELECT coalesce(max(seq), 0) + 1 FROM cache_tag)) '
+                  'ON CONFLICT (name) DO UPDATE SET seq = excluded.seq')
+    select = text('SELECT name, seq FROM cache_tag WHERE name IN :names') \
+        .bindparams(bindparam('names', expanding=True))
+
+    def job(connection):
+        connection.execute(upsert, [{'name': tag} for tag in tags])
+        return dict(connection.execute(select, {'names': list(tags)}).fetchall())
+
+    return write(job)
+
+def sync():
+    global _seen_seq
+    from sqlalchemy import text
+    from app import db
+    with _seen_lock:
+        seen = _seen_seq
+    if seen is None:
+        # Nothing cached yet in this worker, so only the stamp matters.
+        seq = db.session.execute(text('SELECT coalesce(max(seq), 0) FROM cache_tag')).scalar()
+        changed = {}
+    else:
+        rows = db.session.execute(text('SELECT name, seq FROM cache_tag WHERE seq > :seen'),
+                                  {'seen': seen}).fetchall()
+        changed = dict(rows)
+        seq = max([seen] + list(changed.values()))
+    if changed:
+        advance(changed)
+    with _seen_lock:
+        if _seen_seq is None or seq > _seen_seq:
+            _seen_seq = seq
+
+def cache_key(tags, user=None):
+    from flask import request
+    parts = [request.method, request.path, repr(sorted(request.args.items(multi=True))),
+             str(user.id if user is not None else '')]
+    parts.extend(str(version) for version in tag_versions(tags))
+    return 'view:' + hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+def encodings():
+    from app import app
+    return [encoding for encoding in app.config.get('COMPRESS_ENCODINGS') if encoding != 'br' or brotli is not None]
+
+def compress(body, encoding):
+    from app import app
+    if encoding == 'br':
+        return brotli.compress(body, quality=app.config.get('COMPRESS_BROTLI_QUALITY'))
+    return gzip.compress(body, compresslevel=app.config.get('COMPRESS_GZIP_LEVEL'))
+
+def finish(response, key, timeout):
+    # Adds the ETag and, when it pays off, the client's preferred encoding.
+    from flask import request
+    from app import app, cache
+    response.set_etag(key[len('view:'):], weak=True)
+    response.cache_control.no_cache = True
+    body = response.get_data()
+    if len(body) < app.config.get('COMPRESS_MIN_SIZE'):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(encodings())
+    if encoding is None:
+        return response
+    compressed = cache.get(key + ':' + encoding)
+    if compressed is None:
+        compressed = compress(body, encoding)
+        cache.set(key + ':' + encoding, compressed, timeout=timeout)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def cached(tags, timeout=None, per_user=False):
+    # tags is called with the view's arguments and returns the tags whose
+    # invalidation should drop this response. With per_user the view must sit
+    # below token_required, and its first argument (the user) is keyed on.
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            from flask import Response, request
+            from app import app, cache
+            key = cache_key(tags(*args, **kwargs), args[0] if per_user else None)
+            etag = key[len('view:'):]
+            if request.if_none_match.contains_weak(etag):
+                record(f.__name__, True)
+                response = Response(status=304)
+                response.set_etag(etag, weak=True)
+                response.cache_control.no_cache = True
+                return response
+            entry = cache.get(key)
+            if entry is not None:
+                record(f.__name__, True)
+                body, status, headers = entry
+                return finish(Response(body, status, headers), key, timeout)
+            record(f.__name__, False)
+            response = app.make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                cache.set(key, (response.get_data(), response.status_code,
+                                list(response.headers.items())), timeout=timeout)
+                response = finish(response, key, timeout)
+            return response
+        return decorated
+    return decorator
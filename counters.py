@@ -0,0 +1,53 @@
+from sqlalchemy import text
+from app import db
+
+# Recomputes the stored counters from the association tables, for databases
+# that predate them or were changed with the triggers dropped.
+#
+#   python counters.py
+
+def repair_counters():
+    from models import COUNTERS
+    repaired = 0
+    for table, target, counter, key in COUNTERS:
+        result = db.session.execute(text(
+            'UPDATE {1} SET {2} = (SELECT count(*) FROM {0} WHERE {0}.{3} = {1}.id) '
+            'WHERE {2} != (SELECT count(*) FROM {0} WHERE {0}.{3} = {1}.id)'
+            .format(table.name, target, counter, key)))
+        repaired += max(result.rowcount, 0)
+    db.session.commit()
+    return repaired
+
+def repair_trending():
+    # Recomputes club.trending from the latest add of every live favorite
+    # and membership still in club_event, for scores that have drifted
+    # through rounding.
+    import math
+    from models import TRENDING_EPOCH, TRENDING_HALF_LIFE
+    terms = {}
+    for club_id, time in db.session.execute(text(
+            "SELECT club_event.club_id, max(club_event.time) FROM club_event "
+            "LEFT JOIN favorites ON club_event.kind = 'favorite' AND favorites.club_id = club_event.club_id "
+            "AND favorites.user_id = club_event.user_id "
+            "LEFT JOIN user_to_club ON club_event.kind = 'member' AND user_to_club.club_id = club_event.club_id "
+            "AND user_to_club.user_id = club_event.user_id "
+            "WHERE club_event.added AND coalesce(favorites.club_id, user_to_club.club_id) IS NOT NULL "
+            "GROUP BY club_event.club_id, club_event.user_id, club_event.kind")):
+        terms.setdefault(club_id, []).append((time - TRENDING_EPOCH) / TRENDING_HALF_LIFE)
+    repaired = 0
+    for club_id, trending in db.session.execute(text('SELECT id, trending FROM club')).fetchall():
+        xs = terms.get(club_id)
+        score = float('-inf')
+        if xs:
+            top = max(xs)
+            score = top + math.log2(sum(2 ** (x - top) for x in xs))
+        if score != trending and not abs(score - trending) < 1e-9:
+            db.session.execute(text('UPDATE club SET trending = :score WHERE id = :id'),
+                               {'score': score, 'id': club_id})
+            repaired += 1
+    db.session.commit()
+    return repaired
+
+if __name__ == '__main__':
+    print('{} counters repaired'.format(repair_counters()))
+    print('{} trending scores repaired'.format(repair_trending()))
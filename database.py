@@ -0,0 +1,110 @@
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# SQLite setup. Every new connection gets the SQLITE_PRAGMAS from the config
+# (WAL journaling, so readers never wait on the writer, plus sync, cache and
+# mmap settings), and short hot-path writes go through write(), which hands
+# them to one writer thread per process. That thread runs whatever has
+# queued up as a single BEGIN IMMEDIATE transaction with a savepoint per
+# write, so the worker's request threads never fight each other for the
+# database lock and a burst of writes costs one commit.
+
+@event.listens_for(Engine, 'connect')
+def set_pragmas(dbapi_connection, connection_record):
+    from app import app
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config.get('SQLITE_PRAGMAS').items():
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+class WriteCoordinator:
+    def __init__(self, engine, batch_size, batch_wait):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._connection = None
+
+    def submit(self, job):
+        # Runs job(connection) in the next group commit and returns its
+        # result once that has committed. If the job raises, only its own
+        # changes are rolled back and the exception is raised here.
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-coordinator', daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((job, future))
+        return future.result()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _connect(self):
+        connection = self.engine.connect()
+        # Manage transactions ourselves rather than through pysqlite, so
+        # savepoints work and the write lock is taken up front.
+        connection.connection.dbapi_connection.isolation_level = None
+        event.listen(connection, 'begin', lambda conn: conn.exec_driver_sql('BEGIN IMMEDIATE'))
+        return connection
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            results = []
+            try:
+                if self._connection is None:
+                    self._connection = self._connect()
+                with self._connection.begin():
+                    for job, future in batch:
+                        try:
+                            with self._connection.begin_nested():
+                                results.append((future, job(self._connection), None))
+                        except Exception as e:
+                            results.append((future, None, e))
+            except Exception as e:
+                if self._connection is not None:
+                    self._connection.invalidate()
+                    self._connection.close()
+                    self._connection = None
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for future, result, exception in results:
+                if exception is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(exception)
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+
+def write(job):
+    # Runs job(connection) in a write transaction and returns its result.
+    global _coordinator
+    from app import app, db
+    if not app.config.get('WRITE_COORDINATOR'):
+        with db.engine.begin() as connection:
+            return job(connection)
+    with _coordinator_lock:
+        if _coordinator is None:
+            _coordinator = WriteCoordinator(db.engine, app.config.get('WRITE_BATCH_SIZE'),
+                                            app.config.get('WRITE_BATCH_WAIT'))
+    return _coordinator.submit(job)
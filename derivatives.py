@@ -0,0 +1,196 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from app import app
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Resized copies of uploaded images, for ?size= on file downloads. Uploads
+# queue their derivatives on a small pool (IMAGE_WORKERS threads, at most
+# IMAGE_QUEUE waiting; past that they're skipped and made on first request
+# instead). Derivatives are keyed by the blob's digest, so a replaced image
+# never serves a stale one, and live in DERIVATIVE_FOLDER, trimmed least
+# recently used first once it grows past DERIVATIVE_MAX_BYTES. Without
+# Pillow, or for an upload Pillow can't decode, the original is served for
+# every size; decode failures are remembered (for the last UNDECODABLE_MAX
+# digest and size pairs) so they aren't retried on every request.
+
+FORMATS = {'image/jpeg': ('JPEG', 'jpg', 'image/jpeg'), 'image/png': ('PNG', 'png', 'image/png'),
+           'image/gif': ('PNG', 'png', 'image/png')}
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+_pending = {}
+_cache_bytes = None
+_undecodable = OrderedDict()
+
+UNDECODABLE_MAX = 10000
+
+class Undecodable(Exception):
+    pass
+
+def is_image(file):
+    return Image is not None and file.mime in FORMATS
+
+def derivative_path(digest, size, mime):
+    extension = FORMATS[mime][1]
+    return os.path.join(app.config.get('DERIVATIVE_FOLDER'), digest[:2], '{}-{}.{}'.format(digest, size, extension))
+
+def derivative_mime(mime):
+    return FORMATS[mime][2]
+
+def render(source, target, mime, dimension):
+    image_format = FORMATS[mime][0]
+    try:
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((dimension, dimension))
+            if image_format == 'JPEG':
+                image = image.convert('RGB')
+            else:
+                image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    except FileNotFoundError:
+        raise
+    except (OSError, Image.DecompressionBombError) as e:
+        # UnidentifiedImageError is an OSError too.
+        raise Undecodable(str(e)) from e
+    if image_format == 'JPEG':
+        options = {'quality': app.config.get('DERIVATIVE_JPEG_QUALITY'), 'optimize': True, 'progressive': True}
+    else:
+        options = {'optimize': True}
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(target))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, image_format, **options)
+        os.replace(temp, target)
+    except BaseException:
+        os.remove(temp)
+        raise
+    added(os.path.getsize(target))
+
+def added(size):
+    global _cache_bytes
+    with _lock:
+        if _cache_bytes is not None:
+            _cache_bytes += size
+        over = _cache_bytes is None or _cache_bytes > app.config.get('DERIVATIVE_MAX_BYTES')
+    if over:
+        trim()
+
+def trim():
+    # Removes the least recently used derivatives (reads touch the mtime)
+    # until the folder is under three quarters of the cap.
+    global _cache_bytes
+    entries = []
+    for folder, _, names in os.walk(app.config.get('DERIVATIVE_FOLDER')):
+        for name in names:
+            path = os.path.join(folder, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    if total > app.config.get('DERIVATIVE_MAX_BYTES'):
+        target = app.config.get('DERIVATIVE_MAX_BYTES') * 3 // 4
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+    with _lock:
+        _cache_bytes = total
+
+def _make(path, digest, size, mime):
+    # Renders the derivative unless it exists, sharing one render between
+    # the pool and any requests that want it at the same time.
+    key = (digest, size)
+    with _lock:
+        future = _pending.get(key)
+        owner = future is None
+        if owner:
+            future = _pending[key] = Future()
+    if not owner:
+        return future.result()
+    try:
+        if not os.path.exists(path):
+            from storage import blob_path
+            render(blob_path(digest), path, mime, app.config.get('IMAGE_SIZES')[size])
+        future.set_result(path)
+    except Undecodable as e:
+        with _lock:
+            _undecodable[key] = True
+            while len(_undecodable) > UNDECODABLE_MAX:
+                _undecodable.popitem(last=False)
+        future.set_exception(e)
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            del _pending[key]
+    return path
+
+def get(file, size):
+    # Path of the file's derivative of that size, made now if need be.
+    # Raises Undecodable if Pillow can't read the file.
+    with _lock:
+        if (file.digest, size) in _undecodable:
+            raise Undecodable(file.digest)
+    path = derivative_path(file.digest, size, file.mime)
+    try:
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+    return _make(path, file.digest, size, file.mime)
+
+def send(file, size):
+    # Download response for the file's derivative of that size. trim() may
+    # remove it between get() and the open, so it is made once more, and the
+    # original is sent if it is gone again or can't be decoded.
+    from flask import send_file
+    import storage
+    for _ in range(2):
+        try:
+            return send_file(os.path.abspath(get(file, size)), conditional=True, mimetype=derivative_mime(file.mime),
+                             etag='{}-{}'.format(file.digest, size), last_modified=file.mtime)
+        except FileNotFoundError:
+            pass
+        except Undecodable:
+            break
+    return storage.send(file)
+
+def schedule(file):
+    # Queues every size of an uploaded image on the pool.
+    global _executor, _slots
+    if not is_image(file):
+        return
+    workers = app.config.get('IMAGE_WORKERS')
+    if not workers:
+        return
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='derivatives')
+            _slots = threading.BoundedSemaphore(workers + app.config.get('IMAGE_QUEUE'))
+    for size in app.config.get('IMAGE_SIZES'):
+        if not _slots.acquire(blocking=False):
+            return
+        path = derivative_path(file.digest, size, file.mime)
+        try:
+            future = _executor.submit(_make, path, file.digest, size, file.mime)
+        except BaseException:
+            _slots.release()
+            raise
+        future.add_done_callback(lambda _: _slots.release())
@@ -0,0 +1,155 @@
+import json
+import time
+from sqlalchemy import bindparam, text
+from app import db
+
+# Bulk catalog import. Reads a JSON array of clubs ({"code", "name",
+# "description", "tags"}) incrementally and writes it in large batches, one
+# transaction each: all tags of a batch are resolved in one pass, clubs are
+# inserted or updated only where they differ from what's stored, and each
+# club's tag links are made to match its entry. Re-running an import writes
+# nothing.
+#
+#   python importer.py clubs.json --owner josh
+
+def iter_json_array(f, chunk_size=1 << 16):
+    decoder = json.JSONDecoder()
+    buffer, position, eof = '', 0, False
+    def more():
+        nonlocal buffer, position, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer, position = buffer[position:] + chunk, 0
+        return not eof
+    def skip(characters):
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in characters:
+                position += 1
+            if position < len(buffer) or not more():
+                return
+    skip(' \t\r\n')
+    if buffer[position:position + 1] != '[':
+        raise ValueError('Expected a JSON array of clubs.')
+    position += 1
+    while True:
+        skip(' \t\r\n,')
+        if position >= len(buffer):
+            raise ValueError('Unterminated JSON array.')
+        if buffer[position] == ']':
+            return
+        try:
+            entry, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if not more():
+                raise
+            continue
+        if end == len(buffer) and not eof:
+            # A value ending exactly at the chunk boundary may be cut short.
+            more()
+            continue
+        position = end
+        yield entry
+
+def batches(entries, size):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def import_batch(entries, owner, owner_id, stats):
+    from models import Club
+    from search import reindex_clubs
+    entries = list({entry['code']: entry for entry in entries}.values())
+    codes = [entry['code'] for entry in entries]
+    tag_names = {name for entry in entries for name in entry.get('tags', [])}
+    if tag_names:
+        inserted = db.session.execute(text('INSERT OR IGNORE INTO tag (name) VALUES (:name)'),
+                                      [{'name': name} for name in tag_names])
+        stats['tags'] += max(inserted.rowcount, 0)
+    tag_ids = dict(db.session.execute(text('SELECT name, id FROM tag WHERE name IN :names')
+                                      .bindparams(bindparam('names', expanding=True)),
+                                      {'names': list(tag_names)}).fetchall()) if tag_names else {}
+    existing = {row.code: row for row in db.session.query(Club.code, Club.name, Club.description)
+                .filter(Club.code.in_(codes))}
+    new = [entry for entry in entries if entry['code'] not in existing]
+    changed = [entry for entry in entries if entry['code'] in existing and
+               (existing[entry['code']].name, existing[entry['code']].description) !=
+               (entry['name'], entry.get('description'))]
+    if new:
+        inserted = db.session.execute(text('INSERT OR IGNORE INTO club (code, name, description, owner) '
+                                           'VALUES (:code, :name, :description, :owner)'),
+                                      [{'code': entry['code'], 'name': entry['name'],
+                                        'description': entry.get('description'), 'owner': owner}
+                                       for entry in new])
+        stats['inserted'] += max(inserted.rowcount, 0)
+    if changed:
+        db.session.execute(text('UPDATE club SET name = :name, description = :description WHERE code = :code'),
+                           [{'code': entry['code'], 'name': entry['name'],
+                             'description': entry.get('description')} for entry in changed])
+        stats['updated'] += len(changed)
+    club_ids = dict(db.session.query(Club.code, Club.id).filter(Club.code.in_(codes)))
+    wanted = {(club_ids[entry['code']], tag_ids[name]) for entry in entries if entry['code'] in club_ids
+              for name in entry.get('tags', [])}
+    links = set(db.session.execute(text('SELECT club_id, tag_id FROM tag_to_club WHERE club_id IN :ids')
+                                   .bindparams(bindparam('ids', expanding=True)),
+                                   {'ids': list(club_ids.values())}).fetchall())
+    added, removed = wanted - links, links - wanted
+    if added:
+        db.session.execute(text('INSERT INTO tag_to_club (club_id, tag_id) VALUES (:club_id, :tag_id)'),
+                           [{'club_id': club_id, 'tag_id': tag_id} for club_id, tag_id in added])
+    if removed:
+        db.session.execute(text('DELETE FROM tag_to_club WHERE club_id = :club_id AND tag_id = :tag_id'),
+                           [{'club_id': club_id, 'tag_id': tag_id} for club_id, tag_id in removed])
+    stats['links'] += len(added) + len(removed)
+    if owner_id is not None and new:
+        inserted = db.session.execute(text('INSERT OR IGNORE INTO user_to_club (user_id, club_id) '
+                                           'VALUES (:user_id, :club_id)'),
+                                      [{'user_id': owner_id, 'club_id': club_ids[entry['code']]}
+                                       for entry in new if entry['code'] in club_ids])
+        stats['members'] += max(inserted.rowcount, 0)
+    touched = {club_ids[entry['code']] for entry in new + changed if entry['code'] in club_ids}
+    touched |= {club_id for club_id, _ in added | removed}
+    if touched:
+        reindex_clubs(touched)
+    stats['codes'].extend(code for code, club_id in club_ids.items() if club_id in touched)
+    db.session.commit()
+
+def import_clubs(entries, owner=None, batch_size=1000):
+    from models import User
+    from caching import invalidate
+    owner_id = None
+    if owner is not None:
+        owner_id = db.session.query(User.id).filter_by(username=owner).scalar()
+    stats = {'entries': 0, 'inserted': 0, 'updated': 0, 'tags': 0, 'links': 0,
+             'members': 0, 'codes': []}
+    start = time.perf_counter()
+    for batch in batches(entries, batch_size):
+        stats['entries'] += len(batch)
+        import_batch(batch, owner, owner_id, stats)
+    codes = stats.pop('codes')
+    if codes:
+        invalidate('clubs', 'tags', *['club:' + code for code in codes])
+    stats['seconds'] = time.perf_counter() - start
+    rows = stats['inserted'] + stats['updated'] + stats['tags'] + stats['links'] + stats['members']
+    stats['rows_per_second'] = rows / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+def import_file(path, owner=None, batch_size=1000):
+    with open(path, 'r') as f:
+        return import_clubs(iter_json_array(f), owner, batch_size)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--owner')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    stats = import_file(args.path, args.owner, args.batch_size)
+    print('{entries} clubs read: {inserted} new, {updated} updated, {tags} new tags, {links} tag links '
+          'changed, {members} memberships in {seconds:.2f}s ({rows_per_second:.0f} rows/s)'.format(**stats))
@@ -0,0 +1,273 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Per-route request metrics: count by status, a latency histogram, SQL
+# statements and their time, response cache hits and misses, response bytes
+# and the time spent in bcrypt, JWT decoding and JSON encoding. Each worker
+# keeps its own in memory and writes them to METRICS_FOLDER/<pid>.json at
+# most every METRICS_FLUSH_INTERVAL seconds; /api/metrics adds up the files
+# of every live worker and renders them for Prometheus. Only work on the
+# request's thread is counted, so writes run by the write coordinator show
+# up as the wait for them, not as SQL.
+#
+# With PROFILE on, a sampler thread records the stacks of in-flight requests
+# every PROFILE_INTERVAL seconds, and those of requests slower than
+# PROFILE_SLOW_SECONDS are appended to PROFILE_FOLDER/<pid>.folded, one
+# "route;frame;...;frame count" line per stack, for flamegraph.pl or
+# speedscope.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PHASES = ('bcrypt', 'jwt', 'json')
+
+_lock = threading.Lock()
+_requests = Counter()
+_routes = {}
+_last_flush = 0
+_current = threading.local()
+_sampler = None
+_sampled = {}
+
+def empty_route():
+    return {'buckets': [0] * (len(BUCKETS) + 1), 'count': 0, 'seconds': 0.0, 'statements': 0,
+            'sql_seconds': 0.0, 'cache_hits': 0, 'cache_misses': 0, 'response_bytes': 0,
+            'phases': {phase: 0.0 for phase in PHASES}}
+
+def start():
+    from app import app
+    _current.request = {'start': time.perf_counter(), 'statements': 0, 'sql_seconds': 0.0,
+                        'cache_hits': 0, 'cache_misses': 0, 'phases': dict.fromkeys(PHASES, 0.0)}
+    if app.config.get('PROFILE'):
+        start_sampler(app.config.get('PROFILE_INTERVAL'))
+        with _lock:
+            _sampled[threading.get_ident()] = []
+
+def add(name, amount=1):
+    current = getattr(_current, 'request', None)
+    if current is not None:
+        current[name] += amount
+
+@contextmanager
+def timed(phase):
+    current = getattr(_current, 'request', None)
+    if current is None:
+        yield
+        return
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        current['phases'][phase] += time.perf_counter() - began
+
+def finish(route, method, status, size):
+    from app import app
+    current = getattr(_current, 'request', None)
+    if current is None:
+        return
+    elapsed = time.perf_counter() - current['start']
+    bucket = next((i for i, bound in enumerate(BUCKETS) if elapsed <= bound), len(BUCKETS))
+    with _lock:
+        _requests[route, method, status] += 1
+        stats = _routes.setdefault((route, method), empty_route())
+        stats['buckets'][bucket] += 1
+        stats['count'] += 1
+        stats['seconds'] += elapsed
+        for name in ('statements', 'sql_seconds', 'cache_hits', 'cache_misses'):
+            stats[name] += current[name]
+        stats['response_bytes'] += size or 0
+        for phase, seconds in current['phases'].items():
+            stats['phases'][phase] += seconds
+        stacks = _sampled.pop(threading.get_ident(), None)
+    if stacks and elapsed >= app.config.get('PROFILE_SLOW_SECONDS'):
+        write_stacks(route, stacks)
+    if time.monotonic() - _last_flush >= app.config.get('METRICS_FLUSH_INTERVAL'):
+        flush()
+
+def clear():
+    _current.request = None
+    with _lock:
+        _sampled.pop(threading.get_ident(), None)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_current, 'request', None) is not None:
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('metrics_started')
+    current = getattr(_current, 'request', None)
+    if started and current is not None:
+        current['statements'] += 1
+        current['sql_seconds'] += time.perf_counter() - started.pop()
+
+class JSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        with timed('json'):
+            return DefaultJSONProvider.dumps(self, obj, **kwargs)
+
+def dump():
+    with _lock:
+        return json.dumps({'requests': [list(key) + [count] for key, count in _requests.items()],
+                           'routes': [list(key) + [stats] for key, stats in _routes.items()]})
+
+def write_atomic(path, data):
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=folder)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+def flush():
+    global _last_flush
+    from app import app
+    _last_flush = time.monotonic()
+    write_atomic(os.path.join(app.config.get('METRICS_FOLDER'), '{}.json'.format(os.getpid())),
+                 dump())
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def merge(total, stats):
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            merge(total[name], value)
+        elif isinstance(value, list):
+            total[name] = [a + b for a, b in zip(total[name], value)]
+        else:
+            total[name] += value
+
+def collect():
+    # Every live worker's metrics added up. Files left by workers that have
+    # exited are removed, so their counts drop out (a counter reset, as far
+    # as Prometheus is concerned).
+    from app import app
+    flush()
+    folder = app.config.get('METRICS_FOLDER')
+    requests, routes = Counter(), {}
+    for name in os.listdir(folder):
+        pid, extension = os.path.splitext(name)
+        if extension != '.json' or not pid.isdigit():
+            continue
+        path = os.path.join(folder, name)
+        if not alive(int(pid)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        for route, method, status, count in data['requests']:
+            requests[route, method, status] += count
+        for route, method, stats in data['routes']:
+            merge(routes.setdefault((route, method), empty_route()), stats)
+    return requests, routes
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render(collected):
+    # Prometheus text exposition format.
+    requests, routes = collected
+    lines = []
+
+    def family(name, kind, help):
+        lines.append('# HELP clubreview_{} {}'.format(name, help))
+        lines.append('# TYPE clubreview_{} {}'.format(name, kind))
+
+    def sample(name, labels, value):
+        labels = ','.join('{}="{}"'.format(key, escape(label)) for key, label in labels)
+        lines.append('clubreview_{}{{{}}} {}'.format(name, labels, repr(float(value)) if isinstance(value, float)
+                                                     else value))
+
+    family('requests_total', 'counter', 'Requests handled, by route, method and status.')
+    for (route, method, status), count in sorted(requests.items()):
+        sample('requests_total', (('route', route), ('method', method), ('status', status)), count)
+    family('request_duration_seconds', 'histogram', 'Time from the start of a request to its response.')
+    for (route, method), stats in sorted(routes.items()):
+        labels = (('route', route), ('method', method))
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), stats['buckets']):
+            cumulative += count
+            sample('request_duration_seconds_bucket', labels + (('le', bound),), cumulative)
+        sample('request_duration_seconds_sum', labels, stats['seconds'])
+        sample('request_duration_seconds_count', labels, stats['count'])
+    counters = (('sql_statements_total', 'statements', 'SQL statements run on request threads.'),
+                ('sql_seconds_total', 'sql_seconds', 'Time spent running those statements.'),
+                ('cache_hits_total', 'cache_hits', 'Responses served from the response cache.'),
+                ('cache_misses_total', 'cache_misses', 'Cacheable responses that had to be built.'),
+                ('response_bytes_total', 'response_bytes', 'Response body bytes, for non-streamed responses.'))
+    for name, key, help in counters:
+        family(name, 'counter', help)
+        for (route, method), stats in sorted(routes.items()):
+            sample(name, (('route', route), ('method', method)), stats[key])
+    family('phase_seconds_total', 'counter', 'Time spent in bcrypt, JWT decoding and JSON encoding.')
+    for (route, method), stats in sorted(routes.items()):
+        for phase in PHASES:
+            sample('phase_seconds_total', (('route', route), ('method', method), ('phase', phase)),
+                   stats['phases'][phase])
+    return '\n'.join(lines) + '\n'
+
+def fold(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+                     .replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def sample_stacks(interval):
+    while True:
+        time.sleep(interval)
+        frames = sys._current_frames()
+        with _lock:
+            idents = list(_sampled)
+        stacks = {ident: fold(frames[ident]) for ident in idents if ident in frames}
+        del frames
+        with _lock:
+            for ident, stack in stacks.items():
+                if ident in _sampled:
+                    _sampled[ident].append(stack)
+
+def start_sampler(interval):
+    global _sampler
+    with _lock:
+        if _sampler is None:
+            _sampler = threading.Thread(target=sample_stacks, args=(interval,), name='profiler', daemon=True)
+            _sampler.start()
+
+_profile_lock = threading.Lock()
+
+def write_stacks(route, stacks):
+    from app import app
+    folder = app.config.get('PROFILE_FOLDER')
+    os.makedirs(folder, exist_ok=True)
+    lines = ''.join('{};{} {}\n'.format(route.replace(';', ':'), stack, count)
+                    for stack, count in Counter(stacks).items())
+    with _profile_lock, open(os.path.join(folder, '{}.folded'.format(os.getpid())), 'a') as f:
+        f.write(lines)
@@ -0,0 +1,134 @@
+import datetime
+from sqlalchemy import inspect, text
+from app import db
+
+# Brings an existing clubreview.db up to the current models in place. Each
+# step checks whether it has already been applied, so this is safe to run
+# on every deploy.
+
+def columns(table_name):
+    return [column['name'] for column in inspect(db.engine).get_columns(table_name)]
+
+def migrate_invalid_tokens():
+    # invalid_token used to be keyed by the whole JWT. Those tokens are at
+    # most a day old, so they keep their string as jti and expire a day out.
+    from models import InvalidToken
+    if 'jti' in columns('invalid_token'):
+        return
+    expires = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    with db.engine.begin() as connection:
+        connection.execute(text('ALTER TABLE invalid_token RENAME TO invalid_token_old'))
+        InvalidToken.__table__.create(connection)
+        connection.execute(text('INSERT INTO invalid_token (jti, expires) '
+                                'SELECT id, :expires FROM invalid_token_old'),
+                           {'expires': expires.strftime('%Y-%m-%d %H:%M:%S.%f')})
+        connection.execute(text('DROP TABLE invalid_token_old'))
+
+def migrate_association_tables():
+    # The association tables had no key, so they may hold duplicate or
+    # half-empty rows. Rebuild each one with its composite key, keeping one
+    # copy of every complete row.
+    from models import user_to_club, tag_to_club, favorites, owner_to_club, file_to_club
+    for table in (user_to_club, tag_to_club, favorites, owner_to_club, file_to_club):
+        if not inspect(db.engine).has_table(table.name):
+            continue
+        if inspect(db.engine).get_pk_constraint(table.name)['constrained_columns']:
+            continue
+        names = ', '.join(column.name for column in table.columns)
+        not_null = ' AND '.join('{} IS NOT NULL'.format(column.name) for column in table.columns)
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE {0} RENAME TO {0}_old'.format(table.name)))
+            table.create(connection)
+            connection.execute(text('INSERT OR IGNORE INTO {0} ({1}) SELECT {1} FROM {0}_old WHERE {2}'
+                                    .format(table.name, names, not_null)))
+            connection.execute(text('DROP TABLE {}_old'.format(table.name)))
+
+def migrate_files():
+    # file was never written to before content-addressed storage, and its
+    # old rows have no blob to point at, so it is simply recreated. Files
+    # under UPLOAD_FOLDER are still served from there.
+    from models import File
+    if 'digest' in columns('file'):
+        return
+    with db.engine.begin() as connection:
+        connection.execute(text('DROP TABLE file'))
+        File.__table__.create(connection)
+
+def add_counter_columns():
+    # Stored counters (see models.COUNTERS) start at zero and are filled in
+    # by repair_counters once their triggers are in place. They must exist
+    # before any association table is rebuilt, since that adds the triggers.
+    from models import COUNTERS
+    added = False
+    for _, target, counter, _ in COUNTERS:
+        if inspect(db.engine).has_table(target) and counter not in columns(target):
+            with db.engine.begin() as connection:
+                connection.execute(text('ALTER TABLE {} ADD COLUMN {} INTEGER NOT NULL DEFAULT 0'
+                                        .format(target, counter)))
+            added = True
+    return added
+
+def add_trending_column():
+    # Like the counters, this must exist before an association table is
+    # rebuilt. Links made before club_event have no time, so they don't
+    # count towards the score.
+    if not inspect(db.engine).has_table('club') or 'trending' in columns('club'):
+        return False
+    with db.engine.begin() as connection:
+        connection.execute(text('ALTER TABLE club ADD COLUMN trending FLOAT NOT NULL DEFAULT -9e999'))
+    return True
+
+def add_version_column():
+    if inspect(db.engine).has_table('club') and 'version' not in columns('club'):
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE club ADD COLUMN version INTEGER NOT NULL DEFAULT 0'))
+
+def reset_trending():
+    # Rebuilding favorites or user_to_club logs every old link as happening
+    # now; drop those events.
+    with db.engine.begin() as connection:
+        connection.execute(text('DELETE FROM club_event'))
+        connection.execute(text('UPDATE club SET trending = -9e999'))
+
+def create_triggers():
+    # create_all only adds triggers along with a new table.
+    from models import counter_triggers, tag_change_triggers, club_event_triggers, club_version
+    with db.engine.begin() as connection:
+        for trigger in counter_triggers + tag_change_triggers + club_event_triggers + [club_version]:
+            connection.execute(trigger)
+
+def create_missing_indexes():
+    # create_all only creates whole tables, not indexes added to existing ones.
+    for table in db.Model.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def migrate():
+    import models
+    from counters import repair_counters
+    from search import rebuild_index
+    had_search_index = inspect(db.engine).has_table('club_search')
+    if inspect(db.engine).has_table('invalid_token'):
+        migrate_invalid_tokens()
+    if inspect(db.engine).has_table('file'):
+        migrate_files()
+    added_counters = add_counter_columns()
+    added_trending = add_trending_column()
+    add_version_column()
+    # Rebuilding the association tables adds their tag_change and club_event
+    # triggers.
+    models.TagChange.__table__.create(db.engine, checkfirst=True)
+    models.ClubEvent.__table__.create(db.engine, checkfirst=True)
+    migrate_association_tables()
+    if added_trending:
+        reset_trending()
+    db.create_all()
+    create_triggers()
+    if added_counters:
+        repair_counters()
+    create_missing_indexes()
+    if not had_search_index:
+        rebuild_index()
+
+if __name__ == '__main__':
+    migrate()
@@ -1,61 +1,157 @@
 from app import db
+from sqlalchemy import DDL, event
 
 # Your database models should go here.
 # Check out the Flask-SQLAlchemy quickstart for some good docs!
 # https://flask-sqlalchemy.palletsprojects.com/en/2.x/quickstart/
 
+# Each association table is keyed on both ids, which also indexes lookups by
+# the first one, and has a second index for lookups from the other side.
+
 user_to_club = db.Table('user_to_club',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('club_id', db.Integer, db.ForeignKey('club.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
+    db.Index('ix_user_to_club_club_id', 'club_id')
 )
 
 tag_to_club = db.Table('tag_to_club',
-    db.Column('club_id', db.Integer, db.ForeignKey('club.id')),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'))
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    db.Index('ix_tag_to_club_tag_id', 'tag_id')
 )
 
 favorites = db.Table('favorites',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('club_id', db.Integer, db.ForeignKey('club.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
+    db.Index('ix_favorites_club_id', 'club_id')
 )
 
 owner_to_club = db.Table('owner_to_club',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('club_id', db.Integer, db.ForeignKey('club.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
+    db.Index('ix_owner_to_club_club_id', 'club_id')
 )
 
 file_to_club = db.Table('file_to_club',
-    db.Column('club_id', db.Integer, db.ForeignKey('club.id')),
-    db.Column('file_id', db.Integer, db.ForeignKey('file.id'))
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
+    db.Column('file_id', db.Integer, db.ForeignKey('file.id'), primary_key=True),
+    db.Index('ix_file_to_club_file_id', 'file_id')
 )
 
+# Full-text index over club name, description and tag names, keyed by club id
+# (the FTS rowid). Kept in sync by search.index_club/unindex_club.
+club_search_ddl = DDL("CREATE VIRTUAL TABLE IF NOT EXISTS club_search USING fts5("
+                      "name, description, tags, tokenize='unicode61 remove_diacritics 2', "
+                      "prefix='2 3')")
+event.listen(db.Model.metadata, 'after_create', club_search_ddl.execute_if(dialect='sqlite'))
+event.listen(db.Model.metadata, 'before_drop',
+             DDL("DROP TABLE IF EXISTS club_search").execute_if(dialect='sqlite'))
+
+# Row counts of the association tables, stored on the rows they count and
+# kept up to date by triggers, so every insert or delete (ORM, Core or bulk
+# import) adjusts them in its own transaction. counters.py recomputes them.
+COUNTERS = [(user_to_club, 'club', 'membership_count', 'club_id'),
+            (favorites, 'club', 'favorite_count', 'club_id'),
+            (tag_to_club, 'tag', 'club_count', 'tag_id')]
+
+def counter_trigger(table, target, counter, key, action):
+    operator, row = {'insert': ('+', 'NEW'), 'delete': ('-', 'OLD')}[action]
+    trigger = DDL("CREATE TRIGGER IF NOT EXISTS {0}_{1} AFTER {2} ON {0} BEGIN "
+                  "UPDATE {3} SET {4} = {4} {5} 1 WHERE id = {6}.{7}; END"
+                  .format(table.name, action, action.upper(), target, counter, operator, row, key))
+    event.listen(table, 'after_create', trigger.execute_if(dialect='sqlite'))
+    return trigger
+
+counter_triggers = [counter_trigger(*counter, action) for counter in COUNTERS for action in ('insert', 'delete')]
+
+# Every change to tag_to_club is also appended to tag_change, so each
+# worker's tag index (tagindex.py) can catch up from the seq it last saw.
+# Only the last TAG_CHANGE_RETENTION changes are kept; a worker that falls
+# further behind rebuilds from tag_to_club.
+TAG_CHANGE_RETENTION = 100000
+
+def tag_change_trigger(action):
+    row, added = {'insert': ('NEW', 1), 'delete': ('OLD', 0)}[action]
+    trigger = DDL("CREATE TRIGGER IF NOT EXISTS tag_to_club_log_{0} AFTER {1} ON tag_to_club BEGIN "
+                  "INSERT INTO tag_change (club_id, tag_id, added) VALUES ({2}.club_id, {2}.tag_id, {3}); END"
+                  .format(action, action.upper(), row, added))
+    event.listen(tag_to_club, 'after_create', trigger.execute_if(dialect='sqlite'))
+    return trigger
+
+tag_change_triggers = [tag_change_trigger('insert'), tag_change_trigger('delete')]
+
+# Favorites and memberships are logged to club_event with their time, and
+# each logged event adjusts club.trending, a time-decayed popularity score:
+# every event counts 2^(age / TRENDING_HALF_LIFE) less than a new one. The
+# score is stored as log2 of the sum of 2^((time - TRENDING_EPOCH) / half
+# life) over the live events, which orders clubs the same way as the decayed
+# sum at any moment, so it only changes when an event happens and can be
+# indexed. A removal takes away the term of the link's latest add; a club
+# with no events scores -inf. counters.repair_trending recomputes it.
+#
+# Events older than TRENDING_HORIZON, which count less than 1/1000 of a new
+# one, are deleted as new ones come in. Removing a link whose add has gone
+# leaves the score as it is.
+TRENDING_EPOCH = 1704067200
+TRENDING_HALF_LIFE = 3 * 24 * 3600
+TRENDING_HORIZON = 10 * TRENDING_HALF_LIFE
+
+def club_event_trigger(table, kind, action):
+    row, added = {'insert': ('NEW', 1), 'delete': ('OLD', 0)}[action]
+    trigger = DDL("CREATE TRIGGER IF NOT EXISTS {0}_event_{1} AFTER {2} ON {0} BEGIN "
+                  "INSERT INTO club_event (club_id, user_id, kind, added, time) VALUES "
+                  "({3}.club_id, {3}.user_id, '{4}', {5}, (julianday('now') - 2440587.5) * 86400.0); END"
+                  .format(table.name, action, action.upper(), row, kind, added))
+    event.listen(table, 'after_create', trigger.execute_if(dialect='sqlite'))
+    return trigger
+
+club_event_triggers = [club_event_trigger(table, kind, action)
+                       for table, kind in ((favorites, 'favorite'), (user_to_club, 'member'))
+                       for action in ('insert', 'delete')]
+
 class Club(db.Model):
+    # Leaderboards for ?sort=, walked from the top.
+    __table_args__ = (db.Index('ix_club_popular', 'favorite_count', 'id'),
+                      db.Index('ix_club_trending', 'trending', 'id'))
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(255), unique=True, nullable=True)
     name = db.Column(db.String(255), unique=True)
     description = db.Column(db.Text, nullable=True)
-    owner = db.Column(db.String(150), db.ForeignKey('user.username'))
+    owner = db.Column(db.String(150), db.ForeignKey('user.username'), index=True)
+    membership_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    trending = db.Column(db.Float, nullable=False, default=float('-inf'), server_default='-9e999')
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     tags = db.relationship('Tag', secondary=tag_to_club, back_populates='clubs')
     members = db.relationship('User', secondary=user_to_club, back_populates='clubs')
     favorites = db.relationship('User', secondary=favorites, back_populates='favorites')
     files = db.relationship('File', secondary=file_to_club, back_populates='club')
     def to_dict(self):
         return {'id': self.id, 'code': self.code, 'name': self.name, 'description': 
-                self.description, 'membership_count': len(self.members), 'tags': 
-                [tag.to_dict() for tag in self.tags], 'favorite_count': len(self.favorites)}
+                self.description, 'membership_count': self.membership_count, 'tags': 
+                [tag.to_dict() for tag in self.tags], 'favorite_count': self.favorite_count}
+
+# Bumped whenever anything in a club's serialized form but its tags changes,
+# counters included, so cached JSON (utils.club_fragments) can be checked
+# against it. Tag changes bump the 'tags' cache tag instead.
+club_version = DDL("CREATE TRIGGER IF NOT EXISTS club_version AFTER UPDATE OF code, name, description, "
+                   "membership_count, favorite_count ON club BEGIN "
+                   "UPDATE club SET version = version + 1 WHERE id = NEW.id; END")
+event.listen(Club.__table__, 'after_create', club_version.execute_if(dialect='sqlite'))
 
 class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), unique=True)
+    club_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     clubs = db.relationship('Club', secondary=tag_to_club, back_populates='tags')
     def to_dict(self):
-        return {'id': self.id, 'name': self.name, 'clubs': len(self.clubs)}
+        return {'id': self.id, 'name': self.name, 'clubs': self.club_count}
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(150), unique=True)
     password = db.Column(db.String(255))
-    email = db.Column(db.String(254))
+    email = db.Column(db.String(254), index=True)
     clubs = db.relationship('Club', secondary=user_to_club, back_populates='members')
     owned_clubs = db.relationship('Club', backref='owner.username')
     favorites = db.relationship('Club', secondary=favorites, back_populates='favorites')
@@ -63,19 +159,91 @@ class User(db.Model):
         return {'id': self.id, 'username': self.username, 'email': self.email}
 
 class InvalidToken(db.Model):
-    id = db.Column(db.String(255), primary_key=True)
+    # Revoked tokens by jti (tokens issued before jti existed use the whole
+    # token). seq only ever grows so workers can fetch new revocations
+    # incrementally, and rows are purged once the token has expired.
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(255), unique=True, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
-    user_id = db.Column(db.Integer, nullable=False)
-    club_id = db.Column(db.Integer, nullable=False)
-    parent_id = db.Column(db.Integer, nullable=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    club_id = db.Column(db.Integer, nullable=False, index=True)
+    parent_id = db.Column(db.Integer, nullable=True, index=True)
     def to_dict(self):
         return {'id': self.id, 'user': User.query.get(self.user_id).username, 'club': Club.query.get(self.club_id).code, 'content': self.content, 'parent': self.parent_id}
 
 class File(db.Model):
+    # A club's named file. The content lives in a blob shared by every file
+    # with the same digest (see storage.py), so names and paths repeat.
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(255), unique=True)
-    path = db.Column(db.Text, unique=True)
+    name = db.Column(db.String(255), nullable=False)
+    path = db.Column(db.Text, nullable=False)
+    digest = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.Integer, nullable=False)
+    mime = db.Column(db.String(255), nullable=False)
+    mtime = db.Column(db.DateTime, nullable=False)
     club = db.relationship('Club', secondary=file_to_club, back_populates='files')
+
+class TagChange(db.Model):
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True)
+    club_id = db.Column(db.Integer, nullable=False)
+    tag_id = db.Column(db.Integer, nullable=False)
+    added = db.Column(db.Boolean, nullable=False)
+
+tag_change_trim = DDL("CREATE TRIGGER IF NOT EXISTS tag_change_trim AFTER INSERT ON tag_change BEGIN "
+                      "DELETE FROM tag_change WHERE seq <= NEW.seq - {}; END".format(TAG_CHANGE_RETENTION))
+event.listen(TagChange.__table__, 'after_create', tag_change_trim.execute_if(dialect='sqlite'))
+tag_change_triggers.append(tag_change_trim)
+
+class ClubEvent(db.Model):
+    __table_args__ = (db.Index('ix_club_event_link', 'club_id', 'user_id', 'kind'),
+                      {'sqlite_autoincrement': True})
+    seq = db.Column(db.Integer, primary_key=True)
+    club_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(16), nullable=False)
+    added = db.Column(db.Boolean, nullable=False)
+    time = db.Column(db.Float, nullable=False, index=True)
+
+def trending_term(time):
+    return '(({} - {}) / {}.0)'.format(time, TRENDING_EPOCH, TRENDING_HALF_LIFE)
+
+# log2(2^s + 2^x) and log2(2^s - 2^x), kept finite for s = -inf; a removal
+# that leaves (next to) nothing gives -inf.
+club_event_score = DDL(
+    "CREATE TRIGGER IF NOT EXISTS club_event_score AFTER INSERT ON club_event BEGIN "
+    "UPDATE club SET trending = (SELECT CASE "
+    "WHEN NEW.added THEN max(club.trending, x) + log2(1 + pow(2, -abs(club.trending - x))) "
+    "WHEN x IS NULL THEN club.trending "
+    "WHEN x - club.trending > -1e-9 THEN -9e999 "
+    "ELSE club.trending + log2(1 - pow(2, x - club.trending)) END "
+    "FROM (SELECT CASE WHEN NEW.added THEN {0} ELSE "
+    "(SELECT {1} FROM club_event WHERE club_id = NEW.club_id AND user_id = NEW.user_id "
+    "AND kind = NEW.kind AND added AND seq < NEW.seq ORDER BY seq DESC LIMIT 1) END AS x)) "
+    "WHERE id = NEW.club_id; END".format(trending_term('NEW.time'), trending_term('time')))
+event.listen(ClubEvent.__table__, 'after_create', club_event_score.execute_if(dialect='sqlite'))
+club_event_triggers.append(club_event_score)
+
+club_event_trim = DDL("CREATE TRIGGER IF NOT EXISTS club_event_trim AFTER INSERT ON club_event BEGIN "
+                      "DELETE FROM club_event WHERE time < NEW.time - {}; END".format(TRENDING_HORIZON))
+event.listen(ClubEvent.__table__, 'after_create', club_event_trim.execute_if(dialect='sqlite'))
+club_event_triggers.append(club_event_trim)
+
+class CacheTag(db.Model):
+    # Cache tags invalidated by any worker, stamped with an increasing seq so
+    # the others can pick up what changed since they last looked.
+    name = db.Column(db.String(255), primary_key=True)
+    seq = db.Column(db.Integer, nullable=False, index=True)
+
+class ScrapedPage(db.Model):
+    # Validators from the last successful scrape of each page, sent back as
+    # If-None-Match/If-Modified-Since so unchanged pages aren't re-parsed.
+    url = db.Column(db.String(2048), primary_key=True)
+    etag = db.Column(db.String(255), nullable=True)
+    last_modified = db.Column(db.String(255), nullable=True)
+    fetched = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,56 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+# bcrypt runs on a small pool shared by the worker's request threads. At most
+# PASSWORD_HASH_WORKERS hashes run at once and PASSWORD_HASH_QUEUE more may
+# wait; past that a request waits up to PASSWORD_HASH_WAIT seconds for a slot
+# and then gets a 503. Every running or queued hash holds a request thread,
+# so keeping their sum below the worker's threads (and the wait at 0) means a
+# login storm can't take every thread in the worker.
+# PASSWORD_HASH_WORKERS = 0 hashes inline on the request thread instead.
+
+class PasswordHasherBusy(Exception):
+    pass
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+
+def _run(f, *args):
+    from metrics import timed
+    with timed('bcrypt'):
+        return _hash(f, *args)
+
+def _hash(f, *args):
+    global _executor, _slots
+    from app import app
+    workers = app.config.get('PASSWORD_HASH_WORKERS')
+    if not workers:
+        return f(*args)
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+            _slots = threading.BoundedSemaphore(workers + app.config.get('PASSWORD_HASH_QUEUE'))
+    if not _slots.acquire(timeout=app.config.get('PASSWORD_HASH_WAIT')):
+        raise PasswordHasherBusy()
+    try:
+        future = _executor.submit(f, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future.result()
+
+def hash_password(password):
+    from app import app
+    rounds = app.config.get('BCRYPT_LOG_ROUNDS')
+    return _run(lambda: bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)))
+
+def check_password(password, hashed):
+    return _run(bcrypt.checkpw, password.encode('utf-8'), hashed)
+
+def needs_rehash(hashed):
+    from app import app
+    return int(hashed[4:6]) != app.config.get('BCRYPT_LOG_ROUNDS')
@@ -0,0 +1,87 @@
+import hashlib
+import math
+import threading
+
+from app import app
+from caching import LRUCache
+
+# In-memory side of token revocation. Every worker keeps a Bloom filter of
+# the revoked token ids in the invalid_token table, so only tokens the filter
+# might contain cost a database lookup, and a short-lived map from token to
+# user id so a valid token doesn't have to be decoded on every request.
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class RevocationFilter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._last_seq = 0
+        self._version = None
+
+    def _rebuild(self, capacity):
+        self._bloom = BloomFilter(capacity, app.config.get('REVOCATION_FILTER_ERROR_RATE'))
+        self._last_seq = 0
+
+    def refresh(self):
+        # Pulls in tokens revoked since the last refresh, by any worker. Logouts
+        # invalidate the 'tokens' cache tag, so this only queries the table
+        # when that tag has moved.
+        from caching import tag_versions
+        version = tag_versions(['tokens'])[0]
+        with self._lock:
+            if self._bloom is not None and version == self._version:
+                return
+            if self._bloom is None:
+                self._rebuild(app.config.get('REVOCATION_FILTER_CAPACITY'))
+            rows = self._revoked_since(self._last_seq)
+            if self._bloom.count + len(rows) > self._bloom.capacity:
+                # Purged tokens are still in the filter, so rebuilding from
+                # the live rows may be enough to get back under capacity.
+                rows = self._revoked_since(0)
+                self._rebuild(max(app.config.get('REVOCATION_FILTER_CAPACITY'), 2 * len(rows)))
+            for seq, jti in rows:
+                self._bloom.add(jti)
+                self._last_seq = seq
+            self._version = version
+
+    def _revoked_since(self, seq):
+        import datetime
+        from app import db
+        from models import InvalidToken
+        return db.session.query(InvalidToken.seq, InvalidToken.jti) \
+            .filter(InvalidToken.seq > seq, InvalidToken.expires > datetime.datetime.utcnow()) \
+            .order_by(InvalidToken.seq).all()
+
+    def might_contain(self, jti):
+        self.refresh()
+        with self._lock:
+            return jti in self._bloom
+
+    def add(self, jti):
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(jti)
+
+revocations = RevocationFilter()
+token_users = LRUCache(threshold=app.config.get('AUTH_CACHE_SIZE'),
+                       default_timeout=app.config.get('AUTH_CACHE_TTL'))
@@ -1,20 +1,89 @@
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from concurrent.futures import ThreadPoolExecutor
+import datetime
 import requests
 import re
 
+# Scrapes club listings from the sources in SCRAPER_SOURCES. Pages are
+# fetched concurrently with conditional requests, so a page that hasn't
+# changed since the last run is neither downloaded nor parsed again, and
+# everything scraped goes through the importer, which only writes clubs
+# that differ from what's stored.
+
+try:
+    import lxml
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+class Source:
+    # A source turns the HTML of its page into club entries for the importer.
+    def __init__(self, url):
+        self.url = url
+
+    def parse(self, html):
+        raise NotImplementedError
+
+class OCWPSource(Source):
+    # ocwp.pennlabs.org: one styled div per club.
+    only = SoupStrainer('div', style=re.compile('important'))
+
+    def parse(self, html):
+        from utils import create_club_code
+        soup = BeautifulSoup(html, PARSER, parse_only=self.only)
+        entries = []
+        for club in soup.find_all('div', style=re.compile('important')):
+            name = club.find('strong', class_='club-name').text
+            description = club.find('em').text
+            tags = [tag.text for tag in club.find_all('span', class_=re.compile('tag'))]
+            entries.append({'code': create_club_code(name), 'name': name, 'description': description,
+                            'tags': tags})
+        return entries
+
+SOURCES = {'ocwp': OCWPSource}
+
+def fetch(source, page, timeout):
+    # Returns the page's entries and new validators, or None if unchanged.
+    headers = {}
+    if page is not None and page.etag:
+        headers['If-None-Match'] = page.etag
+    if page is not None and page.last_modified:
+        headers['If-Modified-Since'] = page.last_modified
+    response = requests.get(source.url, headers=headers, timeout=timeout)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    return source.parse(response.text), response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+def scrape(owner=None, force=False):
+    from app import app, db
+    from importer import import_clubs
+    from models import ScrapedPage
+    sources = [SOURCES[name](url) for name, url in app.config.get('SCRAPER_SOURCES').items()]
+    pages = {page.url: page for page in
+             ScrapedPage.query.filter(ScrapedPage.url.in_([source.url for source in sources]))}
+    if force:
+        pages = {}
+    workers = max(1, min(app.config.get('SCRAPER_WORKERS'), len(sources)))
+    timeout = app.config.get('SCRAPER_TIMEOUT')
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda source: fetch(source, pages.get(source.url), timeout), sources))
+    entries = [entry for result in results if result is not None for entry in result[0]]
+    stats = import_clubs(entries, owner)
+    stats['pages'] = len(sources)
+    stats['unchanged'] = results.count(None)
+    now = datetime.datetime.utcnow()
+    for source, result in zip(sources, results):
+        if result is not None:
+            db.session.merge(ScrapedPage(url=source.url, etag=result[1], last_modified=result[2], fetched=now))
+    db.session.commit()
+    return stats
+
 def main():
-    from utils import create_club, create_club_code
-    from models import Club, User
-    josh = User.query.filter_by(username='josh').first()
-    page = requests.get('https://ocwp.pennlabs.org/')
-    soup = BeautifulSoup(page.text, 'html.parser')
-    clubs = soup.find_all('div', style=re.compile('important'))
-    for club in clubs:
-        name = club.find('strong', class_='club-name').text
-        code = create_club_code(name)
-        description = club.find('em').text
-        tags = [tag.text for tag in club.find_all('span', class_=re.compile('tag'))]
-        create_club({"code": code, "name": name, "description": description, "tags": tags, 'owner': 'josh'})
+    return scrape(owner='josh')
 
 if __name__ == '__main__':
-    main()
+    import sys
+    stats = scrape(owner='josh', force='--force' in sys.argv)
+    print('{pages} pages, {unchanged} unchanged: {entries} clubs read, {inserted} new, {updated} updated '
+          'in {seconds:.2f}s'.format(**stats))
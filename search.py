@@ -0,0 +1,58 @@
+import re
+from sqlalchemy import bindparam, column, false, func, literal_column, table, text
+from app import db
+
+club_search = table('club_search', column('rowid'), column('club_search'))
+
+def match_expression(term):
+    # Every word must match, and the last one may be a prefix of a word
+    # (so "whart" finds "Wharton").
+    words = re.findall(r'\w+', term)
+    if not words:
+        return None
+    terms = ['"{}"'.format(word) for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+def search_clubs(term):
+    from models import Club
+    expression = match_expression(term)
+    if expression is None:
+        return Club.query.filter(false())
+    rank = func.bm25(literal_column('club_search'), 10.0, 1.0, 5.0)
+    return Club.query.join(club_search, club_search.c.rowid == Club.id) \
+        .filter(club_search.c.club_search.op('MATCH')(expression)) \
+        .order_by(rank, Club.id)
+
+def index_club(club):
+    unindex_club(club.id)
+    db.session.execute(text('INSERT INTO club_search (rowid, name, description, tags) '
+                            'VALUES (:id, :name, :description, :tags)'),
+                       {'id': club.id, 'name': club.name, 'description': club.description or '',
+                        'tags': ' '.join(tag.name for tag in club.tags)})
+
+def unindex_club(club_id):
+    db.session.execute(text('DELETE FROM club_search WHERE rowid = :id'), {'id': club_id})
+
+INDEX_CLUBS = ("INSERT INTO club_search (rowid, name, description, tags) "
+               "SELECT club.id, club.name, coalesce(club.description, ''), "
+               "(SELECT coalesce(group_concat(tag.name, ' '), '') FROM tag "
+               "JOIN tag_to_club ON tag_to_club.tag_id = tag.id WHERE tag_to_club.club_id = club.id) "
+               "FROM club")
+
+def reindex_clubs(club_ids):
+    params = {'ids': list(club_ids)}
+    db.session.execute(text('DELETE FROM club_search WHERE rowid IN :ids')
+                       .bindparams(bindparam('ids', expanding=True)), params)
+    db.session.execute(text(INDEX_CLUBS + ' WHERE club.id IN :ids')
+                       .bindparams(bindparam('ids', expanding=True)), params)
+
+def rebuild_index():
+    from models import club_search_ddl
+    db.session.execute(text(club_search_ddl.statement))
+    db.session.execute(text('DELETE FROM club_search'))
+    db.session.execute(text(INDEX_CLUBS))
+    db.session.commit()
+
+if __name__ == '__main__':
+    rebuild_index()
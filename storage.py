@@ -0,0 +1,183 @@
+import datetime
+import hashlib
+import mimetypes
+import os
+import tempfile
+from app import app, db
+
+# Content-addressed storage for club files. An upload is hashed while it is
+# streamed to a temp file and then renamed to BLOB_FOLDER/ab/cd/abcd...,
+# its sha256, so identical content is stored once however many clubs upload
+# it. File rows map a club's filename to a blob; a blob is removed once no
+# row refers to its digest. Files uploaded before this live as plain files
+# under UPLOAD_FOLDER/<code>/ and are still served from there; reconcile()
+# moves them into the index.
+#
+#   python storage.py
+
+def blob_path(digest):
+    return os.path.join(app.config.get('BLOB_FOLDER'), digest[:2], digest[2:4], digest)
+
+def legacy_path(code, filename):
+    return os.path.join(app.config.get('UPLOAD_FOLDER'), code, filename)
+
+def find_file(club, filename):
+    from models import File, file_to_club
+    return File.query.join(file_to_club).filter(file_to_club.c.club_id == club.id, File.name == filename).first()
+
+def write_temp(stream):
+    # Returns the temp file's path, sha256 and size.
+    folder = os.path.join(app.config.get('BLOB_FOLDER'), 'tmp')
+    os.makedirs(folder, exist_ok=True)
+    chunk_size = app.config.get('BLOB_CHUNK_SIZE')
+    digest, size = hashlib.sha256(), 0
+    fd, path = tempfile.mkstemp(dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, digest.hexdigest(), size
+
+def commit_blob(temp, digest):
+    # Runs after the row is flushed but before it is committed: readers only
+    # see the row once the blob is in place, and SQLite's write lock keeps a
+    # concurrent release of the same digest from running in between.
+    path = blob_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temp, path)
+
+def release(digests):
+    # Call inside the transaction that dropped the rows, before committing:
+    # SQLite holds the write lock until then, so no upload can add a row for
+    # the digest between the count and the removal.
+    from models import File
+    for digest in set(digests):
+        if File.query.filter_by(digest=digest).first() is None:
+            try:
+                os.remove(blob_path(digest))
+            except FileNotFoundError:
+                pass
+
+def store(club, filename, stream, mimetype=None, mtime=None):
+    # Saves the stream as the club's file of that name, replacing any file
+    # already stored under it. Returns the File.
+    from models import File
+    temp, digest, size = write_temp(stream)
+    try:
+        file = find_file(club, filename)
+        old_digest = None
+        if file is None:
+            file = File(name=filename)
+            club.files.append(file)
+        else:
+            old_digest = file.digest
+        file.path = blob_path(digest)
+        file.digest = digest
+        file.size = size
+        file.mime = mimetypes.guess_type(filename)[0] or mimetype or 'application/octet-stream'
+        file.mtime = mtime or datetime.datetime.utcnow()
+        db.session.add(file)
+        db.session.flush()
+        if old_digest is not None and old_digest != digest:
+            release([old_digest])
+        commit_blob(temp, digest)
+        db.session.commit()
+    except BaseException:
+        # A blob already moved into place is left for reconcile().
+        db.session.rollback()
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    legacy = legacy_path(club.code, filename)
+    if os.path.exists(legacy):
+        os.remove(legacy)
+    return file
+
+def send(file):
+    # Download response for a stored file. The digest is a strong ETag, so
+    # conditional requests get a 304 and Range requests a 206. With
+    # FILE_OFFLOAD set, the front-end server sends the bytes (and handles
+    # ranges) from the path in X-Sendfile or X-Accel-Redirect.
+    from flask import Response, request, send_file
+    offload = app.config.get('FILE_OFFLOAD')
+    if offload is None:
+        return send_file(os.path.abspath(file.path), mimetype=file.mime, as_attachment=True,
+                         download_name=file.name, conditional=True, etag=file.digest,
+                         last_modified=file.mtime)
+    response = Response(mimetype=file.mime)
+    response.headers.set('Content-Disposition', 'attachment', filename=file.name)
+    if offload == 'x-accel-redirect':
+        relative = os.path.relpath(file.path, app.config.get('BLOB_FOLDER')).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = app.config.get('FILE_ACCEL_PREFIX') + relative
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(file.path)
+    response.set_etag(file.digest)
+    response.last_modified = file.mtime
+    response.cache_control.no_cache = True
+    response = response.make_conditional(request)
+    if response.status_code == 304:
+        response.headers.pop('X-Sendfile', None)
+        response.headers.pop('X-Accel-Redirect', None)
+    return response
+
+def delete(files):
+    # Deletes the File rows and any blobs left without one, and commits.
+    digests = [file.digest for file in files]
+    for file in files:
+        db.session.delete(file)
+    db.session.flush()
+    release(digests)
+    db.session.commit()
+
+def reconcile(grace=3600):
+    # Brings the index in line with the disk: legacy files are moved into
+    # blob storage, rows whose blob is gone are dropped, and blobs and temp
+    # files no row refers to are removed once older than grace seconds (so
+    # uploads in flight are left alone). Returns what was done.
+    import time
+    from caching import invalidate
+    from models import Club, File
+    stats = {'imported': 0, 'missing': 0, 'orphaned': 0}
+    codes = set()
+    upload_folder = app.config.get('UPLOAD_FOLDER')
+    for code in sorted(os.listdir(upload_folder)) if os.path.isdir(upload_folder) else []:
+        club = Club.query.filter_by(code=code).first()
+        if club is None:
+            continue
+        for filename in sorted(os.listdir(os.path.join(upload_folder, code))):
+            path = legacy_path(code, filename)
+            if not os.path.isfile(path) or find_file(club, filename):
+                continue
+            mtime = datetime.datetime.utcfromtimestamp(os.path.getmtime(path))
+            with open(path, 'rb') as f:
+                store(club, filename, f, mtime=mtime)
+            stats['imported'] += 1
+            codes.add(code)
+    missing = [file for file in File.query if not os.path.exists(file.path)]
+    if missing:
+        codes.update(club.code for file in missing for club in file.club)
+        delete(missing)
+        stats['missing'] = len(missing)
+    digests = {digest for digest, in db.session.query(File.digest).distinct()}
+    cutoff = time.time() - grace
+    for folder, _, names in os.walk(app.config.get('BLOB_FOLDER')):
+        for name in names:
+            path = os.path.join(folder, name)
+            in_use = name in digests and os.path.basename(folder) != 'tmp'
+            if not in_use and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                stats['orphaned'] += 1
+    if codes:
+        invalidate(*['files:' + code for code in codes])
+    return stats
+
+if __name__ == '__main__':
+    print('{imported} files imported, {missing} missing files dropped, {orphaned} orphaned blobs removed'
+          .format(**reconcile()))
@@ -0,0 +1,143 @@
+import threading
+
+# In-memory tag -> clubs index for tag filters and facet counts. Each tag's
+# clubs are a bitmap held in a Python int (bit n set = club n has the tag),
+# so intersections, unions and counts are a few machine-word operations
+# per 64 clubs. Every worker loads it from tag_to_club on first use and then
+# applies the rows tag_change has gained since, whenever the 'tags' cache
+# tag moves.
+
+try:
+    popcount = int.bit_count
+except AttributeError:
+    def popcount(bits):
+        return bin(bits).count('1')
+
+def bitmap(ids):
+    ids = list(ids)
+    if not ids:
+        return 0
+    data = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(data, 'little')
+
+def members(bits, after=None, limit=None):
+    # Set bits of the bitmap in increasing order, past `after` if given.
+    start = 0
+    if after is not None:
+        start = max(after + 1, 0)
+        bits >>= start
+    ids = []
+    if limit is not None:
+        while bits and len(ids) < limit:
+            low = bits & -bits
+            position = low.bit_length() - 1
+            ids.append(start + position)
+            bits >>= position + 1
+            start += position + 1
+        return ids
+    text = bin(bits)[:1:-1]
+    position = text.find('1')
+    while position != -1:
+        ids.append(start + position)
+        position = text.find('1', position + 1)
+    return ids
+
+class TagIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bitmaps = None
+        self.names = {}
+        self._last_seq = 0
+        self._version = None
+
+    def load(self, tags, links):
+        # tags: (id, name) pairs; links: (club_id, tag_id) pairs.
+        self.names = {name: tag_id for tag_id, name in tags}
+        clubs = {}
+        for club_id, tag_id in links:
+            clubs.setdefault(tag_id, []).append(club_id)
+        self.bitmaps = {tag_id: bitmap(clubs.get(tag_id, [])) for tag_id, _ in tags}
+
+    def apply(self, changes):
+        # changes: (club_id, tag_id, added) in seq order; the last change to
+        # each link wins.
+        final = {}
+        for club_id, tag_id, added in changes:
+            final[club_id, tag_id] = added
+        by_tag = {}
+        for (club_id, tag_id), added in final.items():
+            by_tag.setdefault(tag_id, ([], []))[0 if added else 1].append(club_id)
+        for tag_id, (added, removed) in by_tag.items():
+            self.bitmaps[tag_id] = (self.bitmaps.get(tag_id, 0) | bitmap(added)) & ~bitmap(removed)
+
+    def refresh(self):
+        from sqlalchemy import func
+        from app import db
+        from caching import tag_versions
+        from models import Tag, TagChange, tag_to_club
+        version = tag_versions(['tags'])[0]
+        with self._lock:
+            if self.bitmaps is not None and version == self._version:
+                return
+            first = db.session.query(func.min(TagChange.seq)).scalar()
+            if self.bitmaps is None or (first is not None and first > self._last_seq + 1):
+                self._last_seq = db.session.query(func.coalesce(func.max(TagChange.seq), 0)).scalar()
+                self.load(db.session.query(Tag.id, Tag.name).all(),
+                          db.session.query(tag_to_club.c.club_id, tag_to_club.c.tag_id).all())
+            else:
+                self.names = {name: tag_id for tag_id, name in db.session.query(Tag.id, Tag.name)}
+            changes = db.session.query(TagChange.seq, TagChange.club_id, TagChange.tag_id, TagChange.added) \
+                .filter(TagChange.seq > self._last_seq).order_by(TagChange.seq).all()
+            if changes:
+                self.apply((club_id, tag_id, added) for _, club_id, tag_id, added in changes)
+                self._last_seq = changes[-1][0]
+            self._version = version
+
+    def select(self, names, match='all'):
+        # Bitmap of the clubs with all (or any) of the named tags. Unknown
+        # names match no club.
+        with self._lock:
+            bitmaps = [self.bitmaps.get(self.names.get(name), 0) for name in names]
+        if not bitmaps:
+            return None
+        selected = bitmaps[0]
+        for bits in bitmaps[1:]:
+            selected = selected & bits if match == 'all' else selected | bits
+        return selected
+
+    def facets(self, selected=None, exclude=()):
+        # Number of clubs in `selected` (every club if None) under each tag.
+        with self._lock:
+            tags = [(name, tag_id, self.bitmaps.get(tag_id, 0)) for name, tag_id in self.names.items()]
+        counts = {}
+        for name, tag_id, bits in tags:
+            if name in exclude:
+                continue
+            count = popcount(bits if selected is None else bits & selected)
+            if count:
+                counts[name] = (tag_id, count)
+        return counts
+
+tag_index = TagIndex()
+
+def parse_tags(args):
+    # Tag names from ?tags=a,b&tags=c and the match mode, or None if the
+    # mode is invalid.
+    names = [name.strip() for value in args.getlist('tags') for name in value.split(',') if name.strip()]
+    match = args.get('match', 'all')
+    if match not in ('all', 'any'):
+        return None
+    return list(dict.fromkeys(names)), match
+
+def filter_clubs(clubs, names, match, after=None, limit=None):
+    # Restricts a Club query to the clubs selected by the tags. With a limit,
+    # only the first `limit` ids past `after` are passed on.
+    from sqlalchemy import bindparam, text
+    from flask import json
+    from models import Club
+    tag_index.refresh()
+    ids = members(tag_index.select(names, match), after, limit)
+    return clubs.filter(Club.id.in_(text('SELECT value FROM json_each(:tag_club_ids)')
+                                    .bindparams(bindparam('tag_club_ids', json.dumps(ids)))))
@@ -0,0 +1,61 @@
+import pytest
+import uuid
+from collections import namedtuple
+from sqlalchemy import event
+
+from app import app, db
+
+# Shared by the test modules. Names built from RUN are unique to this run, so
+# the tests can share a database with earlier runs. Test modules sorting
+# before test_club must not create clubs (it drops every table and counts
+# the clubs it adds), and nothing may be signed up at import time.
+
+RUN = uuid.uuid4().hex[:8]
+
+client = app.test_client()
+
+Account = namedtuple('Account', ['username', 'headers'])
+
+def signup(name):
+    # Signs up <name>-<RUN> with the password 'password' if need be, and
+    # logs in.
+    username = '{}-{}'.format(name, RUN)
+    request = {'username': username, 'password': 'password', 'email': username + '@seas.upenn.edu'}
+    client.post('/api/signup', json=request)
+    response = client.post('/api/login', json=request)
+    return Account(username, {'auth_token': response.get_json()['auth_token']})
+
+@pytest.fixture(scope='module')
+def account(request):
+    # A user for the module, named after it: test_storage.py gets
+    # storage-<RUN>.
+    return signup(request.module.__name__.rsplit('.', 1)[-1][len('test_'):].replace('_', '-'))
+
+class Queries:
+    # SQL statements (and their parameters) run while inside `with queries:`.
+    def __init__(self):
+        self.statements = []
+        self.parameters = []
+
+    def _record(self, conn, cursor, statement, parameters, *args):
+        self.statements.append(statement)
+        self.parameters.append(parameters)
+
+    def __enter__(self):
+        self.statements = []
+        self.parameters = []
+        event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self.statements
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    def count(self, f):
+        # f's result and the number of statements it ran.
+        with self as statements:
+            result = f()
+        return result, len(statements)
+
+@pytest.fixture
+def queries():
+    return Queries()
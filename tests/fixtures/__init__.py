@@ -0,0 +1,18 @@
+import functools
+import http.server
+import os
+import threading
+
+FIXTURES = os.path.dirname(os.path.abspath(__file__))
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def serve():
+    # Serves this directory on a free local port in place of the real
+    # sites and returns its base URL.
+    handler = functools.partial(QuietHandler, directory=FIXTURES)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}/'.format(server.server_address[1])
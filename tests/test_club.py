@@ -6,6 +6,8 @@ db.create_all()
 client = app.test_client()
 
 import scraper
+from tests.fixtures import serve
+app.config['SCRAPER_SOURCES'] = {'ocwp': serve() + 'ocwp.html'}
 scraper.main()
 
 def get_auth_token():
@@ -0,0 +1,54 @@
+import pytest
+
+from app import app, db
+from tests.conftest import RUN
+db.create_all()
+client = app.test_client()
+
+CODE = 'comments-' + RUN
+
+def comment(account, content, parent=None):
+    path = '/api/clubs/{}/comments/'.format(CODE)
+    if parent is not None:
+        path += str(parent)
+    response = client.post(path, json={'content': content}, headers=account.headers)
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+def test_threaded_comments(account):
+    request = {'name': 'Comments ' + RUN, 'code': CODE, 'tags': []}
+    assert client.post('/api/clubs/', json=request, headers=account.headers).status_code == 201
+    first = comment(account, 'First')
+    reply = comment(account, 'Reply', first)
+    nested = comment(account, 'Nested', reply)
+    second = comment(account, 'Second')
+    thread = client.get('/api/clubs/{}/comments/'.format(CODE), query_string={'threaded': 1}).get_json()
+    assert [node['id'] for node in thread] == [first, second]
+    assert thread[0]['replies'][0]['id'] == reply
+    assert thread[0]['replies'][0]['replies'][0]['content'] == 'Nested'
+    assert thread[0]['replies'][0]['replies'][0]['user'] == account.username
+    subtree = client.get('/api/clubs/{}/comments/{}/thread'.format(CODE, reply)).get_json()
+    assert subtree['id'] == reply and subtree['replies'][0]['id'] == nested
+    shallow = client.get('/api/clubs/{}/comments/{}/thread'.format(CODE, first),
+                         query_string={'depth': 1}).get_json()
+    assert shallow['replies'][0]['replies'] == []
+    flat = client.get('/api/clubs/{}/comments/'.format(CODE)).get_json()
+    assert [item['id'] for item in flat] == [first, reply, nested, second]
+    assert client.get('/api/clubs/{}/comments/999999/thread'.format(CODE)).status_code == 404
+
+def test_thread_query_count_is_constant(account, queries):
+    from models import Club
+    from utils import jsonify_thread
+    club = Club.query.filter_by(code=CODE).first()
+    _, small = queries.count(lambda: jsonify_thread(club))
+    parent = None
+    for i in range(30):
+        if parent is not None:
+            comment(account, 'Sibling {}'.format(i), parent)
+        parent = comment(account, 'Deep {}'.format(i), parent)
+    thread, large = queries.count(lambda: jsonify_thread(club))
+    assert large == small == 1
+    node, depth = thread[-1], 0
+    while node['replies']:
+        node, depth = node['replies'][-1], depth + 1
+    assert depth == 29
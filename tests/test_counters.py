@@ -0,0 +1,50 @@
+import pytest
+from sqlalchemy import text
+
+from app import app, db
+from counters import repair_counters
+from models import Club, Tag
+from tests.conftest import RUN, signup
+db.create_all()
+client = app.test_client()
+
+CODE = 'counters-' + RUN
+
+def club():
+    db.session.expire_all()
+    return client.get('/api/clubs/{}/'.format(CODE)).get_json()
+
+def stored(club_id):
+    return db.session.execute(text('SELECT membership_count, favorite_count FROM club WHERE id = :id'),
+                              {'id': club_id}).fetchone()
+
+def test_counters_follow_every_change(account):
+    owner, member = account.headers, signup('counters-member')
+    request = {'name': 'Counters ' + RUN, 'code': CODE, 'tags': [{'name': 'Counters ' + RUN}]}
+    assert client.post('/api/clubs/', json=request, headers=owner).status_code == 201
+    data = club()
+    assert (data['membership_count'], data['favorite_count'], data['tags'][0]['clubs']) == (1, 0, 1)
+    client.post('/api/clubs/{}/members/'.format(CODE), json={'username': member.username}, headers=owner)
+    client.post('/api/favorites/', json={'code': CODE}, headers=owner)
+    client.post('/api/favorites/', json={'code': CODE}, headers=member.headers)
+    assert client.post('/api/favorites/', json={'code': CODE}, headers=member.headers).status_code == 409
+    data = club()
+    assert (data['membership_count'], data['favorite_count']) == (2, 2)
+    client.delete('/api/favorites/' + CODE, headers=owner)
+    client.delete('/api/clubs/{}/members/{}'.format(CODE, member.username), headers=owner)
+    assert stored(data['id']) == (1, 1)
+    request = {'code': CODE, 'tags': [{'name': 'Counters other ' + RUN}]}
+    assert client.put('/api/clubs/{}/'.format(CODE), json=request, headers=owner).status_code == 201
+    assert Tag.query.filter_by(name='Counters ' + RUN).first().club_count == 0
+    assert Tag.query.filter_by(name='Counters other ' + RUN).first().club_count == 1
+    listed = client.get('/api/clubs/', query_string={'search': 'counters ' + RUN}).get_json()
+    assert (listed[0]['membership_count'], listed[0]['favorite_count']) == (1, 1)
+
+def test_repair_counters():
+    club_id = Club.query.filter_by(code=CODE).first().id
+    db.session.execute(text('UPDATE club SET membership_count = 40, favorite_count = 2 WHERE id = :id'),
+                       {'id': club_id})
+    db.session.commit()
+    assert repair_counters() == 2
+    assert stored(club_id) == (1, 1)
+    assert repair_counters() == 0
@@ -0,0 +1,63 @@
+import pytest
+import threading
+import time
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from database import write
+from models import CacheTag
+from tests.conftest import RUN
+db.create_all()
+
+def test_pragmas_applied_to_every_connection():
+    with db.engine.connect() as connection:
+        assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 1
+        assert connection.exec_driver_sql('PRAGMA cache_size').scalar() == app.config['SQLITE_PRAGMAS']['cache_size']
+
+def insert(name):
+    return lambda connection: connection.execute(CacheTag.__table__.insert().values(name=name, seq=0))
+
+def test_queued_writes_share_one_commit():
+    commits = []
+    def on_commit(connection):
+        commits.append(connection)
+    event.listen(db.engine, 'commit', on_commit)
+    started, release = threading.Event(), threading.Event()
+    def blocker(connection):
+        started.set()
+        release.wait(5)
+    try:
+        threads = [threading.Thread(target=write, args=(blocker,))]
+        threads[0].start()
+        started.wait(5)
+        names = ['group-{}-{}'.format(RUN, i) for i in range(20)]
+        errors = []
+        def duplicate():
+            try:
+                write(insert(names[0]))
+            except IntegrityError as e:
+                errors.append(e)
+        threads += [threading.Thread(target=write, args=(insert(name),)) for name in names]
+        threads.append(threading.Thread(target=duplicate))
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+    finally:
+        event.remove(db.engine, 'commit', on_commit)
+    assert len(commits) == 2
+    assert len(errors) == 1
+    assert CacheTag.query.filter(CacheTag.name.like('group-{}-%'.format(RUN))).count() == 20
+
+def test_failed_write_raises_and_is_rolled_back():
+    def fails(connection):
+        insert('failed-' + RUN)(connection)
+        raise ValueError('Nope')
+    with pytest.raises(ValueError):
+        write(fails)
+    assert CacheTag.query.filter_by(name='failed-' + RUN).first() is None
+    assert write(lambda connection: connection.execute(text('SELECT 42')).scalar()) == 42
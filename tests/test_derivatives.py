@@ -0,0 +1,138 @@
+import pytest
+import io
+import os
+import time
+
+from app import app, db
+import derivatives
+from models import File
+from tests.conftest import RUN
+db.create_all()
+client = app.test_client()
+
+Image = pytest.importorskip('PIL.Image')
+
+CODE = 'derivatives-' + RUN
+HEADERS = {}
+
+@pytest.fixture(scope='module', autouse=True)
+def club(account):
+    HEADERS.update(account.headers)
+    client.post('/api/clubs/', json={'name': CODE, 'code': CODE, 'tags': []}, headers=HEADERS)
+
+@pytest.fixture(autouse=True)
+def folders(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'BLOB_FOLDER', str(tmp_path / 'blobs'))
+    monkeypatch.setitem(app.config, 'DERIVATIVE_FOLDER', str(tmp_path / 'derivatives'))
+    monkeypatch.setattr(derivatives, '_cache_bytes', None)
+    return tmp_path
+
+def image(width, height, image_format='PNG', color=(200, 30, 30)):
+    data = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(data, image_format)
+    return data.getvalue()
+
+def upload(filename, content, method='post'):
+    path = '/api/clubs/{}/files'.format(CODE)
+    if method == 'put':
+        path += '/' + filename
+    response = getattr(client, method)(path, data={'file': (io.BytesIO(content), filename)},
+                                       headers=HEADERS, content_type='multipart/form-data')
+    assert response.status_code == 201
+
+def derivative_files(folders):
+    return sorted(name for _, _, names in os.walk(str(folders / 'derivatives')) for name in names)
+
+def wait_for(f):
+    deadline = time.time() + 10
+    while not f():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+def test_upload_renders_every_size(folders):
+    upload('poster.jpg', image(1600, 900, 'JPEG'))
+    wait_for(lambda: len(derivative_files(folders)) == len(app.config['IMAGE_SIZES']))
+    path = '/api/clubs/{}/files/poster.jpg'.format(CODE)
+    for size, dimension in app.config['IMAGE_SIZES'].items():
+        response = client.get(path, query_string={'size': size})
+        assert response.status_code == 200 and response.mimetype == 'image/jpeg'
+        assert Image.open(io.BytesIO(response.data)).size == (dimension, dimension * 900 // 1600)
+        assert client.get(path, query_string={'size': size},
+                          headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get(path, query_string={'size': 'huge'}).status_code == 400
+    assert Image.open(io.BytesIO(client.get(path).data)).size == (1600, 900)
+
+def test_on_demand_and_replace(folders, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMAGE_WORKERS', 0)
+    upload('logo.gif', image(400, 400, 'GIF'))
+    assert derivative_files(folders) == []
+    path = '/api/clubs/{}/files/logo.gif'.format(CODE)
+    response = client.get(path, query_string={'size': 'thumb'})
+    assert response.mimetype == 'image/png' and Image.open(io.BytesIO(response.data)).size == (128, 128)
+    assert len(derivative_files(folders)) == 1
+    upload('logo.gif', image(200, 100, 'GIF'), 'put')
+    response = client.get(path, query_string={'size': 'thumb'})
+    assert Image.open(io.BytesIO(response.data)).size == (128, 64)
+    text = client.post('/api/clubs/{}/files'.format(CODE), data={'file': (io.BytesIO(b'Notes'), 'notes.txt')},
+                       headers=HEADERS, content_type='multipart/form-data')
+    assert text.status_code == 201
+    assert client.get('/api/clubs/{}/files/notes.txt'.format(CODE), query_string={'size': 'thumb'}).data == b'Notes'
+
+def test_undecodable_image_serves_the_original(folders, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMAGE_WORKERS', 0)
+    renders = []
+    render = derivatives.render
+    monkeypatch.setattr(derivatives, 'render', lambda *args: renders.append(args) or render(*args))
+    upload('flyer.png', b'Not an image ' + RUN.encode())
+    path = '/api/clubs/{}/files/flyer.png'.format(CODE)
+    for _ in range(2):
+        response = client.get(path, query_string={'size': 'thumb'})
+        assert response.status_code == 200 and response.data == b'Not an image ' + RUN.encode()
+    # The failure is remembered rather than tried on every request.
+    assert len(renders) == 1
+    assert derivative_files(folders) == []
+
+def test_cache_is_trimmed_least_recently_used_first(folders, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMAGE_WORKERS', 0)
+    names = ['trim{}.png'.format(i) for i in range(3)]
+    for i, name in enumerate(names):
+        upload(name, image(300, 300, color=(i, 100, 100)))
+    paths = []
+    for name in names:
+        client.get('/api/clubs/{}/files/{}'.format(CODE, name), query_string={'size': 'small'})
+        digest = File.query.filter(File.name == name, File.path.contains(folders.name)).first().digest
+        paths.append(derivatives.derivative_path(digest, 'small', 'image/png'))
+    for i, path in enumerate(paths):
+        os.utime(path, (1000 + i, 1000 + i))
+    client.get('/api/clubs/{}/files/trim0.png'.format(CODE), query_string={'size': 'small'})
+    size = os.path.getsize(paths[1])
+    monkeypatch.setitem(app.config, 'DERIVATIVE_MAX_BYTES', sum(map(os.path.getsize, paths)) - size // 2)
+    client.get('/api/clubs/{}/files/trim0.png'.format(CODE), query_string={'size': 'thumb'})
+    assert os.path.exists(paths[0]) and not os.path.exists(paths[1])
+
+def test_derivative_trimmed_before_it_is_sent(folders, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMAGE_WORKERS', 0)
+    upload('race.png', image(300, 300))
+    path = '/api/clubs/{}/files/race.png'.format(CODE)
+    assert client.get(path, query_string={'size': 'thumb'}).status_code == 200
+    get = derivatives.get
+    trimmed = []
+
+    def get_then_trim(file, size):
+        # A trim on another thread removes the derivative just after get().
+        found = get(file, size)
+        os.remove(found)
+        trimmed.append(found)
+        return found
+
+    monkeypatch.setattr(derivatives, 'get', get_then_trim)
+    response = client.get(path, query_string={'size': 'thumb'})
+    assert response.status_code == 200 and len(trimmed) == 2
+    assert Image.open(io.BytesIO(response.data)).size == (300, 300)
+    # Trimmed once: made again.
+    trimmed.clear()
+    monkeypatch.setattr(derivatives, 'get', lambda file, size: get_then_trim(file, size) if not trimmed
+                        else get(file, size))
+    response = client.get(path, query_string={'size': 'thumb'})
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.data)).size == (128, 128)
@@ -0,0 +1,51 @@
+import pytest
+import io
+import json
+
+from app import app, db
+from importer import import_clubs, import_file, iter_json_array
+from models import Club, User
+from tests.conftest import RUN
+db.create_all()
+client = app.test_client()
+
+def catalog(count):
+    return [{'code': 'import-{}-{}'.format(RUN, i), 'name': 'Import {} {}'.format(RUN, i),
+             'description': 'Imported club {}'.format(i), 'tags': ['Import ' + RUN, 'Import {} {}'.format(RUN, i % 4)]}
+            for i in range(count)]
+
+def test_iter_json_array_across_chunks():
+    data = catalog(20) + [{'code': 'x', 'name': 'Weird ] [ , "quoted"', 'tags': [], 'number': 12345}]
+    text = json.dumps(data, indent=2)
+    for chunk_size in (1, 7, 64, 1 << 16):
+        assert list(iter_json_array(io.StringIO(text), chunk_size)) == data
+    assert list(iter_json_array(io.StringIO('[]'))) == []
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO('{}')))
+
+def test_import_is_idempotent(tmp_path):
+    owner = User(username='import-' + RUN, email='import-{}@seas.upenn.edu'.format(RUN), password=b'')
+    db.session.add(owner)
+    db.session.commit()
+    path = tmp_path / 'clubs.json'
+    path.write_text(json.dumps(catalog(25)))
+    stats = import_file(str(path), owner=owner.username, batch_size=10)
+    assert (stats['entries'], stats['inserted'], stats['updated'], stats['tags']) == (25, 25, 0, 5)
+    assert stats['links'] == 50 and stats['members'] == 25
+    club = Club.query.filter_by(code='import-{}-5'.format(RUN)).first()
+    assert club.owner == owner.username and owner in club.members
+    assert sorted(tag.name for tag in club.tags) == ['Import ' + RUN, 'Import {} 1'.format(RUN)]
+    stats = import_file(str(path), owner=owner.username, batch_size=10)
+    assert (stats['inserted'], stats['updated'], stats['tags'], stats['links'], stats['members']) == (0, 0, 0, 0, 0)
+
+def test_import_applies_changes():
+    entries = catalog(25)
+    entries[3]['description'] = 'Changed'
+    entries[4]['tags'] = ['Import ' + RUN]
+    stats = import_clubs(entries, batch_size=10)
+    assert (stats['inserted'], stats['updated'], stats['links']) == (0, 1, 1)
+    db.session.expire_all()
+    assert Club.query.filter_by(code='import-{}-3'.format(RUN)).first().description == 'Changed'
+    assert len(Club.query.filter_by(code='import-{}-4'.format(RUN)).first().tags) == 1
+    response = client.get('/api/clubs/', query_string={'search': 'changed ' + RUN})
+    assert [club['code'] for club in response.get_json()] == ['import-{}-3'.format(RUN)]
@@ -0,0 +1,81 @@
+import pytest
+from sqlalchemy import event
+
+from app import app, db
+from models import Club
+from tests.conftest import RUN, signup
+db.create_all()
+client = app.test_client()
+
+CODE = 'batch-' + RUN
+NAMES = ['batch-{}-{}'.format(i, RUN) for i in range(5)]
+OWNER = {}
+
+def setup_module():
+    OWNER.update(signup('batch').headers)
+    for i in range(len(NAMES)):
+        signup('batch-{}'.format(i))
+    for code in (CODE, CODE + '-other'):
+        request = {'name': code, 'code': code, 'tags': []}
+        assert client.post('/api/clubs/', json=request, headers=OWNER).status_code == 201
+
+def statuses(results):
+    return [(result.get('username') or result.get('code'), result['status_code']) for result in results]
+
+def members():
+    return sorted(user['username'] for user in client.get('/api/clubs/{}/members/'.format(CODE)).get_json())
+
+def test_batch_members():
+    response = client.post('/api/clubs/{}/members/batch'.format(CODE), headers=OWNER,
+                           json={'add': NAMES[:3] + ['nobody-' + RUN, 'batch-' + RUN]})
+    assert response.status_code == 200
+    assert statuses(response.get_json()['added']) == [(NAMES[0], 201), (NAMES[1], 201), (NAMES[2], 201),
+                                                     ('nobody-' + RUN, 404), ('batch-' + RUN, 409)]
+    assert members() == sorted(NAMES[:3] + ['batch-' + RUN])
+    response = client.post('/api/clubs/{}/members/batch'.format(CODE), headers=OWNER,
+                           json={'add': NAMES[3:], 'remove': [NAMES[0], NAMES[4] + 'x', 'batch-' + RUN]})
+    data = response.get_json()
+    assert statuses(data['added']) == [(NAMES[3], 201), (NAMES[4], 201)]
+    assert statuses(data['removed']) == [(NAMES[0], 200), (NAMES[4] + 'x', 404), ('batch-' + RUN, 409)]
+    assert members() == sorted(NAMES[1:] + ['batch-' + RUN])
+    assert client.get('/api/clubs/{}/'.format(CODE)).get_json()['membership_count'] == 5
+
+def test_batch_members_checks_the_request():
+    url = '/api/clubs/{}/members/batch'.format(CODE)
+    member = signup('batch-1').headers
+    assert client.post(url, headers=member, json={'add': [NAMES[0]]}).status_code == 403
+    assert client.post(url, headers=OWNER, json={'add': 'someone'}).status_code == 400
+    assert client.post(url, headers=OWNER, json={'add': [NAMES[0]], 'remove': [NAMES[0]]}).status_code == 400
+    assert client.post(url, headers=OWNER, json={'add': ['x{}'.format(i) for i in range(1001)]}).status_code == 400
+
+def test_batch_favorites_in_one_transaction():
+    user = signup('batch-0').headers
+    commits = []
+    listener = lambda conn: commits.append(conn)
+    event.listen(db.engine, 'commit', listener)
+    try:
+        response = client.post('/api/favorites/batch', headers=user,
+                               json={'add': [CODE, CODE + '-other', 'missing-' + RUN]})
+    finally:
+        event.remove(db.engine, 'commit', listener)
+    assert statuses(response.get_json()['added']) == [(CODE, 201), (CODE + '-other', 201), ('missing-' + RUN, 404)]
+    # The request's read transactions aside, the writes share one commit.
+    assert len(commits) <= 3
+    favorites = client.get('/api/favorites/', headers=user).get_json()
+    assert sorted(club['code'] for club in favorites) == [CODE, CODE + '-other']
+    response = client.post('/api/favorites/batch', headers=user, json={'add': [CODE], 'remove': [CODE + '-other']})
+    data = response.get_json()
+    assert statuses(data['added']) == [(CODE, 409)]
+    assert statuses(data['removed']) == [(CODE + '-other', 200)]
+    assert [club['code'] for club in client.get('/api/favorites/', headers=user).get_json()] == [CODE]
+    assert client.get('/api/clubs/{}/'.format(CODE)).get_json()['favorite_count'] == 1
+
+def test_batch_lookup():
+    codes = [CODE, 'missing-' + RUN, CODE + '-other']
+    for response in (client.get('/api/clubs/batch', query_string={'codes': ','.join(codes)}),
+                     client.post('/api/clubs/batch', json={'codes': codes})):
+        assert response.status_code == 200
+        results = response.get_json()['clubs']
+        assert statuses(results) == [(CODE, 200), ('missing-' + RUN, 404), (CODE + '-other', 200)]
+        assert results[0]['club']['name'] == CODE and 'club' not in results[1]
+    assert client.post('/api/clubs/batch', json={'codes': [1, 2]}).status_code == 400
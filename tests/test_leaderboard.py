@@ -0,0 +1,100 @@
+import pytest
+import math
+from sqlalchemy import text
+
+from app import app, db
+from counters import repair_trending
+from models import Club, TRENDING_EPOCH, TRENDING_HALF_LIFE
+from tests.conftest import RUN, signup
+db.create_all()
+client = app.test_client()
+
+TAG = 'Leaderboard ' + RUN
+USERS = []
+
+def code(i):
+    return 'leaderboard-{}-{}'.format(RUN, i)
+
+def setup_module():
+    USERS.extend(signup('leaderboard-{}'.format(i)).headers for i in range(3))
+    for i in range(4):
+        request = {'name': 'Leaderboard {} {}'.format(RUN, i), 'code': code(i), 'tags': [{'name': TAG}]}
+        assert client.post('/api/clubs/', json=request, headers=USERS[0]).status_code == 201
+    # The owner's membership counts too, so move every club to the same start.
+    for i in range(4):
+        trending = Club.query.filter_by(code=code(0)).first().trending
+        db.session.execute(text('UPDATE club SET trending = :trending WHERE code = :code'),
+                           {'trending': trending, 'code': code(i)})
+    db.session.commit()
+
+def listed(sort, **query):
+    response = client.get('/api/clubs/', query_string=dict(query, sort=sort, tags=TAG))
+    assert response.status_code == 200
+    return [int(club['code'].rsplit('-', 1)[1]) for club in response.get_json()], response
+
+def favorite(user, i):
+    assert client.post('/api/favorites/', json={'code': code(i)}, headers=USERS[user]).status_code == 201
+
+def test_sorted_listings():
+    favorite(0, 1)
+    favorite(1, 1)
+    favorite(2, 1)
+    favorite(0, 2)
+    favorite(1, 2)
+    favorite(0, 3)
+    assert listed('popular')[0] == [1, 2, 3, 0]
+    assert listed('trending')[0] == [1, 2, 3, 0]
+    assert client.delete('/api/favorites/' + code(1), headers=USERS[0]).status_code == 200
+    assert client.delete('/api/favorites/' + code(1), headers=USERS[1]).status_code == 200
+    assert listed('popular')[0] == [2, 3, 1, 0]
+    assert listed('trending')[0] == [2, 3, 1, 0]
+    assert client.get('/api/clubs/', query_string={'sort': 'newest'}).status_code == 400
+
+def test_sorted_pages():
+    pages, query = [], {'limit': 3}
+    while True:
+        page, response = listed('popular', **query)
+        pages += page
+        if 'X-Next-Cursor' not in response.headers:
+            break
+        query['cursor'] = response.headers['X-Next-Cursor']
+    assert pages == listed('popular')[0]
+    assert client.get('/api/clubs/', query_string={'sort': 'popular', 'cursor': 10 ** 9}).status_code == 400
+
+def test_newer_events_outweigh_older_ones():
+    old, new = (Club.query.filter_by(code=code(i)).first().id for i in (0, 3))
+    now = TRENDING_EPOCH + 400 * 86400
+    db.session.execute(text('UPDATE club SET trending = -9e999 WHERE id IN (:old, :new)'), {'old': old, 'new': new})
+    for club_id, age in ((old, 2 * TRENDING_HALF_LIFE), (old, 2 * TRENDING_HALF_LIFE), (new, 0)):
+        db.session.execute(text("INSERT INTO club_event (club_id, user_id, kind, added, time) "
+                                "VALUES (:club_id, 0, 'favorite', 1, :time)"), {'club_id': club_id, 'time': now - age})
+    db.session.commit()
+    db.session.execute(text("INSERT INTO club_event (club_id, user_id, kind, added, time) "
+                            "VALUES (:club_id, 0, 'favorite', 1, :time)"), {'club_id': old, 'time': now - 400})
+    db.session.execute(text("INSERT INTO club_event (club_id, user_id, kind, added, time) "
+                            "VALUES (:club_id, 0, 'favorite', 0, :time)"), {'club_id': old, 'time': now})
+    db.session.commit()
+    scores = dict(db.session.execute(text('SELECT id, trending FROM club WHERE id IN (:old, :new)'),
+                                     {'old': old, 'new': new}).fetchall())
+    # Two favorites two half-lives old count half as much as one now.
+    x = (now - TRENDING_EPOCH) / TRENDING_HALF_LIFE
+    assert scores[old] == pytest.approx(x - 1)
+    assert scores[new] == pytest.approx(x)
+
+def test_repair_trending():
+    # The events inserted above have no favorites behind them.
+    assert repair_trending() >= 2
+    assert repair_trending() == 0
+    assert listed('trending')[0] == [2, 3, 1, 0]
+
+def test_old_events_are_pruned():
+    from models import ClubEvent, TRENDING_HORIZON
+    club_id = Club.query.filter_by(code=code(0)).first().id
+    latest = db.session.query(db.func.max(ClubEvent.time)).scalar()
+    # Logged against a club that doesn't exist, so no score moves.
+    db.session.add(ClubEvent(club_id=-1, user_id=-1, kind='favorite', added=False, time=latest - TRENDING_HORIZON - 60))
+    db.session.commit()
+    assert ClubEvent.query.filter_by(club_id=-1).count() == 1
+    favorite(2, 0)
+    assert ClubEvent.query.filter_by(club_id=-1).count() == 0
+    assert ClubEvent.query.filter_by(club_id=club_id, kind='favorite').count() == 1
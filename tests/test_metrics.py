@@ -0,0 +1,93 @@
+import pytest
+import json
+import os
+import re
+import subprocess
+import sys
+
+from app import app, db
+import metrics
+from tests.conftest import RUN
+db.create_all()
+client = app.test_client()
+
+@pytest.fixture(autouse=True)
+def folders(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_FOLDER', str(tmp_path / 'metrics'))
+    monkeypatch.setitem(app.config, 'PROFILE_FOLDER', str(tmp_path / 'profiles'))
+    return tmp_path
+
+def scrape():
+    response = client.get('/api/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    values = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+def value(values, name, **labels):
+    order = ['route', 'method', 'status', 'phase', 'le']
+    labels = ','.join('{}="{}"'.format(key, labels[key]) for key in sorted(labels, key=order.index))
+    return values.get('clubreview_{}{{{}}}'.format(name, labels), 0)
+
+def test_requests_are_recorded_per_route():
+    before = scrape()
+    for _ in range(3):
+        assert client.get('/api/tags/').status_code == 200
+    assert client.get('/api/no-such-route-' + RUN).status_code == 404
+    after = scrape()
+    route = {'route': '/api/tags/', 'method': 'GET'}
+    assert value(after, 'requests_total', status=200, **route) - value(before, 'requests_total', status=200, **route) == 3
+    assert value(after, 'request_duration_seconds_count', **route) - value(before, 'request_duration_seconds_count', **route) == 3
+    assert value(after, 'request_duration_seconds_bucket', le='+Inf', **route) == \
+        value(after, 'request_duration_seconds_count', **route)
+    hits = value(after, 'cache_hits_total', **route) - value(before, 'cache_hits_total', **route)
+    misses = value(after, 'cache_misses_total', **route) - value(before, 'cache_misses_total', **route)
+    assert hits + misses == 3 and hits >= 2
+    assert value(after, 'response_bytes_total', **route) > value(before, 'response_bytes_total', **route)
+    assert value(after, 'phase_seconds_total', phase='json', **route) > 0
+    assert value(after, 'requests_total', route='unmatched', method='GET', status=404) >= 1
+
+def test_sql_and_bcrypt_are_timed():
+    request = {'username': 'metrics-' + RUN, 'password': 'password', 'email': 'metrics-{}@seas.upenn.edu'.format(RUN)}
+    client.post('/api/signup', json=request)
+    assert client.post('/api/login', json=request).status_code == 200
+    values = scrape()
+    route = {'route': '/api/login', 'method': 'POST'}
+    assert value(values, 'sql_statements_total', **route) >= 1
+    assert value(values, 'sql_seconds_total', **route) > 0
+    assert value(values, 'phase_seconds_total', phase='bcrypt', **route) > 0
+
+def test_workers_are_added_up(folders):
+    scrape()
+    other = {'requests': [['/api/tags/', 'GET', 200, 1000]],
+             'routes': [['/api/tags/', 'GET', dict(metrics.empty_route(), count=1000, statements=5000)]]}
+    # The parent (pytest's) process is alive; a finished child is not.
+    with open(str(folders / 'metrics' / '{}.json'.format(os.getppid())), 'w') as f:
+        json.dump(other, f)
+    child = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], stdout=subprocess.PIPE)
+    dead = folders / 'metrics' / '{}.json'.format(int(child.stdout))
+    with open(str(dead), 'w') as f:
+        json.dump(other, f)
+    values = scrape()
+    assert value(values, 'requests_total', route='/api/tags/', method='GET', status=200) >= 1000
+    assert value(values, 'requests_total', route='/api/tags/', method='GET', status=200) < 2000
+    assert value(values, 'sql_statements_total', route='/api/tags/', method='GET') >= 5000
+    assert not dead.exists()
+
+def test_profiler_writes_stacks_of_slow_requests(folders, monkeypatch):
+    monkeypatch.setitem(app.config, 'PROFILE', True)
+    monkeypatch.setitem(app.config, 'PROFILE_INTERVAL', 0.001)
+    monkeypatch.setitem(app.config, 'PROFILE_SLOW_SECONDS', 0)
+    request = {'username': 'profile-' + RUN, 'password': 'password', 'email': 'profile-{}@seas.upenn.edu'.format(RUN)}
+    client.post('/api/signup', json=request)
+    assert client.post('/api/login', json=request).status_code == 200
+    with open(str(folders / 'profiles' / '{}.folded'.format(os.getpid()))) as f:
+        lines = f.read().splitlines()
+    assert lines
+    for line in lines:
+        assert re.match(r'^/api/(signup|login);.+ \d+$', line)
+    assert any('login (login.py' in line or 'login (auth.py' in line for line in lines)
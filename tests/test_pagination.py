@@ -0,0 +1,41 @@
+import pytest
+import json
+
+from app import app, db
+from tests.conftest import RUN
+from utils import create_club
+db.create_all()
+client = app.test_client()
+
+def test_keyset_pages_cover_the_full_list():
+    for i in range(5):
+        create_club({'code': 'page-{}-{}'.format(RUN, i), 'name': 'Pagination {} {}'.format(RUN, i),
+                     'description': 'Testing', 'tags': ['Pagination']})
+    full = client.get('/api/clubs/').get_json()
+    pages = []
+    query = {'limit': 2}
+    while True:
+        response = client.get('/api/clubs/', query_string=query)
+        assert response.status_code == 200
+        page = response.get_json()
+        assert len(page) <= 2
+        pages.extend(page)
+        if 'X-Next-Cursor' not in response.headers:
+            break
+        query['cursor'] = response.headers['X-Next-Cursor']
+    assert pages == full
+
+def test_invalid_limit():
+    response = client.get('/api/clubs/', query_string={'limit': -1})
+    assert response.status_code == 400
+
+def test_streamed_list_matches_full_list():
+    full = client.get('/api/clubs/').get_json()
+    chunk_size = app.config['CLUB_STREAM_CHUNK_SIZE']
+    app.config['CLUB_STREAM_CHUNK_SIZE'] = 2
+    try:
+        response = client.get('/api/clubs/', query_string={'stream': 1})
+        assert response.is_streamed
+        assert json.loads(response.get_data()) == full
+    finally:
+        app.config['CLUB_STREAM_CHUNK_SIZE'] = chunk_size
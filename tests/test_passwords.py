@@ -0,0 +1,55 @@
+import pytest
+import threading
+import time
+
+from app import app, db
+import passwords
+from tests.conftest import RUN
+db.create_all()
+client = app.test_client()
+
+def test_full_queue_rejects_with_503():
+    from models import User
+    username = 'busy-' + RUN
+    db.session.add(User(username=username, email=username + '@seas.upenn.edu',
+                        password=passwords.hash_password('password')))
+    db.session.commit()
+    # The defaults leave one of gunicorn's two request threads free.
+    assert app.config['PASSWORD_HASH_WORKERS'] + app.config['PASSWORD_HASH_QUEUE'] < 2
+    passwords._executor = None
+    started, release = threading.Event(), threading.Event()
+    def hold_slot():
+        started.set()
+        release.wait()
+    blocker = threading.Thread(target=passwords._run, args=(hold_slot,))
+    blocker.start()
+    try:
+        started.wait()
+        with pytest.raises(passwords.PasswordHasherBusy):
+            passwords.hash_password('password')
+        start = time.perf_counter()
+        response = client.post('/api/login', json={'username': username, 'password': 'password'})
+        assert response.status_code == 503
+        assert time.perf_counter() - start < 0.5
+        assert response.headers['Retry-After'] == '1'
+    finally:
+        release.set()
+        blocker.join()
+        passwords._executor = None
+
+def test_login_rehashes_at_new_cost():
+    from models import User
+    rounds = app.config['BCRYPT_LOG_ROUNDS']
+    request = {'username': 'rehash-' + RUN, 'password': 'password', 'email': 'rehash-{}@seas.upenn.edu'.format(RUN)}
+    try:
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        client.post('/api/signup', json=request)
+        assert passwords.needs_rehash(User.query.filter_by(username=request['username']).first().password) is False
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        assert client.post('/api/login', json=request).status_code == 200
+        db.session.expire_all()
+        user = User.query.filter_by(username=request['username']).first()
+        assert not passwords.needs_rehash(user.password)
+        assert passwords.check_password('password', user.password)
+    finally:
+        app.config['BCRYPT_LOG_ROUNDS'] = rounds
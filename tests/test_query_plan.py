@@ -0,0 +1,73 @@
+import pytest
+import re
+
+from app import app, db
+from models import *
+from tests.conftest import RUN
+from utils import create_club, jsonify_clubs, jsonify_thread, sort_clubs
+db.create_all()
+
+USERNAME = 'plan-' + RUN
+CODE = 'plan-' + RUN
+
+def setup_module():
+    user = User(username=USERNAME, email=USERNAME + '@seas.upenn.edu', password=b'')
+    db.session.add(user)
+    db.session.commit()
+    club = create_club({'code': CODE, 'name': 'Plan ' + RUN, 'description': '', 'tags': ['Plan'],
+                        'owner': USERNAME})
+    club.members.append(user)
+    user.favorites.append(club)
+    db.session.add(Comment(content='Plan', user_id=user.id, club_id=club.id))
+    db.session.commit()
+
+def user():
+    return User.query.filter_by(username=USERNAME).first()
+
+def club():
+    return Club.query.filter_by(code=CODE).first()
+
+# Lookups that run on most requests and must never scan a whole table.
+HOT_QUERIES = {
+    'club by code': lambda: Club.query.filter_by(code=CODE).first(),
+    'club by name': lambda: Club.query.filter_by(name='Plan ' + RUN).first(),
+    'clubs by owner': lambda: Club.query.filter_by(owner=USERNAME).all(),
+    'user by username': lambda: User.query.filter_by(username=USERNAME).first(),
+    'user by email': lambda: User.query.filter_by(email=USERNAME + '@seas.upenn.edu').first(),
+    'club members': lambda: db.session.query(User).with_parent(club(), 'members').all(),
+    'user clubs': lambda: db.session.query(Club).with_parent(user(), 'clubs').all(),
+    'user favorites': lambda: Club.query.join(favorites).filter(favorites.c.user_id == user().id).all(),
+    'club favorites': lambda: db.session.query(User).with_parent(club(), 'favorites').all(),
+    'club tags': lambda: db.session.query(Tag).with_parent(club(), 'tags').all(),
+    'tag clubs': lambda: db.session.query(Club).with_parent(Tag.query.filter_by(name='Plan').first(), 'clubs').all(),
+    'club comments': lambda: Comment.query.filter_by(club_id=club().id).all(),
+    'comment replies': lambda: Comment.query.filter_by(parent_id=1).all(),
+    'user comments': lambda: Comment.query.filter_by(user_id=user().id).all(),
+    'comment thread': lambda: jsonify_thread(club()),
+    'serialized club': lambda: jsonify_clubs(Club.query.filter_by(code=CODE)),
+    'revoked token': lambda: InvalidToken.query.filter_by(jti=RUN).first(),
+    'new revocations': lambda: InvalidToken.query.filter(InvalidToken.seq > 0).all(),
+    'expired revocations': lambda: InvalidToken.query.filter(InvalidToken.expires < db.func.now()).all(),
+    'club files': lambda: File.query.join(file_to_club).filter(file_to_club.c.club_id == club().id)
+                          .filter(File.id > 0).order_by(File.id).all(),
+    'files by digest': lambda: File.query.filter_by(digest=RUN).first(),
+    'cache tags since': lambda: CacheTag.query.filter(CacheTag.seq > 0).all(),
+    'tag changes since': lambda: TagChange.query.filter(TagChange.seq > 0).all(),
+    'popular page': lambda: sort_clubs(Club.query, 'popular', club().id).limit(10).all(),
+    'trending page': lambda: sort_clubs(Club.query, 'trending', club().id).limit(10).all(),
+    'club events by link': lambda: ClubEvent.query.filter_by(club_id=club().id, user_id=user().id, kind='favorite')
+                                   .order_by(ClubEvent.seq.desc()).first(),
+}
+
+def full_scans(statement, parameters):
+    plan = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    # "SCAN thread" is the recursive CTE itself, not a table.
+    return [row[-1] for row in plan if re.match(r'SCAN (?!thread\b|CONSTANT ROW)', row[-1])]
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_hot_query_uses_an_index(name, queries):
+    with queries:
+        HOT_QUERIES[name]()
+    assert queries.statements
+    for statement, parameters in zip(queries.statements, queries.parameters):
+        assert full_scans(statement, parameters) == [], statement
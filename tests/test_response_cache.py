@@ -0,0 +1,151 @@
+import pytest
+
+from app import app, db
+from caching import LRUCache, stats
+from tests.conftest import RUN, signup
+from utils import create_club
+db.create_all()
+client = app.test_client()
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = LRUCache(threshold=2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1 and lru.get('c') == 3
+
+def test_lru_cache_byte_bound():
+    lru = LRUCache(threshold=100, max_bytes=200)
+    lru.set('a', 'x' * 100)
+    lru.set('b', 'y' * 100)
+    assert lru.get('a') is None
+    assert lru.get('b') == 'y' * 100
+
+def test_query_strings_do_not_collide():
+    create_club({'code': 'cache-alpha-' + RUN, 'name': 'Cache Alpha ' + RUN, 'description': '', 'tags': []})
+    create_club({'code': 'cache-beta-' + RUN, 'name': 'Cache Beta ' + RUN, 'description': '', 'tags': []})
+    alpha = client.get('/api/clubs/', query_string={'search': 'alpha ' + RUN}).get_json()
+    beta = client.get('/api/clubs/', query_string={'search': 'beta ' + RUN}).get_json()
+    assert [club['code'] for club in alpha] == ['cache-alpha-' + RUN]
+    assert [club['code'] for club in beta] == ['cache-beta-' + RUN]
+
+def test_favorites_are_cached_per_user():
+    first, second = signup('cache-first'), signup('cache-second')
+    response = client.post('/api/favorites/', json={'code': 'cache-alpha-' + RUN}, headers=first.headers)
+    assert response.status_code == 201
+    first_favorites = client.get('/api/favorites/', headers=first.headers).get_json()
+    second_favorites = client.get('/api/favorites/', headers=second.headers).get_json()
+    assert [club['code'] for club in first_favorites] == ['cache-alpha-' + RUN]
+    assert second_favorites == []
+    response = client.delete('/api/favorites/cache-alpha-' + RUN, headers=first.headers)
+    assert response.status_code == 200
+    assert client.get('/api/favorites/', headers=first.headers).get_json() == []
+
+def test_hits_and_invalidation():
+    before = stats()['views'].get('get_club', {'hits': 0, 'misses': 0})
+    assert client.get('/api/clubs/cache-beta-{}/'.format(RUN)).get_json()['favorite_count'] == 0
+    assert client.get('/api/clubs/cache-beta-{}/'.format(RUN)).status_code == 200
+    after = stats()['views']['get_club']
+    assert after['misses'] == before['misses'] + 1
+    assert after['hits'] == before['hits'] + 1
+    third = signup('cache-third')
+    client.post('/api/favorites/', json={'code': 'cache-beta-' + RUN}, headers=third.headers)
+    assert client.get('/api/clubs/cache-beta-{}/'.format(RUN)).get_json()['favorite_count'] == 1
+    assert client.get('/api/cache').get_json()['hits'] >= 1
+
+def test_invalidation_from_another_worker():
+    from caching import publish
+    from models import Club
+    code = 'cache-alpha-' + RUN
+    assert client.get('/api/clubs/{}/'.format(code)).get_json()['description'] == ''
+    # Another worker only writes to the database and the cache_tag table.
+    Club.query.filter_by(code=code).first().description = 'Changed elsewhere'
+    db.session.commit()
+    publish(['club:' + code])
+    assert client.get('/api/clubs/{}/'.format(code)).get_json()['description'] == 'Changed elsewhere'
+
+def test_etags_and_not_modified():
+    response = client.get('/api/tags/')
+    etag = response.headers['ETag']
+    assert etag.startswith('W/"')
+    again = client.get('/api/tags/', headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.headers['ETag'] == etag and not again.get_data()
+    create_club({'code': 'cache-gamma-' + RUN, 'name': 'Cache Gamma ' + RUN, 'description': '',
+                 'tags': ['Cache ' + RUN]})
+    from caching import invalidate
+    invalidate('clubs', 'tags')
+    changed = client.get('/api/tags/', headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+
+def test_large_bodies_are_compressed_once(monkeypatch):
+    import caching
+    import gzip
+    plain = client.get('/api/clubs/')
+    assert 'Content-Encoding' not in plain.headers
+    assert len(plain.get_data()) >= app.config['COMPRESS_MIN_SIZE']
+    assert 'Accept-Encoding' in plain.headers['Vary']
+    monkeypatch.setattr(caching, 'brotli', None)
+    calls = []
+    compress = caching.compress
+    monkeypatch.setattr(caching, 'compress', lambda body, encoding: calls.append(encoding) or compress(body, encoding))
+    for _ in range(2):
+        response = client.get('/api/clubs/', headers={'Accept-Encoding': 'br, gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['ETag'] == plain.headers['ETag']
+        assert gzip.decompress(response.get_data()) == plain.get_data()
+    assert calls == ['gzip']
+    small = client.get('/api/clubs/cache-alpha-{}/'.format(RUN), headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+
+def test_tag_counts_follow_other_clubs():
+    tagger = signup('cache-tagger')
+    tag = 'Cache Tag ' + RUN
+    for name in ('first', 'second'):
+        response = client.post('/api/clubs/', json={'code': 'cache-{}-{}'.format(name, RUN), 'name': 'Cache {} {}'.format(
+            name, RUN), 'description': '', 'tags': [{'name': tag}]}, headers=tagger.headers)
+        assert response.status_code == 201
+        club = client.get('/api/clubs/cache-first-{}/'.format(RUN)).get_json()
+        batch = client.get('/api/clubs/batch', query_string={'codes': 'cache-first-' + RUN}).get_json()
+        expected = 1 if name == 'first' else 2
+        assert [t['clubs'] for t in club['tags']] == [expected]
+        assert [t['clubs'] for t in batch['clubs'][0]['club']['tags']] == [expected]
+
+def test_deleting_a_user_updates_club_counts():
+    code = 'cache-beta-' + RUN
+    leaver = signup('cache-leaver')
+    client.post('/api/favorites/', json={'code': code}, headers=leaver.headers)
+    client.post('/api/clubs/', json={'code': 'cache-leaver-' + RUN, 'name': 'Cache Leaver ' + RUN, 'description': '',
+                                     'tags': []}, headers=leaver.headers)
+    favorite_count = client.get('/api/clubs/{}/'.format(code)).get_json()['favorite_count']
+    assert client.get('/api/clubs/cache-leaver-{}/'.format(RUN)).get_json()['membership_count'] == 1
+    response = client.delete('/api/users/' + leaver.username, headers=leaver.headers)
+    assert response.status_code == 200
+    assert client.get('/api/clubs/{}/'.format(code)).get_json()['favorite_count'] == favorite_count - 1
+    assert client.get('/api/clubs/cache-leaver-{}/'.format(RUN)).get_json()['membership_count'] == 0
+
+def test_etags_match_across_workers(monkeypatch):
+    import caching
+    from app import cache
+    url = '/api/clubs/cache-alpha-{}/'.format(RUN)
+    first = client.get(url)
+    etag = first.headers['ETag']
+
+    # A second worker, or this one after a restart, has an empty cache.
+    worker_a, seen_a = app.extensions['cache'][cache], caching._seen_seq
+    worker_b = LRUCache(threshold=100)
+    monkeypatch.setitem(app.extensions['cache'], cache, worker_b)
+    monkeypatch.setattr(caching, '_seen_seq', None)
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(url).headers['ETag'] == etag
+
+    # Worker B invalidates the club; worker A hears of it through cache_tag.
+    caching.invalidate('club:cache-alpha-' + RUN)
+    changed = client.get(url, headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    monkeypatch.setitem(app.extensions['cache'], cache, worker_a)
+    monkeypatch.setattr(caching, '_seen_seq', seen_a)
+    again = client.get(url, headers={'If-None-Match': etag})
+    assert again.status_code == 200
+    assert again.headers['ETag'] == changed.headers['ETag']
@@ -0,0 +1,31 @@
+import pytest
+
+from app import app, db
+import scraper
+from tests.fixtures import serve
+db.create_all()
+
+URL = serve() + 'ocwp.html'
+
+def test_parse_fixture():
+    with open('tests/fixtures/ocwp.html') as f:
+        html = f.read()
+    entries = scraper.OCWPSource(URL).parse(html)
+    assert len(entries) == 200
+    assert len({entry['code'] for entry in entries}) == 200
+    assert all(entry['name'] and entry['description'] and entry['tags'] for entry in entries)
+
+def test_scrape_is_incremental(monkeypatch):
+    monkeypatch.setitem(app.config, 'SCRAPER_SOURCES', {'ocwp': URL})
+    first = scraper.scrape()
+    assert (first['pages'], first['unchanged'], first['entries']) == (1, 0, 200)
+    second = scraper.scrape()
+    assert (second['unchanged'], second['entries'], second['inserted'], second['updated']) == (1, 0, 0, 0)
+    forced = scraper.scrape(force=True)
+    assert (forced['unchanged'], forced['entries'], forced['inserted'], forced['updated']) == (0, 200, 0, 0)
+
+def test_scrape_unknown_page(monkeypatch):
+    import requests
+    monkeypatch.setitem(app.config, 'SCRAPER_SOURCES', {'ocwp': serve() + 'missing.html'})
+    with pytest.raises(requests.HTTPError):
+        scraper.scrape()
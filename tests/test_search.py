@@ -0,0 +1,48 @@
+import pytest
+
+from app import app, db
+from tests.conftest import RUN
+from utils import create_club
+db.create_all()
+client = app.test_client()
+
+# A made-up word per run so earlier runs against the same database don't match.
+WORD = 'zq' + RUN
+
+def search(term, **kwargs):
+    kwargs['search'] = term
+    response = client.get('/api/clubs/', query_string=kwargs)
+    assert response.status_code == 200
+    return [club['code'] for club in response.get_json()]
+
+def test_search_ranks_and_matches_prefixes():
+    create_club({'code': WORD + '-desc', 'name': 'Search Description ' + WORD[:4],
+                 'description': 'We love {}ers.'.format(WORD), 'tags': []})
+    create_club({'code': WORD + '-name', 'name': 'Penn {} Society'.format(WORD),
+                 'description': 'Nothing to see.', 'tags': []})
+    create_club({'code': WORD + '-tag', 'name': 'Search Tag ' + WORD[:4],
+                 'description': 'Nothing to see.', 'tags': [WORD + 'Tag']})
+    assert search(WORD) == [WORD + '-name', WORD + '-tag', WORD + '-desc']
+    assert search(WORD[:5]) == [WORD + '-name', WORD + '-tag', WORD + '-desc']
+    assert search('society ' + WORD) == [WORD + '-name']
+    assert search(WORD + 'tag') == [WORD + '-tag']
+
+def test_search_pagination():
+    assert search(WORD, limit=2) == [WORD + '-name', WORD + '-tag']
+    assert search(WORD, limit=2, offset=2) == [WORD + '-desc']
+    response = client.get('/api/clubs/', query_string={'search': WORD, 'limit': 0})
+    assert response.status_code == 400
+
+def test_search_index_follows_writes(account):
+    request = {'name': 'Search Owned ' + WORD, 'tags': [{'name': 'Undergraduate'}]}
+    response = client.post('/api/clubs/', json=request, headers=account.headers)
+    assert response.status_code == 201
+    code = response.get_json()['code']
+    assert code in search('owned ' + WORD)
+    request = {'code': code, 'description': 'Renamed', 'tags': [{'name': WORD + 'Moved'}]}
+    response = client.put('/api/clubs/{}/'.format(code), json=request, headers=account.headers)
+    assert response.status_code == 201
+    assert search(WORD + 'moved') == [code]
+    response = client.delete('/api/clubs/{}/'.format(code), headers=account.headers)
+    assert response.status_code == 200
+    assert search('owned ' + WORD) == []
@@ -0,0 +1,119 @@
+import json
+import pytest
+
+from app import app, db
+import utils
+from caching import invalidate
+from models import Club, User, favorites
+from tests.conftest import RUN
+from utils import club_fragments, create_club, join_fragments, jsonify_clubs
+db.create_all()
+
+def make_clubs(prefix, count):
+    clubs = []
+    for i in range(count):
+        club = create_club({'code': '{}-{}-{}'.format(prefix, RUN, i), 'name': 'Serialize {} {} {}'.format(prefix, RUN, i),
+                            'description': 'Testing', 'tags': ['Serialize', 'Serialize {}'.format(i % 3)]})
+        clubs.append(club)
+    return clubs
+
+def test_jsonify_clubs_matches_to_dict():
+    clubs = make_clubs('serialize-dict', 3)
+    user = User(username='serialize-' + RUN, email='serialize@seas.upenn.edu')
+    clubs[0].members.append(user)
+    clubs[1].favorites.append(user)
+    db.session.commit()
+    codes = [club.code for club in clubs]
+    data = jsonify_clubs(Club.query.filter(Club.code.in_(codes)).order_by(Club.id))
+    for club, club_dict in zip(clubs, data):
+        expected = club.to_dict()
+        by_id = lambda tag: tag['id']
+        assert sorted(club_dict.pop('tags'), key=by_id) == sorted(expected.pop('tags'), key=by_id)
+        assert club_dict == expected
+
+def test_jsonify_clubs_query_count_is_constant(queries):
+    make_clubs('serialize-small', 2)
+    query = Club.query.filter(Club.code.like('serialize-small-{}-%'.format(RUN)))
+    data, small_count = queries.count(lambda: jsonify_clubs(query))
+    assert len(data) == 2
+    make_clubs('serialize-large', 40)
+    query = Club.query.filter(Club.code.like('serialize-large-{}-%'.format(RUN)))
+    data, large_count = queries.count(lambda: jsonify_clubs(query))
+    assert len(data) == 40
+    assert large_count == small_count
+
+def test_club_fragments_match_jsonify_clubs():
+    make_clubs('serialize-fragment', 3)
+    query = Club.query.filter(Club.code.like('serialize-fragment-{}-%'.format(RUN))).order_by(Club.id)
+    expected = jsonify_clubs(query)
+    assert json.loads(join_fragments(club_fragments(query))) == expected
+    # Served from the fragment cache the second time.
+    assert json.loads(join_fragments(club_fragments(query))) == expected
+    assert [club_id for club_id, _ in club_fragments(query)] == [club['id'] for club in expected]
+
+def test_only_changed_clubs_are_serialized_again(monkeypatch):
+    clubs = make_clubs('serialize-changed', 3)
+    query = Club.query.filter(Club.code.like('serialize-changed-{}-%'.format(RUN))).order_by(Club.id)
+    club_fragments(query)
+    encoded = []
+    encode = utils.encode
+    monkeypatch.setattr(utils, 'encode', lambda data: encoded.append(data['id']) or encode(data))
+    user = User(username='serialize-changed-' + RUN, email='serialize-changed@seas.upenn.edu')
+    db.session.add(user)
+    db.session.commit()
+    assert club_fragments(query) and encoded == []
+
+    db.session.execute(favorites.insert().values(user_id=user.id, club_id=clubs[0].id))
+    db.session.commit()
+    data = json.loads(join_fragments(club_fragments(query)))
+    assert encoded == [clubs[0].id]
+    assert [club['favorite_count'] for club in data] == [1, 0, 0]
+
+    encoded.clear()
+    clubs[1].name = 'Renamed ' + RUN
+    db.session.commit()
+    data = json.loads(join_fragments(club_fragments(query)))
+    assert encoded == [clubs[1].id]
+    assert data[1]['name'] == 'Renamed ' + RUN
+
+    # Tag changes move the 'tags' version, which every fragment depends on.
+    encoded.clear()
+    invalidate('tags')
+    club_fragments(query)
+    assert sorted(encoded) == sorted(club.id for club in clubs)
+
+@pytest.mark.parametrize('fast', [True, False])
+def test_club_fragments_escape_non_ascii_like_jsonify(monkeypatch, fast):
+    if not fast:
+        monkeypatch.setattr(utils, 'orjson', None)
+    elif utils.orjson is None:
+        pytest.skip('orjson is not installed')
+    club = create_club({'code': 'serialize-unicode-{}-{}'.format(RUN, fast), 'name': 'Café Señor ✓ {} {}'.format(
+                            RUN, fast), 'description': 'Ünïcode 日本', 'tags': ['Serialize']})
+    query = Club.query.filter_by(id=club.id)
+    with app.app_context():
+        expected = app.json.response(jsonify_clubs(query)).get_data()
+    invalidate('tags')
+    assert b'\\u' in expected
+    assert join_fragments(club_fragments(query)) == expected
+
+def test_uncached_clubs_are_serialized_in_batches(monkeypatch, queries):
+    make_clubs('serialize-batched', 5)
+    query = Club.query.filter(Club.code.like('serialize-batched-{}-%'.format(RUN))).order_by(Club.id)
+    monkeypatch.setattr(utils, 'FRAGMENT_BATCH_SIZE', 2)
+    invalidate('tags')
+    with queries:
+        data = json.loads(join_fragments(club_fragments(query)))
+    assert data == jsonify_clubs(query)
+    # No statement binds more ids than a batch holds.
+    assert max(len(parameters) for parameters in queries.parameters) <= 3
+
+def test_fragment_cache_is_bounded_in_bytes(monkeypatch):
+    make_clubs('serialize-bytes', 4)
+    query = Club.query.filter(Club.code.like('serialize-bytes-{}-%'.format(RUN))).order_by(Club.id)
+    fragments = club_fragments(query)
+    max_bytes = sum(len(fragment) for _, fragment in fragments[:2])
+    monkeypatch.setattr(utils, '_fragments', None)
+    monkeypatch.setitem(app.config, 'CLUB_FRAGMENT_CACHE_MAX_BYTES', max_bytes)
+    assert club_fragments(query) == fragments
+    assert 0 < utils._fragments._bytes <= max_bytes
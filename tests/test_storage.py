@@ -0,0 +1,158 @@
+import pytest
+import io
+import os
+
+from app import app, db
+from models import File
+from tests.conftest import RUN
+db.create_all()
+client = app.test_client()
+
+CODES = ['storage-{}-{}'.format(RUN, i) for i in range(2)]
+HEADERS = {}
+
+@pytest.fixture(scope='module', autouse=True)
+def clubs(account):
+    HEADERS.update(account.headers)
+    for code in CODES:
+        client.post('/api/clubs/', json={'name': code, 'code': code, 'tags': []}, headers=HEADERS)
+
+@pytest.fixture(autouse=True)
+def folders(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'BLOB_FOLDER', str(tmp_path / 'blobs'))
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path / 'files'))
+    monkeypatch.setitem(app.config, 'BLOB_CHUNK_SIZE', 7)
+    return tmp_path
+
+def upload(code, filename, content, method='post'):
+    path = '/api/clubs/{}/files'.format(code)
+    if method == 'put':
+        path += '/' + filename
+    return getattr(client, method)(path, data={'file': (io.BytesIO(content), filename)},
+                                   headers=HEADERS, content_type='multipart/form-data')
+
+def blobs(tmp_path):
+    return sorted(name for _, _, names in os.walk(str(tmp_path / 'blobs')) for name in names)
+
+def test_identical_uploads_share_a_blob(folders):
+    content = b'Flyer ' + RUN.encode()
+    for code in CODES:
+        assert upload(code, 'flyer.pdf', content).status_code == 201
+    assert upload(CODES[0], 'flyer.pdf', content).status_code == 409
+    files = File.query.filter(File.name == 'flyer.pdf', File.path.contains(folders.name)).all()
+    assert len(files) == 2 and files[0].digest == files[1].digest and files[0].size == len(content)
+    assert files[0].mime == 'application/pdf'
+    assert blobs(folders) == [files[0].digest]
+    response = client.get('/api/clubs/{}/files/flyer.pdf'.format(CODES[1]))
+    assert response.data == content and response.mimetype == 'application/pdf'
+    assert 'flyer.pdf' in response.headers['Content-Disposition']
+
+    assert upload(CODES[0], 'flyer.pdf', b'New flyer', 'put').status_code == 201
+    assert client.get('/api/clubs/{}/files/flyer.pdf'.format(CODES[0])).data == b'New flyer'
+    assert client.get('/api/clubs/{}/files/flyer.pdf'.format(CODES[1])).data == content
+    assert len(blobs(folders)) == 2
+
+    assert client.delete('/api/clubs/{}/files/flyer.pdf'.format(CODES[1]), headers=HEADERS).status_code == 200
+    assert len(blobs(folders)) == 1
+    assert client.delete('/api/clubs/{}/files/flyer.pdf'.format(CODES[0]), headers=HEADERS).status_code == 200
+    assert blobs(folders) == []
+    assert client.get('/api/clubs/{}/files/flyer.pdf'.format(CODES[0])).status_code == 404
+
+def test_blob_is_in_place_before_the_row_is_committed(folders):
+    from sqlalchemy import event
+    import storage
+    content = b'Ordered ' + RUN.encode()
+    seen = []
+    def before_commit(session):
+        seen.append(os.path.exists(storage.blob_path(storage.hashlib.sha256(content).hexdigest())))
+    event.listen(db.session, 'before_commit', before_commit)
+    try:
+        assert upload(CODES[0], 'ordered.pdf', content).status_code == 201
+    finally:
+        event.remove(db.session, 'before_commit', before_commit)
+    assert seen and all(seen)
+
+def test_legacy_files_are_served_and_migrated_on_replace(folders):
+    folder = folders / 'files' / CODES[0]
+    folder.mkdir(parents=True)
+    (folder / 'old.txt').write_bytes(b'Old')
+    assert client.get('/api/clubs/{}/files/old.txt'.format(CODES[0])).data == b'Old'
+    assert upload(CODES[0], 'old.txt', b'Old').status_code == 409
+    assert upload(CODES[0], 'old.txt', b'Replaced', 'put').status_code == 201
+    assert not (folder / 'old.txt').exists()
+    assert client.get('/api/clubs/{}/files/old.txt'.format(CODES[0])).data == b'Replaced'
+
+def test_delete_club_releases_blobs(folders):
+    code = 'storage-{}-gone'.format(RUN)
+    client.post('/api/clubs/', json={'name': code, 'code': code, 'tags': []}, headers=HEADERS)
+    assert upload(code, 'gone.png', b'Gone').status_code == 201
+    assert len(blobs(folders)) == 1
+    assert client.delete('/api/clubs/{}/'.format(code), headers=HEADERS).status_code == 200
+    assert blobs(folders) == []
+
+def test_conditional_and_range_downloads(monkeypatch):
+    content = bytes(range(256)) * 40
+    assert upload(CODES[1], 'big.pdf', content).status_code == 201
+    path = '/api/clubs/{}/files/big.pdf'.format(CODES[1])
+    response = client.get(path)
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    assert response.data == content and not etag.startswith('W/')
+    assert client.get(path, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(path, headers={'If-Modified-Since': last_modified}).status_code == 304
+    partial = client.get(path, headers={'Range': 'bytes=100-199'})
+    assert partial.status_code == 206 and partial.data == content[100:200]
+    assert partial.headers['Content-Range'] == 'bytes 100-199/{}'.format(len(content))
+    assert client.get(path, headers={'Range': 'bytes=100-199', 'If-Range': '"stale"'}).data == content
+
+    stored = File.query.filter_by(name='big.pdf', digest=etag.strip('"')).first()
+    monkeypatch.setitem(app.config, 'FILE_OFFLOAD', 'x-accel-redirect')
+    response = client.get(path)
+    assert response.data == b'' and response.headers['ETag'] == etag
+    assert response.headers['X-Accel-Redirect'] == '/_blobs/{0}/{1}/{2}'.format(stored.digest[:2], stored.digest[2:4],
+                                                                              stored.digest)
+    assert 'X-Accel-Redirect' not in client.get(path, headers={'If-None-Match': etag}).headers
+    monkeypatch.setitem(app.config, 'FILE_OFFLOAD', 'x-sendfile')
+    assert client.get(path).headers['X-Sendfile'] == os.path.abspath(stored.path)
+
+def test_file_listing_pages_with_metadata():
+    code = 'storage-{}-list'.format(RUN)
+    client.post('/api/clubs/', json={'name': code, 'code': code, 'tags': []}, headers=HEADERS)
+    path = '/api/clubs/{}/files'.format(code)
+    assert client.get(path).status_code == 404
+    for i in range(5):
+        assert upload(code, 'page{}.txt'.format(i), b'x' * i).status_code == 201
+    pages, query = [], {'limit': 2}
+    while True:
+        response = client.get(path, query_string=query)
+        pages.extend(response.get_json())
+        if 'X-Next-Cursor' not in response.headers:
+            break
+        query['cursor'] = response.headers['X-Next-Cursor']
+    assert pages == client.get(path).get_json()
+    assert [(item['filename'], item['size'], item['mime']) for item in pages] == \
+        [('page{}.txt'.format(i), i, 'text/plain') for i in range(5)]
+    assert client.get(path, query_string={'limit': 0}).status_code == 400
+
+def test_reconcile(folders):
+    import storage
+    code = 'storage-{}-reconcile'.format(RUN)
+    client.post('/api/clubs/', json={'name': code, 'code': code, 'tags': []}, headers=HEADERS)
+    folder = folders / 'files' / code
+    folder.mkdir(parents=True)
+    (folder / 'legacy.txt').write_bytes(b'Legacy')
+    (folders / 'files' / 'no-such-club').mkdir()
+    (folders / 'files' / 'no-such-club' / 'stray.txt').write_bytes(b'Stray')
+    assert upload(code, 'lost.txt', b'Lost').status_code == 201
+    os.remove(File.query.filter(File.name == 'lost.txt', File.path.contains(folders.name)).first().path)
+    orphan = folders / 'blobs' / 'ab' / 'cd' / 'abcd'
+    orphan.parent.mkdir(parents=True)
+    orphan.write_bytes(b'Orphan')
+    os.utime(str(orphan), (0, 0))
+    (folders / 'blobs' / 'tmp' / 'fresh').write_bytes(b'Uploading')
+    stats = storage.reconcile()
+    assert (stats['imported'], stats['orphaned']) == (1, 1) and stats['missing'] >= 1
+    assert not orphan.exists() and (folders / 'blobs' / 'tmp' / 'fresh').exists()
+    listing = client.get('/api/clubs/{}/files'.format(code)).get_json()
+    assert [item['filename'] for item in listing] == ['legacy.txt']
+    assert client.get('/api/clubs/{}/files/legacy.txt'.format(code)).data == b'Legacy'
+    assert storage.reconcile() == {'imported': 0, 'missing': 0, 'orphaned': 0}
@@ -0,0 +1,78 @@
+import pytest
+import random
+import time
+
+from app import app, db
+from tagindex import TagIndex, bitmap, members, popcount
+from tests.conftest import RUN
+db.create_all()
+client = app.test_client()
+
+def tag(name):
+    return '{} {}'.format(name, RUN)
+
+def add_club(account, i, tags):
+    request = {'name': 'Tag index {} {}'.format(RUN, i), 'code': 'tagindex-{}-{}'.format(RUN, i),
+               'tags': [{'name': tag(name)} for name in tags]}
+    assert client.post('/api/clubs/', json=request, headers=account.headers).status_code == 201
+
+def codes(**query):
+    response = client.get('/api/clubs/', query_string=query)
+    assert response.status_code == 200
+    return sorted(club['code'].rsplit('-', 1)[1] for club in response.get_json())
+
+def test_bitmap_members():
+    ids = [0, 3, 64, 65, 1000]
+    bits = bitmap(ids)
+    assert members(bits) == ids and popcount(bits) == 5
+    assert members(bits, after=3) == [64, 65, 1000]
+    assert members(bits, after=3, limit=2) == [64, 65]
+    assert members(0) == [] and bitmap([]) == 0
+
+def test_filter_and_facets(account):
+    add_club(account, 0, ['Music', 'Arts'])
+    add_club(account, 1, ['Music'])
+    add_club(account, 2, ['Arts', 'Service'])
+    assert codes(tags=tag('Music')) == ['0', '1']
+    assert codes(tags='{},{}'.format(tag('Music'), tag('Arts'))) == ['0']
+    assert codes(tags=[tag('Music'), tag('Service')], match='any') == ['0', '1', '2']
+    assert codes(tags=tag('Nothing')) == []
+    assert codes(tags=tag('Arts'), search='tag index ' + RUN) == ['0', '2']
+    assert client.get('/api/clubs/', query_string={'tags': tag('Arts'), 'match': 'some'}).status_code == 400
+
+    facets = client.get('/api/tags/facets', query_string={'tags': tag('Music')}).get_json()
+    assert facets['clubs'] == 2
+    assert [(item['name'], item['clubs']) for item in facets['tags'] if item['name'].endswith(RUN)] == \
+        [(tag('Arts'), 1)]
+
+    request = {'code': 'tagindex-{}-1'.format(RUN), 'tags': [{'name': tag('Arts')}]}
+    assert client.put('/api/clubs/tagindex-{}-1/'.format(RUN), json=request,
+                      headers=account.headers).status_code == 201
+    assert codes(tags=tag('Music')) == ['0']
+    assert codes(tags=tag('Arts')) == ['0', '1', '2']
+    assert client.delete('/api/clubs/tagindex-{}-2/'.format(RUN), headers=account.headers).status_code == 200
+    assert codes(tags=tag('Arts')) == ['0', '1']
+
+def test_filtered_pages(account):
+    for i in range(3, 8):
+        add_club(account, i, ['Paged'])
+    pages, query = [], {'tags': tag('Paged'), 'limit': 2}
+    while True:
+        response = client.get('/api/clubs/', query_string=query)
+        pages += [club['code'] for club in response.get_json()]
+        if 'X-Next-Cursor' not in response.headers:
+            break
+        query['cursor'] = response.headers['X-Next-Cursor']
+    assert pages == ['tagindex-{}-{}'.format(RUN, i) for i in range(3, 8)]
+
+def test_facets_over_100k_clubs_are_fast():
+    rng = random.Random(0)
+    index = TagIndex()
+    index.load([(i, 'tag{}'.format(i)) for i in range(50)],
+               [(club, tag_id) for club in range(100000) for tag_id in rng.sample(range(50), 3)])
+    selected = index.select(['tag1', 'tag2'], 'any')
+    start = time.perf_counter()
+    for _ in range(10):
+        facets = index.facets(selected, exclude=['tag1', 'tag2'])
+    assert (time.perf_counter() - start) / 10 < 0.005
+    assert sum(count for _, count in facets.values()) > 0
@@ -0,0 +1,55 @@
+import pytest
+
+from app import app, db
+from revocation import BloomFilter
+from tests.conftest import RUN, signup
+db.create_all()
+client = app.test_client()
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    keys = ['token-{}'.format(i) for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    false_positives = sum('other-{}'.format(i) in bloom for i in range(10000))
+    assert false_positives < 300
+
+def test_valid_token_skips_revocation_table(account, queries):
+    path = '/api/users/' + account.username
+    assert client.get(path, headers=account.headers).status_code == 200
+    with queries as statements:
+        assert client.get(path, headers=account.headers).status_code == 200
+    assert not [statement for statement in statements if 'invalid_token' in statement]
+    assert len([statement for statement in statements if 'FROM user' in statement]) == 2
+
+def test_token_revoked_by_another_worker():
+    import datetime
+    import jwt
+    from caching import publish
+    from models import InvalidToken
+    revoked = signup('tokens-revoked')
+    path = '/api/users/' + revoked.username
+    assert client.get(path, headers=revoked.headers).status_code == 200
+    # Another worker only writes the row and publishes the tag.
+    payload = jwt.decode(revoked.headers['auth_token'], app.config['SECRET_KEY'], algorithms='HS256')
+    expires = datetime.datetime.utcfromtimestamp(payload['exp'])
+    db.session.add(InvalidToken(jti=payload['jti'], expires=expires))
+    db.session.commit()
+    publish(['tokens'])
+    assert client.get(path, headers=revoked.headers).status_code == 401
+
+def test_garbage_token_rejected():
+    assert client.get('/api/users/nobody', headers={'auth_token': 'garbage'}).status_code == 401
+
+def test_expired_revocations_are_purged():
+    import datetime
+    from models import InvalidToken
+    from utils import purge_expired_tokens
+    expired = InvalidToken(jti='expired-' + RUN, expires=datetime.datetime.utcnow() - datetime.timedelta(days=1))
+    live = InvalidToken(jti='live-' + RUN, expires=datetime.datetime.utcnow() + datetime.timedelta(days=1))
+    db.session.add_all([expired, live])
+    db.session.commit()
+    assert purge_expired_tokens(force=True) >= 1
+    assert InvalidToken.query.filter_by(jti='expired-' + RUN).first() is None
+    assert InvalidToken.query.filter_by(jti='live-' + RUN).first() is not None
@@ -1,12 +1,16 @@
+import threading
 from app import db
 
 def create_club(club):
     from models import Club
     tags = club.pop('tags')
-    tags = [get_or_create_tag(tag_name) for tag_name in tags]
+    tags = [get_or_create_tag(tag_name) for tag_name in dict.fromkeys(tags)]
     club = Club(**club)
     club.tags.extend(tags)
     db.session.add(club)
+    db.session.flush()
+    from search import index_club
+    index_club(club)
     db.session.commit()
     return club
 
@@ -16,27 +20,217 @@ def get_or_create_tag(tag_name):
     if tag is None:
         tag = Tag(name=tag_name)
         db.session.add(tag)
-        db.session.commit()
+        db.session.flush()
     return tag
 
+def create_comment(content, user_id, club_id, parent_id=None):
+    from database import write
+    from models import Comment
+    insert = Comment.__table__.insert().values(content=content, user_id=user_id, club_id=club_id,
+                                                parent_id=parent_id)
+    comment_id = write(lambda connection: connection.execute(insert).inserted_primary_key[0])
+    return Comment.query.get(comment_id)
+
+def batch_lists(data, *names):
+    # The named lists of a batch request without repeats, and an error message
+    # if they aren't lists of strings, are too long or share an item.
+    from flask import current_app
+    lists = [data.get(name, []) if isinstance(data, dict) else None for name in names]
+    if not all(isinstance(items, list) and all(isinstance(item, str) for item in items) for items in lists):
+        return None, '{} must be lists of strings.'.format(' and '.join(names))
+    lists = [list(dict.fromkeys(items)) for items in lists]
+    if sum(len(items) for items in lists) > current_app.config.get('BATCH_MAX_ITEMS'):
+        return None, 'Too many items in one batch.'
+    if len(set().union(*lists)) < sum(len(items) for items in lists):
+        return None, 'An item may only appear in one list.'
+    return lists, None
+
+def update_links(table, fixed, fixed_id, other, add, remove):
+    # Links fixed_id to the `add` ids and unlinks it from the `remove` ids in
+    # one write transaction. Returns the ids of both that were linked before.
+    from sqlalchemy import select
+    from database import write
+    fixed_column, other_column = table.c[fixed], table.c[other]
+    def job(connection):
+        linked = {other_id for other_id, in connection.execute(
+            select(other_column).where(fixed_column == fixed_id, other_column.in_(list(add) + list(remove))))}
+        adding = [other_id for other_id in add if other_id not in linked]
+        removing = [other_id for other_id in remove if other_id in linked]
+        if adding:
+            connection.execute(table.insert(), [{fixed: fixed_id, other: other_id} for other_id in adding])
+        if removing:
+            connection.execute(table.delete().where(fixed_column == fixed_id, other_column.in_(removing)))
+        return linked
+    return write(job)
+
 def jsonify_comments(comments):
-    comments_dict = [comment.to_dict() for comment in comments]
+    # Resolves every author and club in one query each instead of two per comment.
+    from models import User, Club
+    comments = list(comments)
+    usernames = dict(db.session.query(User.id, User.username)
+                     .filter(User.id.in_({comment.user_id for comment in comments})))
+    codes = dict(db.session.query(Club.id, Club.code)
+                 .filter(Club.id.in_({comment.club_id for comment in comments})))
+    comments_dict = [{'id': comment.id, 'user': usernames.get(comment.user_id), 'club':
+                      codes.get(comment.club_id), 'content': comment.content, 'parent': comment.parent_id}
+                     for comment in comments]
     return comments_dict
 
+def jsonify_thread(club, root_id=None, depth=None):
+    # Fetches a whole discussion in one recursive query: the replies under
+    # root_id, or every top-level comment of the club and their replies, down
+    # to `depth` levels below the roots (all of them if depth is None). Returns
+    # the roots with their replies nested under them.
+    from sqlalchemy import text
+    anchor = 'id = :root_id' if root_id is not None else 'parent_id IS NULL'
+    rows = db.session.execute(text(
+        "WITH RECURSIVE thread(id, depth) AS ("
+        "SELECT id, 0 FROM comment WHERE club_id = :club_id AND " + anchor + " "
+        "UNION ALL "
+        "SELECT comment.id, thread.depth + 1 FROM comment JOIN thread ON comment.parent_id = thread.id "
+        "WHERE :depth IS NULL OR thread.depth < :depth) "
+        "SELECT comment.id, comment.content, comment.parent_id, user.username FROM thread "
+        "JOIN comment ON comment.id = thread.id LEFT JOIN user ON user.id = comment.user_id "
+        "ORDER BY comment.id"),
+        {'club_id': club.id, 'root_id': root_id, 'depth': depth}).fetchall()
+    nodes = {}
+    roots = []
+    for comment_id, content, parent_id, username in rows:
+        node = {'id': comment_id, 'user': username, 'club': club.code, 'content': content,
+                'parent': parent_id, 'replies': []}
+        nodes[comment_id] = node
+        if parent_id in nodes:
+            nodes[parent_id]['replies'].append(node)
+        else:
+            roots.append(node)
+    return roots
+
 def jsonify_users(users):
     users_dict = [user.to_dict() for user in users]
     return users_dict
 
 def jsonify_clubs(clubs):
-    clubs_dict = [club.to_dict() for club in clubs]
+    # Takes a Club query rather than a list so that clubs and tags can be
+    # fetched for the whole result set in two statements, however large it is.
+    from models import Club, Tag, tag_to_club
+    from sqlalchemy import select
+    rows = clubs.all()
+    if not rows:
+        return []
+    club_ids = clubs.with_entities(Club.id).subquery()
+    tag_rows = db.session.query(tag_to_club.c.club_id, Tag.id, Tag.name, Tag.club_count) \
+        .join(Tag, Tag.id == tag_to_club.c.tag_id) \
+        .filter(tag_to_club.c.club_id.in_(select(club_ids.c.id))).all()
+    tags = {}
+    for club_id, tag_id, tag_name, count in tag_rows:
+        tags.setdefault(club_id, []).append({'id': tag_id, 'name': tag_name, 'clubs': count})
+    clubs_dict = [{'id': club.id, 'code': club.code, 'name': club.name, 'description':
+                   club.description, 'membership_count': club.membership_count, 'tags':
+                   tags.get(club.id, []), 'favorite_count': club.favorite_count}
+                  for club in rows]
     return clubs_dict
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def encode(data):
+    # Same JSON as jsonify writes, faster with orjson. orjson can't escape
+    # non-ASCII the way jsonify does, so those go through json instead.
+    if orjson is not None:
+        encoded = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+        if encoded.isascii():
+            return encoded
+    import json
+    return json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+_fragments = None
+_fragments_lock = threading.Lock()
+
+FRAGMENT_BATCH_SIZE = 500
+
+def club_fragments(clubs):
+    # (id, JSON bytes) for each club of the query, in order. Each club's JSON
+    # is kept in a per-worker LRU, bounded by count and by bytes, under its
+    # id, version and the 'tags' version, so only changed clubs are
+    # serialized again and stale entries age out.
+    global _fragments
+    from app import app
+    from caching import LRUCache, tag_versions
+    from metrics import timed
+    from models import Club
+    with _fragments_lock:
+        if _fragments is None:
+            _fragments = LRUCache(threshold=app.config.get('CLUB_FRAGMENT_CACHE_SIZE'),
+                                  max_bytes=app.config.get('CLUB_FRAGMENT_CACHE_MAX_BYTES'), default_timeout=0,
+                                  pickled=False)
+    rows = clubs.with_entities(Club.id, Club.version).all()
+    tags_version = tag_versions(['tags'])[0]
+    keys = ['{}:{}:{}'.format(club_id, version, tags_version) for club_id, version in rows]
+    found = {}
+    for (club_id, _), fragment in zip(rows, _fragments.get_many(*keys)):
+        if fragment is not None:
+            found[club_id] = fragment
+    missing = {club_id: version for club_id, version in rows if club_id not in found}
+    # In batches, to stay under SQLite's limit on bound parameters.
+    ids = list(missing)
+    for start in range(0, len(ids), FRAGMENT_BATCH_SIZE):
+        with timed('json'):
+            for club in jsonify_clubs(Club.query.filter(Club.id.in_(ids[start:start + FRAGMENT_BATCH_SIZE]))):
+                found[club['id']] = encode(club)
+                _fragments.set('{}:{}:{}'.format(club['id'], missing[club['id']], tags_version), found[club['id']])
+    return [(club_id, found[club_id]) for club_id, _ in rows if club_id in found]
+
+def join_fragments(fragments):
+    return b'[' + b','.join(fragment for _, fragment in fragments) + b']\n'
+
+def clubs_response(clubs):
+    from flask import current_app
+    return current_app.response_class(join_fragments(club_fragments(clubs)), mimetype='application/json')
+
+def stream_clubs(clubs, chunk_size):
+    # Yields the serialized list as a JSON array one keyset page at a time, so
+    # only chunk_size clubs are ever held in memory.
+    from models import Club
+    yield b'['
+    last_id = None
+    while True:
+        page = clubs.order_by(Club.id)
+        if last_id is not None:
+            page = page.filter(Club.id > last_id)
+        data = club_fragments(page.limit(chunk_size))
+        if not data:
+            break
+        yield (b',' if last_id is not None else b'') + b','.join(fragment for _, fragment in data)
+        last_id = data[-1][0]
+        if len(data) < chunk_size:
+            break
+    yield b']'
+
+SORTS = {'popular': 'favorite_count', 'trending': 'trending'}
+
+def sort_clubs(clubs, sort, after=None):
+    # Orders the clubs by a leaderboard column (models.Club's indexes), top
+    # first, resuming after the club with id `after`. Returns None if that
+    # club is gone.
+    from sqlalchemy import tuple_
+    from models import Club
+    column = getattr(Club, SORTS[sort])
+    if after is not None:
+        score = db.session.query(column).filter(Club.id == after).first()
+        if score is None:
+            return None
+        clubs = clubs.filter(tuple_(column, Club.id) < tuple_(score[0], after))
+    return clubs.order_by(column.desc(), Club.id.desc())
+
 def jsonify_tags(tags):
     tags_dict = [tag.to_dict() for tag in tags]
     return tags_dict
 
 def jsonify_files(files):
-    files_dict = [{"filename": file} for file in files]
+    files_dict = [{'id': file.id, 'filename': file.name, 'size': file.size, 'mime': file.mime,
+                   'digest': file.digest, 'modified': file.mtime.isoformat() + 'Z'} for file in files]
     return files_dict
 
 def create_club_code(club_name):
@@ -49,38 +243,81 @@ def create_token(username):
     from flask import current_app
     import datetime
     import jwt
+    import uuid
     payload = {
         'exp': datetime.datetime.utcnow() + datetime.timedelta(days=1),
         'iat': datetime.datetime.utcnow(),
-        'sub': username
+        'sub': username,
+        'jti': uuid.uuid4().hex
     }
     return jwt.encode(payload, current_app.config.get('SECRET_KEY'), algorithm='HS256')
 
-def validate_token(token):
-    from models import InvalidToken
-    if InvalidToken.query.filter_by(id=token).first():
-        return False
+def authenticate(token):
+    # Returns the user a token belongs to, or None if it is invalid, expired or
+    # revoked. The JWT is decoded at most once per AUTH_CACHE_TTL, and the
+    # revocation table is only queried when the Bloom filter can't rule it out.
     from flask import current_app
+    import datetime
     import jwt
-    try:
-        payload = jwt.decode(token, current_app.config.get('SECRET_KEY'), algorithms='HS256')
-        return True
-    except jwt.ExpiredSignatureError:
-        return False
-    except jwt.InvalidTokenError:
-        return False
-
-def decode_token(token):
+    from models import User, InvalidToken
+    from revocation import revocations, token_users
+    cached = token_users.get(token)
+    if cached is None:
+        from metrics import timed
+        try:
+            with timed('jwt'):
+                payload = jwt.decode(token, current_app.config.get('SECRET_KEY'), algorithms='HS256')
+        except jwt.InvalidTokenError:
+            return None
+        jti = payload.get('jti', token)
+    else:
+        user_id, jti = cached
+    if revocations.might_contain(jti) and InvalidToken.query.filter_by(jti=jti).first():
+        return None
+    if cached is not None:
+        return User.query.get(user_id)
+    user = User.query.filter_by(username=payload['sub']).first()
+    if user is None:
+        return None
+    expires_in = payload['exp'] - datetime.datetime.utcnow().timestamp()
+    token_users.set(token, (user.id, jti),
+                    timeout=max(1, min(current_app.config.get('AUTH_CACHE_TTL'), int(expires_in))))
+    return user
+
+def invalidate_token(token):
     from flask import current_app
+    import datetime
     import jwt
+    from models import InvalidToken
+    from revocation import revocations, token_users
+    from caching import invalidate
     payload = jwt.decode(token, current_app.config.get('SECRET_KEY'), algorithms='HS256')
-    return payload['sub']
+    jti = payload.get('jti', token)
+    expires = datetime.datetime.utcfromtimestamp(payload['exp'])
+    from database import write
+    write(lambda connection: connection.execute(InvalidToken.__table__.insert().values(jti=jti, expires=expires)))
+    revocations.add(jti)
+    token_users.delete(token)
+    invalidate('tokens')
+    purge_expired_tokens()
 
-def invalidate_token(token):
+_last_token_purge = 0
+
+def purge_expired_tokens(force=False):
+    # Revocations only matter until the token expires on its own. Runs on
+    # logout at most once per TOKEN_PURGE_INTERVAL seconds in each worker.
+    global _last_token_purge
+    from flask import current_app
+    import datetime
+    import time
     from models import InvalidToken
-    blacklist = InvalidToken(id=token)
-    db.session.add(blacklist)
+    if not force and time.time() - _last_token_purge < current_app.config.get('TOKEN_PURGE_INTERVAL'):
+        return 0
+    _last_token_purge = time.time()
+    purged = InvalidToken.query.filter(InvalidToken.expires < datetime.datetime.utcnow()) \
+        .delete(synchronize_session=False)
     db.session.commit()
+    return purged
 
 def file_is_allowed(filename):
     ALLOWED_EXTENSIONS = ['txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif']
@@ -91,6 +328,11 @@ def file_is_allowed(filename):
         i -= 1
     return file_extension.lower() in ALLOWED_EXTENSIONS
 
+def item_result(key, value, status, message, code):
+    # One item's outcome in a batch response, shaped like make_response's.
+    return {key: value, 'status': 'successful' if status else 'unsuccessful', 'message': message,
+            'status_code': code}
+
 def make_response(status, message, code):
     status_code = 'unsuccessful'
     if status:
@@ -2,7 +2,7 @@ from flask import Blueprint, request, redirect, jsonify
 from app import db, token_required
 from models import *
 from utils import *
-import bcrypt
+from passwords import hash_password, check_password, needs_rehash
 
 auth = Blueprint('auth', __name__, url_prefix='/api/')
 
@@ -16,7 +16,7 @@ def signup():
     email = data['email'].lower()
     if User.query.filter_by(username=username).first() or User.query.filter_by(email=email).first():
         return make_response(False, 'User with username and/or email already exists.', 409)
-    password = bcrypt.hashpw(data['password'].encode('utf8'), bcrypt.gensalt())
+    password = hash_password(data['password'])
     new_user = User(username=username, email=email, password=password)
     db.session.add(new_user)
     db.session.commit()
@@ -29,10 +29,13 @@ def login():
     if not all(item in data for item in required):
         return make_response(False, 'Missing credentials.', 400)
     username = data['username']
-    password = data['password'].encode('utf-8')
+    password = data['password']
     user = User.query.filter_by(username=username).first()
-    if not user or not bcrypt.checkpw(password, user.password):
+    if not user or not check_password(password, user.password):
         return make_response(False, 'Invalid authentication credentials.', 401)
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+        db.session.commit()
     token = create_token(username)
     responseObject = {
         'status': 'success',
@@ -1,19 +1,88 @@
-from flask import Blueprint, jsonify, abort, request
-from app import db, token_required, cache
+from flask import Blueprint, jsonify, abort, request, Response, stream_with_context
+from app import db, token_required
+from caching import cached, invalidate
 from models import *
 from utils import *
+from search import search_clubs, index_club, unindex_club
+from tagindex import filter_clubs, parse_tags
 import os
 
 club = Blueprint('club', __name__, url_prefix='/api/clubs')
 
 @club.route('/', methods=['GET'])
-@cache.memoize(timeout=600)
+@cached(lambda: ['clubs'])
 def get_clubs():
-    clubs = Club.query.all()
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        return make_response(False, 'Invalid limit.', 400)
+    tags = parse_tags(request.args)
+    if tags is None:
+        return make_response(False, 'Invalid match.', 400)
+    names, match = tags
+    sort = request.args.get('sort')
+    if sort is not None and sort not in SORTS:
+        return make_response(False, 'Invalid sort.', 400)
     if request.args.get('search'):
-        search = '%{}%'.format(request.args.get('search'))
-        clubs = Club.query.filter(Club.name.like(search)).all()
-    return jsonify_clubs(clubs), 200
+        clubs = search_clubs(request.args.get('search'))
+        if names:
+            clubs = filter_clubs(clubs, names, match)
+        offset = request.args.get('offset', 0, type=int)
+        if offset < 0:
+            return make_response(False, 'Invalid offset.', 400)
+        clubs = clubs.limit(limit).offset(offset)
+        return clubs_response(clubs), 200
+    clubs = Club.query
+    if request.args.get('stream'):
+        from app import app
+        if names:
+            clubs = filter_clubs(clubs, names, match)
+        chunks = stream_clubs(clubs, app.config.get('CLUB_STREAM_CHUNK_SIZE'))
+        return Response(stream_with_context(chunks), mimetype='application/json')
+    cursor = request.args.get('cursor', type=int)
+    if sort is not None:
+        if names:
+            clubs = filter_clubs(clubs, names, match)
+        clubs = sort_clubs(clubs, sort, cursor)
+        if clubs is None:
+            return make_response(False, 'Invalid cursor.', 400)
+    else:
+        if names:
+            clubs = filter_clubs(clubs, names, match, cursor, limit)
+        if cursor is not None:
+            clubs = clubs.filter(Club.id > cursor)
+        clubs = clubs.order_by(Club.id)
+    fragments = club_fragments(clubs.limit(limit))
+    response = Response(join_fragments(fragments), mimetype='application/json')
+    if limit is not None and len(fragments) == limit:
+        response.headers['X-Next-Cursor'] = fragments[-1][0]
+    return response, 200
+
+@club.route('/batch', methods=['GET'])
+@cached(lambda: ['clubs', 'tags'])
+def get_clubs_batch():
+    codes = [code for value in request.args.getlist('codes') for code in value.split(',') if code]
+    return lookup_clubs({'codes': codes})
+
+@club.route('/batch', methods=['POST'])
+def post_clubs_batch():
+    # For lists too long for a query string.
+    return lookup_clubs(request.get_json())
+
+def lookup_clubs(data):
+    lists, error = batch_lists(data, 'codes')
+    if error:
+        return make_response(False, error, 400)
+    codes = lists[0]
+    clubs = {club['code']: club for club in jsonify_clubs(Club.query.filter(Club.code.in_(codes)))}
+    results = []
+    for code in codes:
+        if code in clubs:
+            result = item_result('code', code, True, 'Club found.', 200)
+            result['club'] = clubs[code]
+        else:
+            result = item_result('code', code, False, 'No club with this code found.', 404)
+        results.append(result)
+    return jsonify({'clubs': results}), 200
 
 @club.route('/', methods=['POST'])
 @token_required
@@ -33,12 +102,13 @@ def add_club(current_user):
     data['owner'] = current_user.username
     club = create_club(data)
     club.members.append(current_user)
-    cache.delete_memoized(get_clubs)
     db.session.commit()
+    invalidate('clubs', 'tags', 'club:' + club.code)
     return jsonify(club.to_dict()), 201
 
 @club.route('/<code>/', methods=['GET'])
-@cache.memoize(timeout=600)
+# The embedded tags carry their club counts, which change with other clubs.
+@cached(lambda code: ['club:' + code, 'tags'])
 def get_club(code):
     club = Club.query.filter_by(code=code).first()
     if not club:
@@ -66,10 +136,10 @@ def modify_club(current_user, code):
         club.description = data['description']
     if 'tags' in data:
         tags = [tag['name'] for tag in data['tags']]
-        club.tags = [get_or_create(tag) for tag in tags]
+        club.tags = [get_or_create_tag(tag) for tag in dict.fromkeys(tags)]
+    index_club(club)
     db.session.commit()
-    cache.delete_memoized(get_club)
-    cache.delete_memoized(get_clubs)
+    invalidate('clubs', 'tags', 'club:' + code)
     return jsonify(club.to_dict()), 201
 
 @club.route('/<code>/', methods=['DELETE'])
@@ -81,14 +151,16 @@ def delete_club(current_user, code):
     club_owner = User.query.filter_by(username=club.owner).first()
     if club_owner and current_user != club_owner:
         return make_response(False, 'Only club owners can delete a club.', 403)
+    import storage
+    unindex_club(club.id)
+    files = list(club.files)
     db.session.delete(club)
-    db.session.commit()
-    cache.delete_memoized(get_clubs)
-    cache.delete_memoized(get_club)
+    storage.delete(files)
+    invalidate('clubs', 'tags', 'club:' + code, 'comments:' + code, 'files:' + code)
     return make_response(True, 'Club successfully deleted.', 200)
 
 @club.route('/<code>/members/', methods=['GET'])
-@cache.memoize(timeout=600)
+@cached(lambda code: ['club:' + code, 'users'])
 def get_club_members(code):
     club = Club.query.filter_by(code=code).first()
     if not club:
@@ -116,9 +188,48 @@ def add_club_member(current_user, code):
         return make_response(False, 'User to be added is already a member.', 409)
     club.members.append(new_member)
     db.session.commit()
-    cache.delete_memoized(get_club_members)
+    invalidate('clubs', 'club:' + code)
     return jsonify(new_member.to_dict()), 201
 
+@club.route('/<code>/members/batch', methods=['POST'])
+@token_required
+def batch_club_members(current_user, code):
+    club = Club.query.filter_by(code=code).first()
+    if not club:
+        return make_response(False, 'Club with this code not found.', 404)
+    club_owner = User.query.filter_by(username=club.owner).first()
+    if club_owner and current_user != club_owner:
+        return make_response(False, 'Only club owners can change the members of a club.', 403)
+    lists, error = batch_lists(request.get_json(), 'add', 'remove')
+    if error:
+        return make_response(False, error, 400)
+    add, remove = lists
+    users = dict(db.session.query(User.username, User.id).filter(User.username.in_(add + remove)))
+    club_id, current_user_id = club.id, current_user.id
+    db.session.commit()
+    members = update_links(user_to_club, 'club_id', club_id, 'user_id',
+                           [users[name] for name in add if name in users],
+                           [users[name] for name in remove if name in users and users[name] != current_user_id])
+    added, removed = [], []
+    for name in add:
+        if name not in users:
+            added.append(item_result('username', name, False, 'User with that username not found.', 404))
+        elif users[name] in members:
+            added.append(item_result('username', name, False, 'User to be added is already a member.', 409))
+        else:
+            added.append(item_result('username', name, True, 'Member successfully added.', 201))
+    for name in remove:
+        if name in users and users[name] == current_user_id:
+            removed.append(item_result('username', name, False,
+                                       'Club owners may not remove themselves as members.', 409))
+        elif name not in users or users[name] not in members:
+            removed.append(item_result('username', name, False, 'No member with that username found.', 404))
+        else:
+            removed.append(item_result('username', name, True, 'Member successfully removed.', 200))
+    if any(result['status_code'] < 300 for result in added + removed):
+        invalidate('clubs', 'club:' + code)
+    return jsonify({'added': added, 'removed': removed}), 200
+
 @club.route('/<code>/members/<username>', methods=['DELETE'])
 @token_required
 def delete_club_member(current_user, code, username):
@@ -135,21 +246,29 @@ def delete_club_member(current_user, code, username):
         return make_response(False, 'Club owners may not remove themselves as members.', 409)
     club.members.remove(former_member)
     db.session.commit()
-    cache.delete_memoized(get_club_members)
+    invalidate('clubs', 'club:' + code)
     return make_response(True, 'Member successfully removed.', 200)
 
 @club.route('/<code>/files', methods=['GET'])
-@cache.memoize(timeout=600)
+@cached(lambda code: ['files:' + code])
 def get_club_files(code):
     club = Club.query.filter_by(code=code).first()
     if not club:
         return make_response(False, 'No such club found.', 404)
-    from app import app
-    club_folder = os.path.join(app.config.get('UPLOAD_FOLDER'), code)
-    if not os.path.isdir(club_folder):
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        return make_response(False, 'Invalid limit.', 400)
+    files = File.query.join(file_to_club).filter(file_to_club.c.club_id == club.id)
+    cursor = request.args.get('cursor', type=int)
+    if cursor is not None:
+        files = files.filter(File.id > cursor)
+    files = jsonify_files(files.order_by(File.id).limit(limit))
+    if not files and cursor is None:
         return make_response(False, 'No files found for this club.', 404)
-    files = os.listdir(club_folder)
-    return jsonify_files(files), 200
+    response = jsonify(files)
+    if limit is not None and len(files) == limit:
+        response.headers['X-Next-Cursor'] = files[-1]['id']
+    return response, 200
 
 @club.route('/<code>/files', methods=['POST'])
 @token_required
@@ -166,28 +285,36 @@ def add_club_file(current_user, code):
     if not (file.filename and file_is_allowed(file.filename)):
         return make_response(False, 'File type not supported.', 400)
     from werkzeug.utils import secure_filename
+    import derivatives
+    import storage
     filename = secure_filename(file.filename)
-    from app import app
-    club_folder = os.path.join(app.config.get('UPLOAD_FOLDER'), code)
-    if not os.path.isdir(club_folder):
-        os.makedirs(club_folder)
-    filepath = os.path.join(club_folder, filename)
-    if os.path.exists(filepath):
+    if storage.find_file(club, filename) or os.path.exists(storage.legacy_path(code, filename)):
         return make_response(False, 'Filename already taken.', 409)
-    file.save(filepath)
-    cache.delete_memoized(get_club_files)
-    return make_response(True, '{} uploaded to {}'.format(filename, filepath), 201)
+    stored = storage.store(club, filename, file.stream, file.mimetype)
+    derivatives.schedule(stored)
+    invalidate('files:' + code)
+    return make_response(True, '{} uploaded to {}'.format(filename, stored.path), 201)
 
 @club.route('/<code>/files/<filename>', methods=['GET'])
-@cache.memoize(timeout=60)
 def get_club_file(code, filename):
     from app import app
+    from flask import send_from_directory
+    import derivatives
+    import storage
+    size = request.args.get('size')
+    if size is not None and size not in app.config.get('IMAGE_SIZES'):
+        return make_response(False, 'Invalid size.', 400)
+    club = Club.query.filter_by(code=code).first()
+    stored = club and storage.find_file(club, filename)
+    if stored and size is not None and derivatives.is_image(stored):
+        return derivatives.send(stored, size)
+    if stored:
+        return storage.send(stored)
     club_folder = os.path.join(app.config.get('UPLOAD_FOLDER'), code)
     filepath = os.path.join(club_folder, filename)
     if not os.path.exists(filepath):
         return make_response(False, 'No file with this filename exists.', 404)
-    from flask import send_from_directory
-    return send_from_directory(club_folder, filename, as_attachment=True), 200
+    return send_from_directory(club_folder, filename, as_attachment=True)
 
 @club.route('/<code>/files/<filename>', methods=['PUT'])
 @token_required
@@ -198,20 +325,19 @@ def modify_club_file(current_user, code, filename):
     club_owner = User.query.filter_by(username=club.owner).first()
     if club_owner and current_user != club_owner:
         return make_response(False, 'Only club owners can modify club files.', 403)
-    from app import app
-    club_folder = os.path.join(app.config.get('UPLOAD_FOLDER'), code)
-    filepath = os.path.join(club_folder, filename)
-    if not os.path.exists(filepath):
+    import derivatives
+    import storage
+    if not storage.find_file(club, filename) and not os.path.exists(storage.legacy_path(code, filename)):
         return make_response(False, 'No such file found.', 404)
     file = request.files['file']
     if not file:
         return make_response(False, 'File not found in request.', 400)
     if not (file.filename and file_is_allowed(file.filename)):
         return make_response(False, 'File type not supported.', 400)
-    file.save(filepath)
-    cache.delete_memoized(get_club_file)
-    cache.delete_memoized(get_club_files)
-    return make_response(True, '{} successfully replaced at {}'.format(filename, club_folder), 201)
+    stored = storage.store(club, filename, file.stream, file.mimetype)
+    derivatives.schedule(stored)
+    invalidate('files:' + code)
+    return make_response(True, '{} successfully replaced at {}'.format(filename, stored.path), 201)
 
 @club.route('/<code>/files/<filename>', methods=['DELETE'])
 @token_required
@@ -222,29 +348,36 @@ def delete_club_file(current_user, code, filename):
     club_owner = User.query.filter_by(username=club.owner).first()
     if club_owner and current_user != club_owner:
         return make_response(False, 'Only club owners can delete club files.', 403)
-    from app import app
-    club_folder = os.path.join(app.config.get('UPLOAD_FOLDER'), code)
-    filepath = os.path.join(club_folder, filename)
-    if not os.path.exists(filepath):
+    import storage
+    stored = storage.find_file(club, filename)
+    filepath = stored.path if stored else storage.legacy_path(code, filename)
+    if stored:
+        storage.delete([stored])
+    elif os.path.exists(filepath):
+        os.remove(filepath)
+    else:
         return make_response(False, 'File with this filepath not found.', 404)
-    os.remove(filepath)
-    cache.delete_memoized(get_club_file)
-    cache.delete_memoized(get_club_files)
+    invalidate('files:' + code)
     return make_response(True, '{} successfully deleted.'.format(filepath), 200)
 
 @club.route('/<code>/comments/', methods=['GET'])
-@cache.memoize(timeout=60)
+@cached(lambda code: ['comments:' + code, 'users'])
 def get_club_comments(code):
     club = Club.query.filter_by(code=code).first()
     if not club:
         return make_response(False, 'Club with this code not found.', 404)
-    comments = Comment.query.filter_by(club_id=club.id).all()
+    from app import app
+    if request.args.get('threaded'):
+        depth = request.args.get('depth', app.config.get('COMMENT_THREAD_MAX_DEPTH'), type=int)
+        depth = min(depth, app.config.get('COMMENT_THREAD_MAX_DEPTH'))
+        return jsonify(jsonify_thread(club, depth=depth)), 200
+    comments = Comment.query.filter_by(club_id=club.id)
     if request.args.get('search'):
-        comments = comments.query.filter(user_id=request.args.get('search'))
+        comments = comments.filter_by(user_id=request.args.get('search'))
     return jsonify_comments(comments), 200
 
 @club.route('/<code>/comments/<comment_id>', methods=['GET'])
-@cache.memoize(timeout=60)
+@cached(lambda code, comment_id: ['comments:' + code, 'users'])
 def get_comment(code, comment_id):
     club = Club.query.filter_by(code=code).first()
     if not club:
@@ -255,7 +388,21 @@ def get_comment(code, comment_id):
     subcomments = Comment.query.filter_by(parent_id=comment.id).all()
     if len(subcomments) != 0:
         return jsonify_comments(subcomments), 200
-    return jsonify(comment.to_dict()), 200
+    return jsonify(jsonify_comments([comment])[0]), 200
+
+@club.route('/<code>/comments/<int:comment_id>/thread', methods=['GET'])
+@cached(lambda code, comment_id: ['comments:' + code, 'users'])
+def get_comment_thread(code, comment_id):
+    club = Club.query.filter_by(code=code).first()
+    if not club:
+        return make_response(False, 'Club with this code not found.', 404)
+    from app import app
+    depth = request.args.get('depth', app.config.get('COMMENT_THREAD_MAX_DEPTH'), type=int)
+    depth = min(depth, app.config.get('COMMENT_THREAD_MAX_DEPTH'))
+    thread = jsonify_thread(club, root_id=comment_id, depth=depth)
+    if not thread:
+        return make_response(False, 'Comment with this ID not found.', 404)
+    return jsonify(thread[0]), 200
 
 @club.route('/<code>/comments/', methods=['POST'])
 @token_required
@@ -266,12 +413,8 @@ def add_comment(current_user, code):
     data = request.get_json()
     if 'content' not in data:
         return make_response(False, 'Comment content not found in request.', 400)
-    comment = data['content']
-    new_comment = Comment(content=comment, user_id=current_user.id, club_id=club.id)
-    db.session.add(new_comment)
-    db.session.commit()
-    cache.delete_memoized(get_club_comments)
-    cache.delete_memoized(get_club_comment)
+    new_comment = create_comment(data['content'], current_user.id, club.id)
+    invalidate('comments:' + code)
     return jsonify(new_comment.to_dict()), 201
 
 @club.route('/<code>/comments/<comment_id>', methods=['POST'])
@@ -286,12 +429,8 @@ def add_subcomment(current_user, code, comment_id):
     data = request.get_json()
     if 'content' not in data:
         return make_response(False, 'Comment content not found in request.', 400)
-    comment = data['content']
-    new_comment = Comment(content=comment, user_id=current_user.id, club_id=club.id, parent_id=comment_id)
-    db.session.add(new_comment)
-    db.session.commit()
-    cache.delete_memoized(get_club_comments)
-    cache.delete_memoized(get_club_comment)
+    new_comment = create_comment(data['content'], current_user.id, club.id, parent_id=comment.id)
+    invalidate('comments:' + code)
     return jsonify(new_comment.to_dict()), 201
 
 @club.route('/<code>/comments/<comment_id>', methods=['DELETE'])
@@ -308,6 +447,5 @@ def delete_club_comment(current_user, code, comment_id):
         return make_response(False, 'You can only delete your own comments.', 403)
     db.session.delete(comment)
     db.session.commit()
-    cache.delete_memoized(get_club_comments)
-    cache.delete_memoized(get_club_comment)
+    invalidate('comments:' + code)
     return make_response(True, 'Comment successfully deleted.', 200)
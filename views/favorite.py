@@ -1,16 +1,17 @@
 from flask import Blueprint, jsonify, request
-from app import db, token_required, cache
+from app import db, token_required
+from caching import cached, invalidate
 from models import *
 from utils import *
 
 favorite = Blueprint('favorite', __name__, url_prefix='/api/favorites')
 
 @favorite.route('/', methods=['GET'])
-@cache.memoize(timeout=600)
 @token_required
+@cached(lambda current_user: ['clubs', 'user:{}'.format(current_user.id)], per_user=True)
 def get_favorites(current_user):
-    clubs = [club for club in current_user.favorites]
-    return jsonify_clubs(clubs), 200
+    clubs = Club.query.join(favorites).filter(favorites.c.user_id == current_user.id)
+    return clubs_response(clubs), 200
     
 @favorite.route('/', methods=['POST'])
 @token_required
@@ -22,9 +23,16 @@ def add_favorite(current_user):
     club = Club.query.filter_by(code=code).first()
     if not club:
         return make_response(False, 'Club with this code not found.', 404)
-    current_user.favorites.append(club)
-    db.session.commit()
-    cache.delete_memoized(get_favorites)
+    if club in current_user.favorites:
+        return make_response(False, 'Club already favorited.', 409)
+    from database import write
+    from sqlalchemy.exc import IntegrityError
+    try:
+        write(lambda connection: connection.execute(favorites.insert().values(user_id=current_user.id,
+                                                                                club_id=club.id)))
+    except IntegrityError:
+        return make_response(False, 'Club already favorited.', 409)
+    invalidate('clubs', 'club:' + code, 'user:{}'.format(current_user.id))
     return make_response(True, "Added to favorites.", 201)
 
 @favorite.route('/<code>', methods=['DELETE'])
@@ -35,7 +43,42 @@ def remove_favorite(current_user, code):
         return make_response(False, 'no such club found', 404)
     if club not in current_user.favorites:
         return make_response(False, 'no such club favorited', 404)
-    current_user.favorites.remove(club)
-    db.session.commit()
-    cache.delete_memoized(get_favorites)
+    from database import write
+    delete = favorites.delete().where(favorites.c.user_id == current_user.id, favorites.c.club_id == club.id)
+    write(lambda connection: connection.execute(delete))
+    invalidate('clubs', 'club:' + code, 'user:{}'.format(current_user.id))
     return make_response(True, 'favorite removed', 200)
+
+@favorite.route('/batch', methods=['POST'])
+@token_required
+def batch_favorites(current_user):
+    lists, error = batch_lists(request.get_json(), 'add', 'remove')
+    if error:
+        return make_response(False, error, 400)
+    add, remove = lists
+    clubs = dict(db.session.query(Club.code, Club.id).filter(Club.code.in_(add + remove)))
+    user_id = current_user.id
+    db.session.commit()
+    favorited = update_links(favorites, 'user_id', user_id, 'club_id',
+                             [clubs[code] for code in add if code in clubs],
+                             [clubs[code] for code in remove if code in clubs])
+    added, removed, changed = [], [], []
+    for code in add:
+        if code not in clubs:
+            added.append(item_result('code', code, False, 'Club with this code not found.', 404))
+        elif clubs[code] in favorited:
+            added.append(item_result('code', code, False, 'Club already favorited.', 409))
+        else:
+            added.append(item_result('code', code, True, 'Added to favorites.', 201))
+            changed.append(code)
+    for code in remove:
+        if code not in clubs:
+            removed.append(item_result('code', code, False, 'no such club found', 404))
+        elif clubs[code] not in favorited:
+            removed.append(item_result('code', code, False, 'no such club favorited', 404))
+        else:
+            removed.append(item_result('code', code, True, 'favorite removed', 200))
+            changed.append(code)
+    if changed:
+        invalidate('clubs', 'user:{}'.format(user_id), *['club:' + code for code in changed])
+    return jsonify({'added': added, 'removed': removed}), 200
@@ -1,12 +1,28 @@
-from flask import Blueprint, jsonify
-from utils import jsonify_tags
-from app import cache
+from flask import Blueprint, jsonify, request
+from utils import jsonify_tags, make_response
+from caching import cached
 from models import *
 
 tag = Blueprint('tag', __name__, url_prefix='/api/tags')
 
 @tag.route('/', methods=['GET'])
-@cache.memoize(timeout=60)
+@cached(lambda: ['tags'])
 def get_tags():
     tags = Tag.query.all()
     return jsonify_tags(tags), 200
+
+@tag.route('/facets', methods=['GET'])
+@cached(lambda: ['tags', 'clubs'])
+def get_tag_facets():
+    from tagindex import parse_tags, popcount, tag_index
+    tags = parse_tags(request.args)
+    if tags is None:
+        return make_response(False, 'Invalid match.', 400)
+    names, match = tags
+    tag_index.refresh()
+    selected = tag_index.select(names, match)
+    total = Club.query.count() if selected is None else popcount(selected)
+    facets = tag_index.facets(selected, exclude=names)
+    facets = [{'id': tag_id, 'name': name, 'clubs': count}
+              for name, (tag_id, count) in sorted(facets.items(), key=lambda item: (-item[1][1], item[0]))]
+    return jsonify({'clubs': total, 'tags': facets}), 200
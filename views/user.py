@@ -2,6 +2,7 @@ from flask import Blueprint, jsonify, abort, request
 from app import db, token_required
 from models import *
 from utils import *
+from caching import invalidate
 
 user = Blueprint('user', __name__, url_prefix='/api/users')
 
@@ -27,10 +28,10 @@ def modify_user(current_user, username):
     if 'email' in data:
         user.email = data['email']
     if 'password' in data:
-        import bcrypt
-        new_password = data['password'].encode('utf8')
-        user.password = bcrypt.hashpw(new_password, bcrypt.gensalt())
+        from passwords import hash_password
+        user.password = hash_password(data['password'])
     db.session.commit()
+    invalidate('users')
     return make_response(True, 'User information successfully updated.', 201)
 
 @user.route('/<username>', methods=['DELETE'])
@@ -42,6 +43,10 @@ def delete_user(current_user, username):
     if user != current_user:
         return make_response(False, 'You can only delete your own user profile.', 403)
     invalidate_token(request.headers.get('auth_token'))
+    user_id = current_user.id
+    # The cascade changes the counts of every club the user was in or liked.
+    codes = {club.code for club in current_user.clubs + current_user.favorites}
     db.session.delete(current_user)
     db.session.commit()
+    invalidate('users', 'clubs', 'user:{}'.format(user_id), *['club:' + code for code in codes])
     return make_response(True, 'User successfully deleted.', 200)